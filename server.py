@@ -3,11 +3,11 @@ import sys
 from flask_cors import CORS
 from json import dumps
 import json
-from flask import Flask, request, send_from_directory
+from flask import Flask, request, send_from_directory, make_response
 import time as t
 from timeloop import Timeloop
 from datetime import date, time, datetime
-import threading
+import atexit
 import server_data
 import os
 import pickle
@@ -16,8 +16,13 @@ sys.path.append('server/')
 from server.helper import *
 from server.channels import *
 from server.auth import auth_register, auth_login, auth_logout, auth_passwordreset_request, auth_passwordreset_reset, admin_userpermission_change
-from server.user_profile import user_profile, user_profile_setname, user_profile_setemail, user_profile_sethandle, user_profiles_uploadphoto, users_all
-from server.messages import message_send, message_pin, message_unpin, message_react, message_unreact, message_remove, message_edit, search, message_sendlater, standup_start, standup_send, standup_active
+from server.user_profile import user_profile, user_profile_setname, user_profile_setemail, user_profile_sethandle, user_profiles_uploadphoto, user_profiles_uploadphoto_status, users_all, users_all_json, users_all_page, user_profile_setphoto
+from server.messages import message_send, message_pin, message_unpin, message_react, message_unreact, message_remove, message_edit, search, search_terms, message_sendlater, standup_start, standup_send, standup_active
+from server import persistence, passwords, images
+from server.storage import SqliteStorage
+from server.scheduler import Scheduler
+from server.mail import OUTBOX
+from server.locks import reads_channels, writes
 APP = Flask(__name__, static_url_path='/static/')
 
 CORS(APP)
@@ -42,57 +47,73 @@ def echo2():
 
 # The following function is for typecasting a token so that it can be used inside form
 def type_cast(token):
-        for user in server_data.data['users']:
-            if str(user["token"]) == token:
-                return user["token"]
+        if token in server_data.sessions:
+            return token
         return None
 
 # ========================== PERSISTENCE ========================== #
 
-if os.path.exists('dataStore.json'):
-    server_data.data = json.load(open('dataStore.json','r'))
-    
-if os.path.exists('standups.json'):
-    server_data.standups = json.load(open('standups.json','r'))
-
-if os.path.exists('messagesLater.json'):
-    server_data.messages_later = json.load(open('messagesLater.json','r'))
-
+# Mutations are appended to dataStore.log as they happen, the json stores
+# are only rewritten at checkpoints
+# Set SLACKR_DB to write each change to a sqlite database instead, it is filled
+# from the json stores the first time it is used. Only the users and channels
+# are read into memory on startup, the message history is served from the
+# database's tables
+# Also set SLACKR_SHARED=1 to serve the same database from several worker
+# processes, e.g. gunicorn -w 4 server:APP (without --preload, so each worker
+# opens its own connection)
+if os.environ.get('SLACKR_DB'):
+    STORAGE = SqliteStorage(os.environ['SLACKR_DB'],
+                            shared=bool(os.environ.get('SLACKR_SHARED')))
+    persistence.use_storage(STORAGE)
+    if STORAGE.shared:
+        # uploads can be polled from any worker
+        images.use_shared(STORAGE)
+persistence.load()
+
+# Seconds between each run of the periodic jobs
+LATER_MESSAGES_INTERVAL = float(os.environ.get('SLACKR_LATER_INTERVAL', 1))
+STANDUPS_INTERVAL = float(os.environ.get('SLACKR_STANDUP_INTERVAL', 1))
+SYNC_INTERVAL = float(os.environ.get('SLACKR_SYNC_INTERVAL', 1))
+CHECKPOINT_INTERVAL = float(os.environ.get('SLACKR_CHECKPOINT_INTERVAL', 5))
+
+# Image worker processes are forked before any other thread is started
+images.start()
+
+SCHEDULER = Scheduler()
+SCHEDULER.add('later_messages', check_latermessages, LATER_MESSAGES_INTERVAL)
+SCHEDULER.add('standups', check_standups, STANDUPS_INTERVAL)
+SCHEDULER.add('sync', persistence.sync, SYNC_INTERVAL)
+SCHEDULER.add('checkpoint', persistence.maybe_checkpoint, CHECKPOINT_INTERVAL)
+SCHEDULER.start()
+
+# Mail is sent from its own thread, see server/mail.py for SLACKR_MAIL
+OUTBOX.start()
+
+# Called by routes after a change, the periodic jobs are left to the scheduler
 def save():
-    check_latermessages()
-    check_standups()
-    print('Saving!', t.strftime('%Y-%m-%d %H:%M:%S', t.localtime(int(t.time()))))
-    with open('dataStore.json','w') as FILE:
-        json.dump(server_data.data, FILE, indent = 4, sort_keys=False)
-    with open('standups.json','w') as FILE:
-        json.dump(server_data.standups, FILE, indent = 4, sort_keys=False)
-    with open('messagesLater.json','w') as FILE:
-        json.dump(server_data.messages_later, FILE, indent = 4, sort_keys=False)
-
-def timerAction():
-    timer = threading.Timer(1.0,timerAction)
-    timer.start()
-    save()
-timerAction()
+    persistence.sync()
+
+@atexit.register
+def shutdown():
+    SCHEDULER.stop()
+    OUTBOX.stop()
+    images.stop()
+    persistence.close()
 
 # ========================== DEV FUNCTIONS ======================== #
 @APP.route('/data/reset', methods=['POST'])
+@writes
 def data_resett():
     """ Dev showing all data """
-    server_data.data = {
-        "n_users"       : 0,
-        "users"         : [],
-        "n_channels"    : 0,
-        "channels"      : [],
-        "n_messages"    : 0    
-    }
-    server_data.messages_later = []
-    server_data.standups = []
+    reset_data()
+    persistence.checkpoint()
     return dumps({
         'data': server_data.data
     })
     
 @APP.route('/data/getall', methods=['GET'])
+@reads_channels
 def get_all():
     """ Dev showing all data """
     return dumps({
@@ -100,6 +121,7 @@ def get_all():
     })
     
 @APP.route('/data/later', methods=['GET'])
+@reads_channels
 def get_later():
     """ Dev showing messages to be sent later"""
     return dumps({
@@ -107,6 +129,7 @@ def get_later():
     })
     
 @APP.route('/data/standups', methods=['GET'])
+@reads_channels
 def get_standups():
     """ Dev showing all standups"""
     return dumps({
@@ -114,13 +137,36 @@ def get_standups():
     })
     
 @APP.route('/data/getlater', methods=['GET'])
+@reads_channels
 def get_messages_later():
     """ Dev showing all data """
     return dumps(
         server_data.messages_later
     )
     
+@APP.route('/data/scheduler', methods=['GET'])
+def get_scheduler_stats():
+    """ Dev showing how long each periodic job takes """
+    return dumps(
+        SCHEDULER.stats()
+    )
+
+@APP.route('/data/passwords', methods=['GET'])
+def get_password_stats():
+    """ Dev showing how long hashing and checking passwords takes """
+    return dumps(
+        passwords.stats()
+    )
+
+@APP.route('/data/mail', methods=['GET'])
+def get_mail_stats():
+    """ Dev showing how much mail has been queued and sent """
+    return dumps(
+        OUTBOX.stats()
+    )
+
 @APP.route('/data/add', methods=['POST'])
+@writes
 def add():
     """ Dev adding a user """
     name = request.args.get('name')
@@ -128,10 +174,12 @@ def add():
     server_data.data['users'].append(name)
     server_data.data['users'].append(last)
     server_data.data['n_users'] += 1
+    persistence.touch('data')
     return dumps({
     })
 
 @APP.route('/data/delete', methods=['DELETE'])
+@writes
 def create():
     """ Dev removing a user """
     name = request.args.get('name')
@@ -140,6 +188,7 @@ def create():
         if x == name:
             server_data.data['users'].remove(name)
             server_data.data['n_users'] -= 1
+            persistence.touch('data')
     return dumps({
     })
 
@@ -261,7 +310,6 @@ def post_channel_invite():
     real_token = type_cast(token)
     channel_id = request.form.get('channel_id')
     u_id = request.form.get('u_id')
-    save()
     try:
         output = channel_invite(real_token, int(channel_id), int(u_id))
     except ValueError as e:
@@ -272,6 +320,7 @@ def post_channel_invite():
             'name' : 'AccessError',
             'message' : str(e)
         }), 400 
+    save()
     return dumps(
         output
     )
@@ -282,9 +331,12 @@ def get_channel_details():
     token = request.args.get('token')
     channel_id = request.args.get('channel_id')
     token = type_cast(token)
-    save()
+    start = request.args.get('start')
+    limit = request.args.get('limit')
     try:
-        output = channel_details(token, int(channel_id))
+        output = channel_details(token, int(channel_id),
+                                 None if start is None else int(start),
+                                 None if limit is None else int(limit))
     except ValueError as e:
         return str(e)
     except AccessError as e:
@@ -303,7 +355,6 @@ def post_channel_create():
     token = request.form.get('token')
     channel_name = request.form.get('name')
     is_public = request.form.get('is_public')
-    save()
     try:
         output = channel_create(token,channel_name,is_public)
     except ValueError as e:
@@ -314,6 +365,7 @@ def post_channel_create():
             'name' : 'AccessError',
             'message' : str(e)
         }), 400 
+    save()
     return dumps({        
         "channel_id" : output
     }) 
@@ -340,8 +392,17 @@ def get_channels_list():
 def channels_list_all():
     """ Lists all channels """
     token = request.args.get('token')
-    try:
+    prefix = request.args.get('prefix')
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    try:
+        # typeahead pickers ask for one page of the channels matching a prefix
+        if prefix is not None or cursor is not None or limit is not None:
+            return dumps(channels_listall_page(token, prefix or '', cursor,
+                                               None if limit is None else int(limit)))
         output = channels_listall(token)
+    except ValueError as e:
+        return str(e)
     except AccessError as e:
         return dumps ({
             'code' : 400,
@@ -359,7 +420,6 @@ def add_owner():
     token = request.form.get('token')
     channel_id = request.form.get('channel_id')
     u_id = request.form.get('u_id')
-    save()
     try:
         channel_addowner(type_cast(token), int(channel_id), int(u_id))
     except ValueError as e:
@@ -370,6 +430,7 @@ def add_owner():
             'name' : 'AccessError',
             'message' : str(e)
         }), 400 
+    save()
     return dumps({
     })
     
@@ -439,9 +500,12 @@ def messages():
     '''returns messages'''
     token = request.args.get('token')
     channel_id = request.args.get('channel_id') 
-    start = request.args.get('start')
+    start = request.args.get('start', 0)
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
     try:
-        output = channel_messages(str(token),int(channel_id),int(start))
+        output = channel_messages(str(token), int(channel_id), int(start), cursor,
+                                  None if limit is None else int(limit))
     except ValueError as e:
         return str(e)
     except AccessError as e:
@@ -450,7 +514,6 @@ def messages():
             'name' : 'AccessError',
             'message' : str(e)
         }), 400 
-    save()
     return dumps(
         output
     )
@@ -460,18 +523,30 @@ def messages():
 def get_users_all():
     """Lists all users across slackr"""
     token = request.args.get('token')
-    try:
-        output = users_all(type_cast(token))
+    prefix = request.args.get('prefix')
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    try:
+        # typeahead pickers ask for one page of the users matching a prefix
+        if prefix is not None or cursor is not None or limit is not None:
+            return dumps(users_all_page(type_cast(token), prefix or '', cursor,
+                                        None if limit is None else int(limit)))
+        body, etag = users_all_json(type_cast(token))
+    except ValueError as e:
+        return str(e)
     except AccessError as e:
         return dumps ({
             'code' : 400,
             'name' : 'AccessError',
             'message' : str(e)
         }), 400 
-    save()
-    return dumps(
-        output
-    )
+    # clients polling with the ETag they were last sent get an empty 304
+    # until a user changes
+    response = make_response(body)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 # ========================= USER PROFILE FUNCTIONS ==================== #
@@ -493,7 +568,6 @@ def user_profile_details():
             'name' : 'AccessError',
             'message' : str(e)
         }), 400 
-    save()
     return dumps(
         output
     )
@@ -735,11 +809,16 @@ def post_message_unreact():
 '''
 @APP.route('/search', methods=['GET'])
 def get_search():
-    """ Searches for a particular message given a query string """
+    """ Searches for a particular message given a query string
+        With terms=true every word or "quoted phrase" must match instead,
+        oldest first """
     token = request.args.get('token')
     query_str = request.args.get('query_str')
     try:
-        output = search(token, query_str)
+        if request.args.get('terms') == 'true':
+            output = search_terms(token, query_str)
+        else:
+            output = search(token, query_str)
     except ValueError as e:
         return str(e)
     except AccessError as e:
@@ -825,9 +904,7 @@ def user_uploadphoto():
     x_end = request.form.get('x_end')
     y_end = request.form.get('y_end')
     try:
-        output = user_profiles_uploadphoto(token ,str(img_url), int(x_start), int(y_start), int(x_end), int(y_end))
-        curr_user_id = token_to_user(token)
-        server_data.data['users'][curr_user_id]['profile_img_url'] = request.url_root + './static/' + token + '.jpg'
+        output = user_profiles_uploadphoto(token ,str(img_url), int(x_start), int(y_start), int(x_end), int(y_end), request.url_root)
     except ValueError as e:
         return str(e)
     except AccessError as e:
@@ -840,6 +917,43 @@ def user_uploadphoto():
         output
     )
 
+@APP.route('/user/profiles/uploadphoto/status', methods=['GET'])
+def user_uploadphoto_status():
+    token = request.args.get('token')
+    job_id = request.args.get('job_id')
+    try:
+        output = user_profiles_uploadphoto_status(token, job_id)
+    except ValueError as e:
+        return str(e)
+    except AccessError as e:
+        return dumps ({
+            'code' : 400,
+            'name' : 'AccessError',
+            'message' : str(e)
+        }), 400 
+    return dumps (
+        output
+    )
+
+# Stored images never change, so they are cached for a year and revalidated
+# by their hash
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+@APP.route('/' + images.IMAGE_ROUTE + '<name>', methods=['GET'])
+def get_image(name):
+    key, _, size = name[:-len('.jpg')].partition('_')
+    if not name.endswith('.jpg') or not images.is_key(key) or not (size == '' or size.isdigit()):
+        return dumps({
+            'code' : 404,
+            'name' : 'NotFound',
+            'message' : 'Image does not exist'
+        }), 404
+    response = send_from_directory(os.path.abspath(images.IMAGE_DIR), name,
+                                   etag=name[:-len('.jpg')], max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @APP.route('/static/<path>:path')
 def send_js(path):
     return send_from_directory('',path)
@@ -1,10 +1,14 @@
 ''' Auth Functions '''
-import hashlib
-import subprocess
 import server_data
 from server.helper import is_email, is_password, is_valid_name, generate_token
 from server.helper import is_slackr_admin, generate_reset_token, AccessError, token_to_user
-from server.helper import check_valid_user, validate_token
+from server.helper import check_valid_user, validate_token, start_session, end_session
+from server.helper import index_user
+from server.persistence import commit, applies
+from server.mail import OUTBOX
+from server import name_index
+from server.passwords import hash_password, check_password, needs_rehash
+from server.locks import reads, writes
 
 # ============================ AUTHORISATION ================================ #
 
@@ -22,9 +26,14 @@ def auth_register(email, password, name_first, name_last):
     is_valid_name(name_first)
     is_valid_name(name_last)
 
-    for user in server_data.data['users']:
-        if user['email'] == email:
-            raise ValueError('Email Taken')
+    # Hash encrypt password, before locking as it is slow
+    hashed = hash_pw(password)
+    return _register(email, password, hashed, name_first, name_last)
+
+@writes
+def _register(email, password, hashed, name_first, name_last):
+    if email in server_data.user_emails:
+        raise ValueError('Email Taken')
 
     # Set user_id depending on the number of users in the server
     u_id = server_data.data['n_users']
@@ -32,9 +41,6 @@ def auth_register(email, password, name_first, name_last):
     # Generate token
     token = generate_token(u_id, password)
 
-    # Hash encrypt password
-    password = hash_pw(password)
-
     # Generate handle
     handle_str = name_first.lower() + name_last.lower()
     handle_str = handle_str[:20]
@@ -42,18 +48,15 @@ def auth_register(email, password, name_first, name_last):
     og_handle_str = handle_str[:19]
 
     # Check if handle is taken
-    handle_count = 0
-    flag = 1
-    while flag:
-        flag = 0
-        for user in server_data.data['users']:
-            if handle_str == user['handle_str']:
-                flag = 1
-                break
-        if flag == 1:
+    # Numbering carries on from the last user given the same handle, so
+    # common names do not count up through every number already used
+    if handle_str in server_data.user_handles:
+        handle_count = server_data.handle_counts.get(og_handle_str, 0)
+        while handle_str in server_data.user_handles:
             # Increment number next to handle_str
             handle_count += 1
             handle_str = og_handle_str + str(handle_count)
+        server_data.handle_counts[og_handle_str] = handle_count
 
     # determine admin permission
     # The first joined user is the owner of the slackr
@@ -62,10 +65,10 @@ def auth_register(email, password, name_first, name_last):
     else:
         permission = 3
 
-    server_data.data["users"].append({
+    commit('auth_register', user={
         'token' : token,
         'email' : email,
-        'password': password,
+        'password': hashed,
         'name_first' : name_first,
         'name_last': name_last,
         'handle_str': handle_str,
@@ -75,9 +78,18 @@ def auth_register(email, password, name_first, name_last):
         'reset_token' : None,
         'profile_img_url' : ""
     })
+    return ({'u_id': u_id, 'token': token})
 
+@applies('auth_register', 'user')
+def _apply_auth_register(record):
+    user = dict(record['user'])
+    user['channels'] = list(user['channels'])
+    server_data.data["users"].append(user)
     server_data.data['n_users'] += 1
-    return ({'u_id': u_id, 'token': token})
+    server_data.users_version += 1
+    index_user(user)
+    name_index.add_user(user)
+    start_session(user['token'], user['u_id'])
 
 
 def auth_login(email, password):
@@ -87,49 +99,93 @@ def auth_login(email, password):
     is_email(email) # Checks if the email is a valid email
 
     # only return token if it exists and password matches
-    for user in server_data.data['users']:
-        if user['email'] == email:
-            if hashlib.sha256(password.encode()).hexdigest() == user['password']:
-                u_id = user['u_id']
-                token = generate_token(u_id, password)
-                # Set the user's token
-                server_data.data['users'][int(u_id)]['token'] = token
-                return ({'u_id': u_id, 'token': token})
+    # the password is checked without holding the lock, so it is checked
+    # again if the user's password changed in the meantime
+    while True:
+        u_id, stored = _login_password(email)
+        if not check_password(password, stored):
             raise ValueError('Password incorrect')
 
-    # Otherwise, raise a ValueError
-    raise ValueError('Email does not exist')
+        # passwords hashed at an older cost are replaced as the user logs in
+        rehashed = hash_pw(password) if needs_rehash(stored) else None
+        output = _login(u_id, password, stored, rehashed)
+        if output is not None:
+            return output
+
+@reads
+def _login_password(email):
+    u_id = server_data.user_emails.get(email)
+    if u_id is None:
+        # Otherwise, raise a ValueError
+        raise ValueError('Email does not exist')
+    return u_id, server_data.data['users'][u_id]['password']
+
+@writes
+def _login(u_id, password, stored, rehashed):
+    if server_data.data['users'][u_id]['password'] != stored:
+        return None
+
+    token = generate_token(u_id, password)
+    # Set the user's token
+    if rehashed is None:
+        commit('auth_login', u_id=u_id, token=token)
+    else:
+        commit('auth_login', u_id=u_id, token=token, password=rehashed)
+    return ({'u_id': u_id, 'token': token})
 
+@applies('auth_login', 'user')
+def _apply_auth_login(record):
+    user = server_data.data['users'][int(record['u_id'])]
+    if user['token'] is not None:
+        end_session(user['token'])
+    user['token'] = record['token']
+    if 'password' in record:
+        user['password'] = record['password']
+    start_session(record['token'], user['u_id'])
+
+@writes
 def auth_logout(token):
     '''
     Logs users out by setting their token to None
     '''
-    for user in server_data.data['users']:
-        if str(user['token']) == str(token):
-            user['token'] = None
-            return {'is_success': True}
+    u_id = server_data.sessions.get(str(token))
+    if u_id is not None:
+        commit('auth_logout', u_id=u_id)
+        return {'is_success': True}
 
     # Otherwise return false
     return {'is_success': False}
 
+@applies('auth_logout', 'user')
+def _apply_auth_logout(record):
+    user = server_data.data['users'][record['u_id']]
+    if user['token'] is not None:
+        end_session(user['token'])
+    user['token'] = None
+
+@writes
 def auth_passwordreset_request(email):
     '''
     This functions is for requesting a password reset
     '''
     is_email(email)
 
-    for user in server_data.data["users"]:
-        if user['email'] == str(email):
-            # setting reset code
-            #print("Email found")
-            reset = generate_reset_token(user['u_id'], user['password'])
-            user['reset_token'] = reset
-            msg = '"Your reset code is ' + str(reset)  + '"'
-            cmd = 'echo ' + msg + ' | mailx ' + str(email) + ' -s ' + '"Password Reset"'
-            subprocess.call(cmd, shell=True)
-            return {}
+    u_id = server_data.user_emails.get(str(email))
+    if u_id is None:
+        raise ValueError('Email does not exist')
+
+    # setting reset code
+    user = server_data.data["users"][u_id]
+    reset = generate_reset_token(user['u_id'], user['password'])
+    commit('auth_passwordreset_request', u_id=user['u_id'], reset_token=reset)
+    # only the latest code works, so it replaces any still waiting to be sent
+    OUTBOX.send(str(email), 'Password Reset', 'Your reset code is ' + str(reset),
+                key=('reset', u_id))
+    return {}
 
-    raise ValueError('Email does not exist')
+@applies('auth_passwordreset_request', 'user')
+def _apply_auth_passwordreset_request(record):
+    server_data.data['users'][record['u_id']]['reset_token'] = record['reset_token']
 
 
 def auth_passwordreset_reset(reset_code, new_password):
@@ -139,14 +195,22 @@ def auth_passwordreset_reset(reset_code, new_password):
     is_password(new_password)
 
     new_password = hash_pw(new_password)
+    return _passwordreset_reset(reset_code, new_password)
 
+@writes
+def _passwordreset_reset(reset_code, new_password):
     for user in server_data.data["users"]:
         if str(user['reset_token']) == str(reset_code):
-            user['password'] = new_password
-            user['reset_token'] = None
+            commit('auth_passwordreset_reset', u_id=user['u_id'], password=new_password)
             return {}
     raise ValueError("Reset code is not valid")
 
+@applies('auth_passwordreset_reset', 'user')
+def _apply_auth_passwordreset_reset(record):
+    user = server_data.data['users'][record['u_id']]
+    user['password'] = record['password']
+    user['reset_token'] = None
+
 
 
 # Given a User by their user ID, set their permissions to new permissions
@@ -155,6 +219,7 @@ def auth_passwordreset_reset(reset_code, new_password):
 # Admin permission = 2
 # Member permission_id = 3
 
+@writes
 @validate_token
 def admin_userpermission_change(token, u_id, permission_id):
     '''
@@ -187,13 +252,16 @@ def admin_userpermission_change(token, u_id, permission_id):
         pass
 
     # set the permission
-    server_data.data['users'][u_id]['permission'] = permission_id
+    commit('admin_userpermission_change', u_id=u_id, permission_id=permission_id)
 
     return {}
 
+@applies('admin_userpermission_change', 'user')
+def _apply_admin_userpermission_change(record):
+    server_data.data['users'][record['u_id']]['permission'] = record['permission_id']
+
 def hash_pw(password):
     '''
-    Simple hashing function for the password
+    Hashing function for the password, see server/passwords.py
     '''
-    password = hashlib.sha256(password.encode()).hexdigest()
-    return password
+    return hash_password(password)
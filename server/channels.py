@@ -1,14 +1,21 @@
 '''Channels'''
+import bisect
 import sys
 import server_data
 from server.helper import is_valid_token, channel_exists, token_to_user, members_list
 from server.helper import get_userinfo, check_valid_user, check_valid_channel, is_owner
 from server.helper import is_slackr_admin, is_valid_name, check_channel_member, AccessError
-from server.helper import valid_start, channel_id_exists
+from server.helper import valid_start, channel_id_exists, validate_token, view_message
+from server.helper import channel_arg, index_member, unindex_member, set_channel_permission
+from server.persistence import commit, applies, message_store
+from server.images import thumbnail_url
+from server import name_index
+from server.paging import page_limit, encode_cursor, decode_cursor
+from server.locks import reads, writes, reads_channel
 sys.path.append('../')
 
 
-
+@writes
 def channel_join(token, channel_id):
     '''
     Using a valid token, the user joins a channel specified by 'channel_id'
@@ -16,6 +23,9 @@ def channel_join(token, channel_id):
     Raises errors if:
     - Channel doesn't exist
     - User tries to join a private channel
+
+    A member joining again is turned away without a change, so they are
+    never listed twice
     '''
     is_valid_token(token)
   # When channel Id is invalid
@@ -28,25 +38,34 @@ def channel_join(token, channel_id):
 
     user_id = token_to_user(token)
 
-  # Add user to channel 'members' list (channel_permission 2)
-    # create a new dictionary with u_id and default channel permission
-    data = {
-        'u_id': user_id,
+  # When user is already a member
+    if check_channel_member(user_id, channel_id):
+        return
+
+    commit('channel_join', channel_id=channel_id, u_id=user_id)
+
+@applies('channel_join', 'member')
+@applies('channel_invite', 'member')
+def _apply_channel_join(record):
+  # Logs written before repeat joins were turned away may hold them
+    if check_channel_member(record['u_id'], record['channel_id']):
+        return
+
+  # Add user to channel 'members' list (channel_permission 0)
+    # append a new dictionary with u_id and default channel permission
+    member = {
+        'u_id': record['u_id'],
         'channel_permission': 0,
     }
-
-    # append this to the channel list
-    members = members_list(channel_id)
-    members.append(data)
+    members_list(record['channel_id']).append(member)
+    index_member(record['channel_id'], member)
 
   # Add channel to users 'channels' list
-    # get user info
-    user_info = get_userinfo(user_id)
-
-    # add channel_id to 'channels' list
-    user_info['channels'].append(channel_id)
+    user_info = get_userinfo(record['u_id'])
+    user_info['channels'].append(record['channel_id'])
 
 
+@writes
 def channel_leave(token, channel_id):
     '''
     Using a valid token, the user leaves a channel specified by 'channel_id'
@@ -59,21 +78,25 @@ def channel_leave(token, channel_id):
     if not channel_exists(channel_id):
         raise ValueError('Channel does not exist')
 
-  # Remove user from 'members' list in channel
-    # get members list (from channel_id)
-    members = members_list(channel_id)
-
-    # remove user from members list
     user_id = token_to_user(token)
-    for member in members:
-        if member['u_id'] == user_id:
-            members.remove(member)
+    if not check_channel_member(user_id, channel_id):
+        raise ValueError('User is not a member of the channel')
+
+    commit('channel_leave', channel_id=channel_id, u_id=user_id)
+
+@applies('channel_leave', 'member')
+def _apply_channel_leave(record):
+  # Remove user from 'members' list in channel
+    members = members_list(record['channel_id'])
+    members[:] = [member for member in members if member['u_id'] != record['u_id']]
+    unindex_member(record['channel_id'], record['u_id'])
 
   # Remove channel from users 'channels' list
-    user_info = get_userinfo(user_id)
-    user_info['channels'].remove(channel_id)
+    user_info = get_userinfo(record['u_id'])
+    user_info['channels'].remove(record['channel_id'])
 
 
+@writes
 def channel_addowner(token, channel_id, u_id):
     '''
     Using a valid token, add a user specified by 'u_id' as an owner of a specific channel
@@ -103,15 +126,15 @@ def channel_addowner(token, channel_id, u_id):
         raise ValueError('User is already an owner')
 
   # Change user permission to owner
-    # get members list (from channel_id)
-    members = members_list(channel_id)
+    commit('channel_addowner', channel_id=channel_id, u_id=u_id)
 
+@applies('channel_addowner', 'member')
+def _apply_channel_addowner(record):
     # change user permission to '1'
-    for member in members:
-        if member['u_id'] == u_id:
-            member['channel_permission'] = 1
+    set_channel_permission(record['channel_id'], record['u_id'], 1)
 
 
+@writes
 def channel_removeowner(token, channel_id, u_id):
     '''
     Using a valid token, remove a users permission as an owner in a specified channel
@@ -146,13 +169,12 @@ def channel_removeowner(token, channel_id, u_id):
         raise AccessError('Cannot change the permission of Slackr creator')
 
   # Remove user permission as owner
-    # get members list (from channel_id)
-    members = members_list(channel_id)
+    commit('channel_removeowner', channel_id=channel_id, u_id=u_id)
 
+@applies('channel_removeowner', 'member')
+def _apply_channel_removeowner(record):
     # change user permission to '0'
-    for member in members:
-        if member['u_id'] == u_id:
-            member['channel_permission'] = 0
+    set_channel_permission(record['channel_id'], record['u_id'], 0)
 
 # ============================ CHANNELS ====================================== #
 
@@ -168,6 +190,7 @@ def channel_removeowner(token, channel_id, u_id):
 
 # ----------------------------------------------------------------
 
+@writes
 def channel_invite(token, channel_id, u_id):
     '''
     The following function invites a given user into a given channel
@@ -191,19 +214,7 @@ def channel_invite(token, channel_id, u_id):
 
     # If it reaches here, all parameters are valid
     # target user becomes a member of the channel
-    for channel in server_data.data['channels']:
-        if channel['channel_id'] == channel_id:
-            channel['members'].append({
-                'u_id' : u_id,
-                'channel_permission' : 0
-            })
-            break
-
-    # channel is in the user's channel list
-    for user in server_data.data['users']:
-        if user['u_id'] == u_id:
-            user['channels'].append(channel_id)
-            break
+    commit('channel_invite', channel_id=channel_id, u_id=u_id)
     return {}
 
 # -------------------------CHANNEL MESSAGES-------------------------
@@ -213,9 +224,14 @@ def channel_invite(token, channel_id, u_id):
 # ----------------------------------------------------------------
 
 
-def channel_messages(token, channel_id, start):
+@reads_channel(channel_arg)
+def channel_messages(token, channel_id, start, cursor=None, limit=None):
     '''
-    The following function shows up to 50 messages in a given channel
+    The following function shows up to 50 messages in a given channel, newest
+    first, starting either 'start' messages back from the most recent one or
+    from a cursor returned by an earlier call. Cursors keep their place when
+    new messages are sent, 'older' pages further back and 'newer' pages
+    forward to messages sent since.
     '''
     # check token
     curr_user_id = token_to_user(token)
@@ -229,48 +245,85 @@ def channel_messages(token, channel_id, start):
     if not check_channel_member(curr_user_id, channel_id) and not cha_data['is_public']:
         raise AccessError('User is not in the target channel. Error code: 1')
 
-    #tests for validity of token, channel_id and start
-
-    # checks if start is valid else raise error
-    valid_start(start)
-    if start >= (server_data.data["channels"][channel_id]["channel_n_messages"]):
-        raise ValueError("Start is greater than total number of messages")
-
-    # checks if channel_id is valid else raise error
-    channel_id_exists(channel_id)
-
-    return_amount = 49
-    messages = []
-    actual_start = server_data.data["channels"][channel_id]["channel_n_messages"] - start - 1
-    counter = actual_start
-
-    if actual_start > return_amount:
-        last = actual_start - return_amount
-        for counter in range(actual_start, last, -1):
-            messages.append(server_data.data["channels"][channel_id]["messages"][counter])
-        end = start + return_amount
-
+    limit = page_limit(limit)
+
+    n_messages = cha_data['channel_n_messages']
+    store = message_store()
+
+    direction = None
+    if cursor is None:
+        # checks if start is valid else raise error
+        valid_start(start)
+        if start < 0:
+            raise ValueError("Start cannot be negative")
+        if start >= n_messages:
+            raise ValueError("Start is greater than total number of messages")
+        # index of the newest message on the page, and one past the oldest
+        newest = n_messages - start
+        oldest = max(newest - limit, 0)
+        if store is None:
+            messages = cha_data['messages'][oldest:newest]
+        else:
+            messages = store.latest(channel_id, start, newest - oldest)
     else:
-        end = -1
-        while counter > -1:
-            messages.append(server_data.data["channels"][channel_id]["messages"][counter])
-            counter = counter - 1
-
-    # return correct react types
-    for msg in messages:
-        for react in msg['reacts']:
-            if curr_user_id in react['u_ids']:
-                react['is_this_user_reacted'] = True
+        cursor_channel_id, message_id, direction = _read_cursor(cursor)
+        if store is None:
+            if cursor_channel_id != channel_id or message_id not in server_data.message_seq:
+                raise ValueError("Cursor is not valid for this channel")
+            seqs = server_data.channel_seqs.get(channel_id, [])
+            seq = server_data.message_seq[message_id]
+            if direction == 'older':
+                newest = bisect.bisect_left(seqs, seq)
+                oldest = max(newest - limit, 0)
+            else:
+                oldest = bisect.bisect_right(seqs, seq)
+                newest = min(oldest + limit, n_messages)
+            messages = cha_data['messages'][oldest:newest]
+        else:
+            # the storage engine pages from the cursor's message itself
+            found = store.position(message_id)
+            if cursor_channel_id != channel_id or found is None or found[0] != channel_id:
+                raise ValueError("Cursor is not valid for this channel")
+            position = found[1]
+            if direction == 'older':
+                newest = store.count_older(channel_id, position)
+                oldest = max(newest - limit, 0)
+                messages = store.older(channel_id, position, newest - oldest)
             else:
-                react['is_this_user_reacted'] = False
+                oldest = store.count_older(channel_id, position) + 1
+                messages = store.newer(channel_id, position, limit)
+                newest = oldest + len(messages)
+
+    # return correct react types for this user
+    page = [view_message(message, curr_user_id) for message in messages[::-1]]
+    start = n_messages - newest
+
+    # an empty page of newer messages is polled again from the same place
+    newer = None
+    if page:
+        newer = _cursor(channel_id, page[0], 'newer')
+    elif direction == 'newer':
+        newer = cursor
 
     return {
-        'messages' : messages,
+        'messages' : page,
         'start' : start,
-        'end' : end
+        'end' : start + len(page) if oldest > 0 else -1,
+        'older' : _cursor(channel_id, page[-1], 'older') if page and oldest > 0 else None,
+        'newer' : newer
     }
 
+def _cursor(channel_id, message, direction):
+    '''
+    Returns an opaque cursor to the messages sent before or after message
+    '''
+    return encode_cursor(channel_id, message['message_id'], direction)
 
+def _read_cursor(cursor):
+    channel_id, message_id, direction = decode_cursor(cursor, int, int, str)
+    if direction not in ('older', 'newer'):
+        raise ValueError("Cursor is not valid")
+    return channel_id, message_id, direction
 
 
 # -------------------------CHANNEL DETAILS-------------------------
@@ -279,9 +332,12 @@ def channel_messages(token, channel_id, start):
 
 # ----------------------------------------------------------------
 
-def channel_details(token, channel_id):
+@reads
+def channel_details(token, channel_id, start=None, limit=None):
     '''
     The following function gives details about a given channel
+    Given a start or limit, only that page of all_members is returned, along
+    with the start and the end of the page, which is -1 on the last page
     '''
     # check token
     curr_user_id = token_to_user(token)
@@ -298,31 +354,55 @@ def channel_details(token, channel_id):
     # Return channel details
 
     # format: { name, owner_members, all_members }
+    details = _member_details(channel_data)
+    if start is None and limit is None:
+        return ({
+            'name' : channel_data['name'],
+            'owner_members' : details['owner_members'],
+            'all_members' : details['all_members']
+            })
+
+    start = 0 if start is None else start
+    limit = page_limit(limit)
+    if start < 0:
+        raise ValueError("Start must not be negative")
+    end = start + limit
+    return ({
+        'name' : channel_data['name'],
+        'owner_members' : details['owner_members'],
+        'all_members' : details['all_members'][start:end],
+        'start' : start,
+        'end' : end if end < len(details['all_members']) else -1
+        })
+
+def _member_details(channel_data):
+    '''
+    Returns the members and owners of a channel as channel_details shows
+    them, building them only after they have changed. They are shared by
+    every call until then, so must not be modified.
+    '''
+    details = server_data.member_details.get(channel_data['channel_id'])
+    if details is not None:
+        return details
 
-    # add owner and all members
+    # add owner and all members, owners are the same dicts as in all_members
     owner_members = []
     all_members = []
     for member in channel_data['members']:
         user = server_data.data['users'][member['u_id']]
-        all_members.append({
+        entry = {
             'u_id' : user['u_id'],
             'name_first' : user['name_first'],
             'name_last' : user['name_last'],
-            'profile_img_url' : user['profile_img_url']
-        })
+            'profile_img_url' : thumbnail_url(user['profile_img_url'])
+        }
+        all_members.append(entry)
         if member['channel_permission'] == 1:
-            owner_members.append({
-                'u_id' : user['u_id'],
-                'name_first' : user['name_first'],
-                'name_last' : user['name_last'],
-                'profile_img_url' : user['profile_img_url']
-            })
+            owner_members.append(entry)
 
-    return ({
-        'name' : channel_data['name'],
-        'owner_members' : owner_members,
-        'all_members' : all_members
-        })
+    details = {'owner_members' : owner_members, 'all_members' : all_members}
+    server_data.member_details[channel_data['channel_id']] = details
+    return details
 
 
 # -------------------------CHANNEL LIST -------------------------
@@ -338,6 +418,7 @@ def channel_details(token, channel_id):
 
 # Provide a list of all channels (and their associated details) that the
 # authorised user is part of
+@reads
 @validate_token
 def channels_list(token):
     '''
@@ -357,6 +438,7 @@ def channels_list(token):
     return full_list
 
 # Provide a list of all channels (and their associated details)
+@reads
 @validate_token
 def channels_listall(token):
     '''
@@ -372,6 +454,25 @@ def channels_listall(token):
             })
     return full_list
 
+# Provide a page of the public channels with a name starting with a prefix
+@reads
+@validate_token
+def channels_listall_page(token, prefix='', cursor=None, limit=None):
+    '''
+    The following function lists a page of the public channels whose name
+    starts with prefix, sorted by name, with a cursor to the next page
+    '''
+    after = None if cursor is None else name_index.read_cursor(cursor)
+    entries, next_cursor = name_index.page(server_data.channel_names, prefix, after, limit)
+    full_list = []
+    for _, channel_id in entries:
+        channel = server_data.data['channels'][channel_id]
+        full_list.append({
+            'channel_id' : channel['channel_id'],
+            'name' : channel['name']
+        })
+    return {'channels' : full_list, 'next' : next_cursor}
+
 # ------------------------- CHANNEL CREATE -------------------------
 
 #                 Implementation for channel_create
@@ -382,6 +483,7 @@ def channels_listall(token):
 
 # Input: token, name, is_public
 # Output: Adds a channel to channels dictionary
+@writes
 @validate_token
 def channel_create(token, name, is_public):
 
@@ -407,27 +509,34 @@ def channel_create(token, name, is_public):
     # generates a channel_id and assigns it to a variable
     channel_id = server_data.data["n_channels"]
 
-    # appending a dictionary containing channel details into "channels"
-    server_data.data["channels"].append({"channel_id": channel_id, "name": name, "members":
-                                         [{"u_id" : curr_user_id, "channel_permission" : 1}],
-                                         "messages" : [], "is_public": public_bool,
-                                         "channel_n_messages": 0
-                                        })
+    members = [{"u_id" : curr_user_id, "channel_permission" : 1}]
 
     # add all slackr owner / admins into the channel
     for user in server_data.data['users']:
         if is_slackr_admin(user['u_id']) and (user['u_id'] != curr_user_id):
-            server_data.data['channels'][channel_id]['members'].append({"u_id" : user['u_id'],
-                                                                        "channel_permission" : 1
-                                                                        })
-            server_data.data['users'][user['u_id']]['channels'].append(channel_id)
-
-    # appending a dictionary containing channel details into 'channels' within "users"
-    server_data.data['users'][curr_user_id]['channels'].append(channel_id)
-
-    # increasing n_channels by one
-    server_data.data["n_channels"] = ((server_data.data["n_channels"]) + 1)
+            members.append({"u_id" : user['u_id'], "channel_permission" : 1})
 
+    commit('channel_create', channel={"channel_id": channel_id, "name": name,
+                                      "members": members, "messages" : [],
+                                      "is_public": public_bool, "channel_n_messages": 0
+                                     })
 
     # returning channel_id
     return channel_id
+
+@applies('channel_create', 'channel')
+def _apply_channel_create(record):
+    # appending a dictionary containing channel details into "channels"
+    channel = dict(record['channel'])
+    channel['members'] = [dict(member) for member in channel['members']]
+    channel['messages'] = list(channel['messages'])
+    server_data.data["channels"].append(channel)
+
+    # appending the channel into 'channels' within "users" for every member
+    for member in channel['members']:
+        server_data.data['users'][member['u_id']]['channels'].append(channel['channel_id'])
+        index_member(channel['channel_id'], member)
+    name_index.add_channel(channel)
+
+    # increasing n_channels by one
+    server_data.data["n_channels"] = ((server_data.data["n_channels"]) + 1)
@@ -6,8 +6,15 @@ import requests
 import sys
 import time as t
 sys.path.append('../')
+import bisect
+import heapq
+import itertools
+import threading
 import server_data
 import jwt
+from server.persistence import commit, applies, touch, on_load, message_store
+from server import search_index, name_index
+from server.locks import writes
 # ========================= HELPER FUNCTIONS =============================#
 
 # This is a helper function file which will be included in our test files
@@ -16,6 +23,7 @@ import jwt
 class AccessError(Exception):
     pass
 
+@writes
 def reset_data():
     server_data.data = {
         "n_users"       : 0,
@@ -26,6 +34,61 @@ def reset_data():
     }
     server_data.messages_later = []
     server_data.standups = []
+    server_data.search_index = None
+    store = message_store()
+    if store is not None:
+        store.clear_messages()
+    for store in server_data.generations:
+        touch(store)
+    rebuild_indexes()
+
+@on_load
+def rebuild_indexes():
+    '''
+    Rebuilds every index over server_data from the stores
+    '''
+    global _appended, _next_message_id
+    server_data.users_version += 1
+    server_data.sessions = {}
+    server_data.user_emails = {}
+    server_data.user_handles = {}
+    server_data.handle_counts = {}
+    for user in server_data.data['users']:
+        if user['token'] is not None:
+            server_data.sessions[user['token']] = user['u_id']
+        index_user(user)
+    name_index.build()
+
+    server_data.channel_members = {}
+    server_data.channel_owners = {}
+    server_data.user_channels = {}
+    server_data.member_details = {}
+    for channel in server_data.data['channels']:
+        for member in channel['members']:
+            index_member(channel['channel_id'], member)
+
+    _appended = itertools.count()
+    _next_message_id = 0
+    server_data.message_index = {}
+    server_data.message_seq = {}
+    server_data.channel_seqs = {}
+    server_data.react_index = {}
+    for channel in server_data.data['channels']:
+        for message in channel['messages']:
+            index_message(channel, message)
+            for react in message['reacts']:
+                # flags older versions stored for whoever viewed last
+                react.pop('is_this_user_reacted', None)
+
+    server_data.standup_index = {}
+    server_data.standup_queue = []
+    for standup in server_data.standups:
+        index_standup(standup)
+
+    # the json storage reads the search index back if its checkpoint is current,
+    # an engine serving messages searches them itself
+    if server_data.search_index is None and message_store() is None:
+        search_index.build()
 
 # this prints out the data for debugging purposes
 def show():
@@ -73,33 +136,46 @@ def decode_token(token):
     info = jwt.decode(token, SECRET, algorithms=['HS256'])
     return info
 
+# Changes the secret tokens are signed with and logs every user out, tokens
+# signed with the old one no longer decode
+@writes
+def rotate_secret(secret):
+    global SECRET
+    SECRET = secret
+    for u_id in set(server_data.sessions.values()):
+        commit('auth_logout', u_id=u_id)
+
 # Function for obtaining user_id from token
+# Only tokens in the session registry belong to a logged in user, a token
+# that still decodes after its user logged out is rejected
 
 def token_to_user(token):
-    global SECRET
-    u_id = decode_token(token)['u_id']
-    return int(u_id)
+    u_id = server_data.sessions.get(token)
+    if u_id is None:
+        raise AccessError("Invalid token")
+    return u_id
 
 # Function for obtaining first_name from token
 
 def token_to_firstname(token):
-    global SECRET
-    u_id = decode_token(token)['u_id']
-    data = server_data.data
-    for x in data['users']:
-        if x['u_id'] is u_id:
-            return str(x['name_first'])
+    u_id = token_to_user(token)
+    return str(server_data.data['users'][u_id]['name_first'])
 
 
 # Function for checking whether token is valid
 
 def is_valid_token(token):
-    for user in server_data.data['users']:
-        if token == user['token']:
-            if token != None:
-                return
-    # Raise access error
-    raise AccessError("Invalid token")
+    if token not in server_data.sessions:
+        # Raise access error
+        raise AccessError("Invalid token")
+
+# Functions keeping the session registry up to date
+
+def start_session(token, u_id):
+    server_data.sessions[token] = u_id
+
+def end_session(token):
+    server_data.sessions.pop(token, None)
 
 # following is a decorator for validating a token
 def validate_token(function):
@@ -108,6 +184,15 @@ def validate_token(function):
         return function(*args, **kwargs)
     return wrapper
 
+# The following return the channel_id a function works on from its arguments,
+# for locking just that channel
+
+def channel_arg(token, channel_id, *args, **kwargs):
+    return channel_id
+
+def message_channel(token, message_id, *args, **kwargs):
+    return msg_to_channel(message_id)['channel_id']
+
 '''
                         * * * AUTHORISATION * * *
 '''
@@ -180,13 +265,179 @@ def get_message_id(dic, msg_str):
 # Search for a message ID and return its string
 # @@@ Changing this function to match changed utility
 # returns the message dictionary given a message ID
+# When the storage engine serves messages they are looked up in it instead
 def get_msg_dict(message_id):
-    # loop through the channels
-    for channel in server_data.data["channels"]:
-        for message in channel["messages"]:
-            if int(message['message_id']) == int(message_id):
-                return message
-    return None
+    store = message_store()
+    entry = (server_data.message_index.get(int(message_id)) if store is None
+             else store.message(int(message_id)))
+    if entry is None:
+        return None
+    return entry[1]
+
+# Reserves the next message_id. Messages in different channels can be sent
+# at the same time when channels are locked separately, so ids are handed
+# out under their own lock rather than read from n_messages
+_message_ids_lock = threading.Lock()
+_next_message_id = 0
+
+def new_message_id():
+    global _next_message_id
+    with _message_ids_lock:
+        message_id = max(server_data.data['n_messages'], _next_message_id)
+        _next_message_id = message_id + 1
+    return message_id
+
+# Functions keeping the message index up to date, called whenever a message
+# is added to or deleted from a channel
+
+_appended = itertools.count()
+
+def index_message(channel, message):
+    seq = next(_appended)
+    server_data.message_index[int(message['message_id'])] = (channel, message)
+    server_data.message_seq[int(message['message_id'])] = seq
+    server_data.channel_seqs.setdefault(channel['channel_id'], []).append(seq)
+    for react in message['reacts']:
+        server_data.react_index[(int(message['message_id']), react['react_id'])] = \
+            set(react['u_ids'])
+
+def unindex_message(message_id):
+    channel, message = server_data.message_index.pop(int(message_id))
+    seqs = server_data.channel_seqs[channel['channel_id']]
+    del seqs[bisect.bisect_left(seqs, server_data.message_seq[int(message_id)])]
+    for react in message['reacts']:
+        server_data.react_index.pop((int(message_id), react['react_id']), None)
+
+# returns the set of u_ids who reacted to a message with react_id
+def react_users(message_id, react_id):
+    if message_store() is None:
+        return server_data.react_index.get((int(message_id), react_id), set())
+    for react in get_msg_dict(message_id)['reacts']:
+        if react['react_id'] == react_id:
+            return set(react['u_ids'])
+    return set()
+
+# returns what the user u_id sees of a message, built without changing the
+# stored message as it is shared by everyone viewing it
+def view_message(message, u_id):
+    indexed = message_store() is None
+    view = dict(message)
+    view['reacts'] = [{
+        'react_id' : react['react_id'],
+        'u_ids' : list(react['u_ids']),
+        'is_this_user_reacted' : (u_id in react_users(message['message_id'], react['react_id'])
+                                  if indexed else u_id in react['u_ids'])
+    } for react in message['reacts']]
+    return view
+
+# returns where a message is in its channel's messages list
+def message_position(message_id):
+    channel, _ = server_data.message_index[int(message_id)]
+    seqs = server_data.channel_seqs[channel['channel_id']]
+    return bisect.bisect_left(seqs, server_data.message_seq[int(message_id)])
+
+# The following change messages for the appliers. When the storage engine
+# serves messages the change is made to its copy, which it then writes,
+# otherwise to the channels' lists and the indexes over them. Records other
+# processes journalled are already in the engine's tables, so replaying one
+# only drops the engine's copy of the message.
+
+def _store_changing(store, message_id):
+    if store.replaying:
+        store.forget(message_id)
+        return None
+    return store.message(message_id)
+
+def add_message(channel, message):
+    store = message_store()
+    server_data.data['n_messages'] = max(server_data.data['n_messages'],
+                                         message['message_id'] + 1)
+    if store is None:
+        channel['messages'].append(message)
+        channel['channel_n_messages'] += 1
+        index_message(channel, message)
+        search_index.add(message)
+    elif store.replaying:
+        store.forget(message['message_id'])
+    else:
+        channel['channel_n_messages'] += 1
+        store.changed(message['message_id'], (channel['channel_id'], message))
+
+def remove_message(message_id):
+    store = message_store()
+    if store is None:
+        channel, message = server_data.message_index[int(message_id)]
+        channel['channel_n_messages'] -= 1
+        del channel['messages'][message_position(message_id)]
+        unindex_message(message_id)
+        search_index.remove(message)
+        return
+    entry = _store_changing(store, message_id)
+    if entry is not None:
+        server_data.data['channels'][entry[0]]['channel_n_messages'] -= 1
+        store.changed(message_id, None)
+
+def edit_message(message_id, text):
+    store = message_store()
+    if store is None:
+        message = get_msg_dict(message_id)
+        search_index.remove(message)
+        message['message'] = text
+        search_index.add(message)
+        return
+    entry = _store_changing(store, message_id)
+    if entry is not None:
+        entry[1]['message'] = text
+        store.changed(message_id, entry)
+
+def pin_message(message_id, is_pinned):
+    store = message_store()
+    entry = (server_data.message_index[int(message_id)] if store is None
+             else _store_changing(store, message_id))
+    if entry is not None:
+        entry[1]['is_pinned'] = is_pinned
+        if store is not None:
+            store.changed(message_id, entry)
+
+def add_react(message_id, react_id, u_id):
+    store = message_store()
+    entry = (server_data.message_index[int(message_id)] if store is None
+             else _store_changing(store, message_id))
+    if entry is None:
+        return
+    if store is None:
+        server_data.react_index.setdefault((int(message_id), react_id), set()).add(u_id)
+    else:
+        store.changed(message_id, entry)
+
+    # if the message already has the react id
+    for react in entry[1]['reacts']:
+        if react['react_id'] == react_id:
+            # react to the message!
+            react['u_ids'].append(u_id)
+            return
+
+    # otherwise, the message has not been reacted too
+    entry[1]['reacts'].append({
+        'react_id' : react_id,
+        'u_ids' : [u_id]
+    })
+
+def remove_react(message_id, react_id, u_id):
+    store = message_store()
+    entry = (server_data.message_index[int(message_id)] if store is None
+             else _store_changing(store, message_id))
+    if entry is None:
+        return
+    reacted = react_users(message_id, react_id)
+    for react_dict in entry[1]['reacts']:
+        if react_dict['react_id'] == react_id:
+            if u_id in reacted:
+                # the current user has reacted
+                reacted.discard(u_id)
+                react_dict['u_ids'].remove(u_id)
+    if store is not None:
+        store.changed(message_id, entry)
 
 # Return the react id of a specific message
 def get_react_id(dic, message_id):
@@ -211,11 +462,12 @@ def valid_start(start):
 
 # given the message_id, return what channel it is in
 def msg_to_channel(message_id):
-    for channel in server_data.data["channels"]:
-        for message in channel["messages"]:
-            if message["message_id"] == message_id:
-                return channel
-    return None
+    store = message_store()
+    if store is None:
+        entry = server_data.message_index.get(int(message_id))
+        return None if entry is None else entry[0]
+    entry = store.message(int(message_id))
+    return None if entry is None else server_data.data['channels'][entry[0]]
 
 def is_msg_removed(message_id):
     message_dict = get_msg_dict(message_id)
@@ -274,10 +526,83 @@ def is_valid_name(name):
 '''
 def check_channel_member(curr_user_id, channel_id):
     # Check if the user is part of the channel
-    for channels in server_data.data['users'][curr_user_id]['channels']:
-        if int(channels) == int(channel_id):
-            return True
-    return False
+    return int(channel_id) in server_data.user_channels.get(int(curr_user_id), ())
+
+'''
+    The following functions keep the membership indexes up to date
+'''
+def index_member(channel_id, member):
+    channel_id = int(channel_id)
+    u_id = int(member['u_id'])
+    server_data.member_details.pop(channel_id, None)
+    server_data.channel_members.setdefault(channel_id, set()).add(u_id)
+    server_data.user_channels.setdefault(u_id, set()).add(channel_id)
+    if member['channel_permission'] == 1:
+        server_data.channel_owners.setdefault(channel_id, set()).add(u_id)
+
+def unindex_member(channel_id, u_id):
+    channel_id = int(channel_id)
+    u_id = int(u_id)
+    server_data.member_details.pop(channel_id, None)
+    for index, key, value in ((server_data.channel_members, channel_id, u_id),
+                              (server_data.channel_owners, channel_id, u_id),
+                              (server_data.user_channels, u_id, channel_id)):
+        values = index.get(key)
+        if values is None:
+            continue
+        values.discard(value)
+        if not values:
+            del index[key]
+
+def set_channel_permission(channel_id, u_id, permission):
+    channel_id = int(channel_id)
+    u_id = int(u_id)
+    server_data.member_details.pop(channel_id, None)
+    # a user who joined twice has two entries, both change
+    for member in members_list(channel_id):
+        if member['u_id'] == u_id:
+            member['channel_permission'] = permission
+    owners = server_data.channel_owners
+    if permission == 1:
+        owners.setdefault(channel_id, set()).add(u_id)
+    elif u_id in owners.get(channel_id, ()):
+        owners[channel_id].discard(u_id)
+        if not owners[channel_id]:
+            del owners[channel_id]
+
+'''
+    The following function drops the cached members of every channel a user
+    is in, after details channel_details shows have changed
+'''
+def user_details_changed(u_id):
+    for channel_id in server_data.user_channels.get(int(u_id), ()):
+        server_data.member_details.pop(channel_id, None)
+
+'''
+    The following functions keep the email and handle indexes up to date
+'''
+def index_user(user):
+    server_data.user_emails[user['email']] = user['u_id']
+    server_data.user_handles.setdefault(user['handle_str'], set()).add(user['u_id'])
+
+def set_email(u_id, email):
+    user = server_data.data['users'][u_id]
+    if server_data.user_emails.get(user['email']) == u_id:
+        del server_data.user_emails[user['email']]
+    user['email'] = email
+    server_data.user_emails[email] = u_id
+
+def set_handle(u_id, handle_str):
+    user = server_data.data['users'][u_id]
+    name_index.remove_user(user)
+    users = server_data.user_handles.get(user['handle_str'])
+    if users is not None:
+        users.discard(u_id)
+        if not users:
+            del server_data.user_handles[user['handle_str']]
+    user['handle_str'] = handle_str
+    server_data.user_handles.setdefault(handle_str, set()).add(u_id)
+    name_index.add_user(user)
 
 '''
     The following function checks if a user valid
@@ -315,52 +640,42 @@ Checks if a specific channel exists using a channel_id
 Returns 'True' if it exists, 'False' if it doesn't
 '''
 def channel_exists(channel_id):
-    for x in server_data.data["channels"]:
-        if int(x["channel_id"]) is int(channel_id):
-            return True
-    return False
+    return channel_info(channel_id) is not None
 
 '''
 Return a list of members in a specified channel
 '''
 def members_list(channel_id):
-    for x in server_data.data["channels"]:
-        if int(x["channel_id"]) is int(channel_id):
-            index = server_data.data["channels"].index(x)
-            members = (server_data.data["channels"][index]['members'])
-            return members
+    info = channel_info(channel_id)
+    if info is not None:
+        return info['members']
 
 '''
 Using a given channel_id
 Returns the dictionary with all the channel info
 '''
 def channel_info(channel_id):
-    for x in server_data.data["channels"]:
-        if int(x["channel_id"]) is int(channel_id):
-            index = server_data.data["channels"].index(x)
-            info = (server_data.data["channels"][index])
-            return info
+    # channel_ids are handed out in order, so each is its channel's position
+    channel_id = int(channel_id)
+    if 0 <= channel_id < len(server_data.data["channels"]):
+        return server_data.data["channels"][channel_id]
 
 '''
 Check if a user is an owner of a specified channel
 Returns 'True' if they are, 'False' if they aren't
 '''
 def is_owner(u_id, channel_id):
-    members = members_list(channel_id)
-    for y in members:
-        if y['u_id'] == u_id and y['channel_permission'] == 1:
-            return True
-    return False
+    return int(u_id) in server_data.channel_owners.get(int(channel_id), ())
 
 '''
 Get user information using a u_id
 Returns their dictionary in data['users']
 '''
 def get_userinfo(u_id):
-    for x in server_data.data["users"]:
-        if x['u_id'] == u_id:
-            index = server_data.data["users"].index(x)
-            return server_data.data["users"][index]
+    # u_ids are handed out in order, so each is its user's position
+    u_id = int(u_id)
+    if 0 <= u_id < len(server_data.data["users"]):
+        return server_data.data["users"][u_id]
 
 '''
 Check if a user has admin privileges 
@@ -379,72 +694,121 @@ def is_slackr_admin(u_id):
 Check if a standup is running in a specified channel
 '''
 def standup_exists(channel_id):
-    standups = server_data.standups
-    for x in standups:
-        if int(x["channel_id"]) is int(channel_id):
-            return True
-    return False
+    return int(channel_id) in server_data.standup_index
 
 
 '''
 Return an active standup of a specified channel
 '''
-def get_standup(standups, channel_id):
-    for x in standups:
-        if int(x["channel_id"]) is int(channel_id):
-            index = standups.index(x)
-            return standups[index]
-    return None
+def get_standup(channel_id):
+    return server_data.standup_index.get(int(channel_id))
+
+'''
+Add a standup that has started to the index and the queue of standups to finish
+'''
+def index_standup(standup):
+    server_data.standup_index[int(standup['channel_id'])] = standup
+    heapq.heappush(server_data.standup_queue, (standup['time_end'], int(standup['channel_id'])))
+
+'''
+A message waiting to be sent later. messages_later is kept as a heap of these
+so the next one due is always first
+'''
+class LaterMessage(dict):
+    def __lt__(self, other):
+        return ((self['time_created'], self['message_id']) <
+                (other['time_created'], other['message_id']))
+
+@on_load
+def load_later_queue():
+    server_data.messages_later = [LaterMessage(x) for x in server_data.messages_later]
+    heapq.heapify(server_data.messages_later)
 
 '''
-Check if there are any messages to be sent which have been stored for later
+Returns True if the head of a heap is due, read without taking any lock so
+the scheduler only takes the write lock when there is something to do
+'''
+def is_due(queue, due_time):
+    try:
+        return due_time(queue[0]) <= int(t.time())
+    except IndexError:
+        # emptied by a writer since it was looked at
+        return False
+
+'''
+Send every message stored for later that is due, oldest first
 '''
 def check_latermessages():
+    if is_due(server_data.messages_later, lambda x: x['time_created']):
+        send_latermessages()
+
+@writes
+def send_latermessages():
     messages_later = server_data.messages_later
     time = int(t.time())
-    for x in messages_later:
-        if x['time_created'] == time:
-            channel_id = x['channel_id']
-            index = messages_later.index(x)
-            info = channel_info(channel_id)
-            messages = info['messages']
-            info['channel_n_messages'] += 1
-            messages.append(dict(messages_later[index]))
+    while messages_later and messages_later[0]['time_created'] <= time:
+        x = messages_later[0]
+        # a crash between the two records leaves a sent message still queued
+        if get_msg_dict(x['message_id']) is None:
+            commit('message_send', channel_id=x['channel_id'], message=x)
+        commit('later_remove', message_id=x['message_id'])
+
+@applies('later_remove', 'later', 'messages_later')
+def _apply_later_remove(record):
+    messages_later = server_data.messages_later
+    if messages_later and messages_later[0]['message_id'] == record['message_id']:
+        heapq.heappop(messages_later)
+        return
+    for i, x in enumerate(messages_later):
+        if x['message_id'] == record['message_id']:
+            messages_later[i] = messages_later[-1]
+            messages_later.pop()
+            heapq.heapify(messages_later)
+            return
 
 
 '''
-Check if any standups are finished
+Finish every standup whose time is up, each exactly once
 '''
 def check_standups():
-    standups = server_data.standups
-    if len(standups) == 0:
-        return
+    if is_due(server_data.standup_queue, lambda x: x[0]):
+        finish_standups()
+
+@writes
+def finish_standups():
+    queue = server_data.standup_queue
     time = int(t.time())
-    for x in standups:
-        if x['time_end'] == time:
-            print('finished standup for channel_id', x['channel_id'])
-            standup_messages = x['messages']
-            channel_id = x['channel_id']
-            creator_id = x['u_id']
-            info = channel_info(channel_id)
-            messages = info['messages']
-            info['channel_n_messages'] += 1
-            all_messages = ''
-            for y in standup_messages:
-                all_messages += y['first_name'] + ': ' + y['message'] + '\n'
-
-            message_id = server_data.data['n_messages']
-            server_data.data['n_messages'] += 1
-
-            newMessage = dict()
-            newMessage['message_id'] = message_id
-            newMessage['u_id'] = creator_id
-            newMessage['message'] = all_messages
-            newMessage['time_created'] = time
-            newMessage['reacts'] = []
-            newMessage['is_pinned'] = False
-            messages.append(dict(newMessage))
-            standups.remove(x)
+    while queue and queue[0][0] <= time:
+        time_end, channel_id = heapq.heappop(queue)
+        x = get_standup(channel_id)
+        # the standup has already finished
+        if x is None or x['time_end'] != time_end:
+            continue
+        print('finished standup for channel_id', x['channel_id'])
+        creator_id = x['u_id']
+        all_messages = ''.join(y['first_name'] + ': ' + y['message'] + '\n'
+                               for y in x['messages'])
+
+        message_id = new_message_id()
+
+        newMessage = dict()
+        newMessage['message_id'] = message_id
+        newMessage['u_id'] = creator_id
+        newMessage['message'] = all_messages
+        newMessage['time_created'] = time_end
+        newMessage['reacts'] = []
+        newMessage['is_pinned'] = False
+        commit('message_send', channel_id=x['channel_id'], message=newMessage)
+        commit('standup_end', channel_id=x['channel_id'])
+
+@applies('standup_end', 'standup', 'standups')
+def _apply_standup_end(record):
+    standup = server_data.standup_index.pop(int(record['channel_id']))
+    standups = server_data.standups
+    for i, x in enumerate(standups):
+        if x is standup:
+            del standups[i]
+            break
 
 
 
@@ -475,11 +839,9 @@ def check_later(message_id):
 Get the messages from an active standup
 '''
 def standup_messages(channel_id):
-    standups = server_data.standups
-    for x in standups:
-        if x['channel_id'] is channel_id:
-            index = standups.index(x)
-            return standups[index]['messages']
+    standup = get_standup(channel_id)
+    if standup is not None:
+        return standup['messages']
 
 '''
 Search for a specific message in an active standup
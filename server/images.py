@@ -0,0 +1,358 @@
+'''
+Images
+
+Profile photos are downloaded once, streamed into memory up to a size limit,
+decoded once, cropped, encoded once and written to disk atomically. The
+image's dimensions are read from its header and checked before it is
+decoded, so a small file that decodes to a huge image is refused as well.
+Stored photos are named by their hash and come with thumbnails.
+
+Uploads run in the background as jobs that clients poll, with the decoding
+and encoding done in worker processes so it does not hold the GIL. When
+several server processes share a database, each job's status is also kept
+in it so a poll can reach any process.
+'''
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time as t
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import requests
+from PIL import Image
+
+# ============================ IMAGES ======================================= #
+
+#       This file contains the functions fetching and cropping images
+
+# =========================================================================== #
+
+# Largest download and largest image, in pixels, that are accepted
+MAX_BYTES = int(os.environ.get('SLACKR_IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+MAX_PIXELS = int(os.environ.get('SLACKR_IMAGE_MAX_PIXELS', 40 * 1000 * 1000))
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 10
+
+# Photos are stored under the sha256 of their jpeg, so a file never changes
+# once written and uploads of the same photo share it. Each also has
+# thumbnails no larger than these sizes, named <hash>_<size>.jpg
+IMAGE_DIR = os.environ.get('SLACKR_IMAGE_DIR', 'images')
+IMAGE_ROUTE = 'images/'
+THUMBNAIL_SIZES = (32, 64, 128)
+
+# Thumbnail size used wherever users are listed
+AVATAR_SIZE = 64
+
+
+def fetch(url):
+    '''
+    Downloads url, raising ValueError if it cannot be fetched or is too large
+    '''
+    try:
+        with requests.get(url, stream=True, timeout=TIMEOUT) as response:
+            if response.status_code != 200:
+                raise ValueError("Invalid Url")
+            length = response.headers.get('Content-Length')
+            if length is not None and length.isdigit() and int(length) > MAX_BYTES:
+                raise ValueError("Image is too large")
+
+            data = io.BytesIO()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                data.write(chunk)
+                if data.tell() > MAX_BYTES:
+                    raise ValueError("Image is too large")
+            return data.getvalue()
+    except requests.RequestException:
+        raise ValueError("Invalid Url")
+
+
+def crop(data, x_start, y_start, x_end, y_end):
+    '''
+    Decodes an image and returns the part of it within the given bounds
+    '''
+    try:
+        img = Image.open(io.BytesIO(data))
+    except (OSError, Image.DecompressionBombError):
+        raise ValueError("Url is not an image")
+
+    # crop length must be withing dimensions of the image
+    width, height = img.size
+    if width * height > MAX_PIXELS:
+        raise ValueError("Image is too large")
+
+    if (x_start < 0 or y_start < 0 or x_end > width or y_end > height):
+        raise ValueError(
+            "x_start, y_start, x_end and y_end must be within the dimensions of the image"
+        )
+
+    if (x_start > x_end or y_start > y_end):
+        raise ValueError("x_start and y_start must be smaller than x_end and y_end respectively")
+
+    try:
+        return img.crop((x_start, y_start, x_end, y_end)).convert('RGB')
+    except OSError:
+        raise ValueError("Url is not an image")
+
+
+def _encode(img):
+    output = io.BytesIO()
+    img.save(output, 'JPEG')
+    return output.getvalue()
+
+
+def process(data, x_start, y_start, x_end, y_end):
+    '''
+    Returns the given part of an image and its thumbnails encoded as jpegs,
+    keyed by size with the full image under None. This is the part of a job
+    run in the worker processes
+    '''
+    img = crop(data, x_start, y_start, x_end, y_end)
+    renditions = {None : _encode(img)}
+    for size in THUMBNAIL_SIZES:
+        thumbnail = img.copy()
+        thumbnail.thumbnail((size, size))
+        renditions[size] = _encode(thumbnail)
+    return renditions
+
+
+def image_name(key, size=None):
+    '''
+    Returns the file name of a stored image or one of its thumbnails
+    '''
+    if size is None:
+        return key + '.jpg'
+    return key + '_' + str(size) + '.jpg'
+
+
+def thumbnail_url(profile_img_url, size=AVATAR_SIZE):
+    '''
+    Returns the url of a thumbnail of a stored photo, other urls are
+    returned as they are
+    '''
+    head, _, name = profile_img_url.rpartition('/')
+    key = name[:-len('.jpg')]
+    if not head.endswith(IMAGE_ROUTE.rstrip('/')) or not is_key(key):
+        return profile_img_url
+    return head + '/' + image_name(key, size)
+
+
+def is_key(key):
+    '''
+    Returns True if key could be the hash of a stored image
+    '''
+    return len(key) == 64 and all(char in '0123456789abcdef' for char in key)
+
+
+def save(data, filepath):
+    '''
+    Writes data to filepath, replacing the file only once it is complete
+    '''
+    directory = os.path.dirname(filepath) or '.'
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.jpg', delete=False) as FILE:
+        try:
+            FILE.write(data)
+        except BaseException:
+            FILE.close()
+            os.unlink(FILE.name)
+            raise
+    os.replace(FILE.name, filepath)
+
+
+def store(renditions):
+    '''
+    Saves an image and its thumbnails unless they are already stored,
+    returning the image's key
+    '''
+    key = hashlib.sha256(renditions[None]).hexdigest()
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    for size, data in renditions.items():
+        filepath = os.path.join(IMAGE_DIR, image_name(key, size))
+        if not os.path.exists(filepath):
+            save(data, filepath)
+    return key
+
+
+def ingest(url, x_start, y_start, x_end, y_end):
+    '''
+    Downloads the image at url and stores the given part of it, returning
+    its key
+    '''
+    data = fetch(url)
+    pool = _processes
+    if pool is None:
+        renditions = process(data, x_start, y_start, x_end, y_end)
+    else:
+        renditions = pool.submit(process, data, x_start, y_start, x_end, y_end).result()
+    return store(renditions)
+
+# ============================ JOBS ========================================= #
+
+#       Uploads run as jobs on a pool of threads, each fetching its image and
+#       handing the decoding, cropping and encoding to a worker process
+
+# =========================================================================== #
+
+# Number of worker processes, and of threads running jobs
+WORKERS = int(os.environ.get('SLACKR_IMAGE_WORKERS', 2))
+JOB_THREADS = int(os.environ.get('SLACKR_IMAGE_JOB_THREADS', 4))
+
+# Jobs a user may have queued or running at once, and all users together
+MAX_QUEUED_PER_USER = int(os.environ.get('SLACKR_IMAGE_MAX_QUEUED_PER_USER', 3))
+MAX_QUEUED = int(os.environ.get('SLACKR_IMAGE_MAX_QUEUED', 100))
+
+# Seconds finished jobs are kept for clients to poll, and the most kept
+JOB_TTL = 600
+JOBS_KEPT = 1000
+
+_processes = None
+_threads = ThreadPoolExecutor(max_workers=JOB_THREADS, thread_name_prefix='images')
+
+# job_id -> job, queued and running jobs of each user, and the ids of
+# finished jobs in the order they finished, all guarded by _jobs_cond
+_jobs = {}
+_queued = {}
+_finished = deque()
+_jobs_cond = threading.Condition()
+
+# Storage shared with other processes that job statuses are copied to
+_shared = None
+
+
+def use_shared(storage):
+    '''
+    Copies every job's status to storage shared with other server processes,
+    which answers polls for jobs this process does not have
+    '''
+    global _shared
+    _shared = storage
+
+
+def _publish(job):
+    shared = _shared
+    if shared is None:
+        return
+    try:
+        shared.save_job(job, t.time() - JOB_TTL)
+    except Exception:
+        # the job still runs, only other processes cannot report it
+        print('Image job', job['job_id'], 'could not be shared')
+        traceback.print_exc()
+
+
+def start():
+    '''
+    Starts the worker processes. They are forked from the server, so this
+    should be called before it starts any other threads. Until it is called
+    images are processed on the job threads.
+    '''
+    global _processes
+    if _processes is not None or WORKERS <= 0:
+        return
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    _processes = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context(method))
+    # the workers are all started by the first job
+    _processes.submit(int).result()
+
+
+def stop():
+    '''
+    Waits for running jobs to finish and stops the worker processes
+    '''
+    global _processes
+    _threads.shutdown(wait=True)
+    if _processes is not None:
+        _processes.shutdown()
+        _processes = None
+
+
+def _finish(job, status, error=None):
+    # stored first, so the job is never finished here but not in the database
+    finished = dict(job)
+    finished['status'] = status
+    finished['error'] = error
+    _publish(finished)
+    with _jobs_cond:
+        job['status'] = status
+        job['error'] = error
+        _queued[job['u_id']] -= 1
+        if not _queued[job['u_id']]:
+            del _queued[job['u_id']]
+        _finished.append((t.monotonic(), job['job_id']))
+        _jobs_cond.notify_all()
+
+
+def _expire():
+    # finished jobs expire in the order they finished, so only the oldest
+    # are ever looked at
+    expired = t.monotonic() - JOB_TTL
+    while _finished and (_finished[0][0] <= expired or len(_finished) > JOBS_KEPT):
+        del _jobs[_finished.popleft()[1]]
+
+
+def _run(job, url, box, on_done):
+    with _jobs_cond:
+        job['status'] = 'running'
+        running = dict(job)
+    _publish(running)
+    try:
+        key = ingest(url, *box)
+        if on_done is not None:
+            on_done(key)
+    except ValueError as error:
+        _finish(job, 'failed', str(error))
+    except Exception:
+        print('Image job', job['job_id'], 'failed')
+        traceback.print_exc()
+        _finish(job, 'failed', 'Image could not be processed')
+    else:
+        _finish(job, 'done')
+
+
+def submit(u_id, url, box, on_done=None):
+    '''
+    Queues a job storing the part of the image at url within box, calling
+    on_done with its key once it has been stored. Returns the job's id.
+    Raises ValueError if the user or the server already has too many jobs.
+    '''
+    job = {'job_id' : uuid.uuid4().hex, 'u_id' : u_id, 'status' : 'queued', 'error' : None}
+    with _jobs_cond:
+        _expire()
+        if _queued.get(u_id, 0) >= MAX_QUEUED_PER_USER:
+            raise ValueError("Too many photos are already being uploaded")
+        if len(_jobs) - len(_finished) >= MAX_QUEUED:
+            raise ValueError("Too many photos are being uploaded, try again later")
+        _jobs[job['job_id']] = job
+        _queued[u_id] = _queued.get(u_id, 0) + 1
+    _publish(dict(job))
+    _threads.submit(_run, job, url, box, on_done)
+    return job['job_id']
+
+
+def job_status(job_id):
+    '''
+    Returns a copy of a job, or None if there is no such job
+    '''
+    with _jobs_cond:
+        _expire()
+        job = _jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+    # submitted to another process
+    shared = _shared
+    return shared.load_job(job_id) if shared is not None else None
+
+
+def wait(job_id, timeout=None):
+    '''
+    Waits for a job to finish and returns a copy of it
+    '''
+    with _jobs_cond:
+        job = _jobs[job_id]
+        _jobs_cond.wait_for(lambda: job['status'] in ('done', 'failed'), timeout)
+        return dict(job)
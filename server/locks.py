@@ -0,0 +1,233 @@
+'''
+Locks
+
+Every function reading or changing server_data takes STATE, a readers-writer
+lock, so requests served on several threads and the scheduler never see a
+half applied change. Any number of readers run at once, writers run alone.
+
+Setting SLACKR_LOCKS=channel also gives each channel its own lock. Changes
+to a single channel's messages and standups then only hold STATE as a
+reader, so writers in different channels run at the same time. Anything
+reading every channel takes STATE as a writer instead.
+
+When several processes share one database, 'shared' is set to its storage.
+Writers then also hold the database's write lock and readers catch up with
+the other processes first. Channels are not locked separately in that mode.
+'''
+import functools
+import os
+import threading
+from contextlib import contextmanager
+
+# ============================ LOCKS ======================================== #
+
+#       This file contains the locks guarding server_data
+
+# =========================================================================== #
+
+
+class RWLock:
+    '''
+    A readers-writer lock that waiting writers take ahead of new readers.
+    Both sides are reentrant and a thread holding the write lock may also
+    read, but a reader cannot upgrade to a writer.
+    '''
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = {}
+        self.writer = None
+        self.write_depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer != me and me not in self.readers:
+                while self.writer is not None or self.waiting_writers:
+                    self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+
+    def held(self):
+        '''
+        Returns True if the current thread holds the lock either way
+        '''
+        me = threading.get_ident()
+        with self.cond:
+            return self.writer == me or me in self.readers
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self.cond:
+            self.readers[me] -= 1
+            if not self.readers[me]:
+                del self.readers[me]
+                if not self.readers:
+                    self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.write_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError('A read lock cannot be upgraded to a write lock')
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.write_depth = 1
+
+    def release_write(self):
+        with self.cond:
+            self.write_depth -= 1
+            if not self.write_depth:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+STATE = RWLock()
+
+PER_CHANNEL = os.environ.get('SLACKR_LOCKS') == 'channel'
+
+# Storage shared with other processes, set by persistence.use_storage
+shared = None
+
+_channel_locks = {}
+_channel_locks_lock = threading.Lock()
+
+
+def channel_lock(channel_id):
+    '''
+    Returns the lock of a channel, creating it the first time
+    '''
+    with _channel_locks_lock:
+        return _channel_locks.setdefault(int(channel_id), RWLock())
+
+
+def _per_channel():
+    return PER_CHANNEL and shared is None
+
+
+@contextmanager
+def _read():
+    if shared is not None and not STATE.held():
+        with STATE.write():
+            shared.refresh()
+    with STATE.read():
+        yield
+
+
+@contextmanager
+def _write():
+    outermost = not STATE.held()
+    with STATE.write():
+        if shared is None or not outermost:
+            yield
+            return
+        shared.begin()
+        try:
+            yield
+        finally:
+            shared.end()
+
+
+def reads(function):
+    '''
+    Decorator for functions that only read server_data
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with _read():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def writes(function):
+    '''
+    Decorator for functions that change server_data
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with _write():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def reads_channels(function):
+    '''
+    Decorator for functions that read every channel's messages or the indexes
+    over them, which channel writers change while only reading STATE
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _per_channel():
+            with STATE.write():
+                return function(*args, **kwargs)
+        with _read():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def _channel_of(channel_of, args, kwargs):
+    try:
+        return channel_of(*args, **kwargs)
+    except Exception:
+        # let the function itself report the bad argument
+        return None
+
+
+def reads_channel(channel_of):
+    '''
+    Decorator for functions that only read one channel, channel_of is given
+    the function's arguments and returns its channel_id
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            channel_id = _channel_of(channel_of, args, kwargs) if _per_channel() else None
+            if channel_id is None:
+                with _read():
+                    return function(*args, **kwargs)
+            with STATE.read(), channel_lock(channel_id).read():
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def writes_channel(channel_of):
+    '''
+    Decorator for functions that only change one channel's messages or
+    standup, channel_of is given the function's arguments and returns its
+    channel_id
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            channel_id = _channel_of(channel_of, args, kwargs) if _per_channel() else None
+            if channel_id is None:
+                with _write():
+                    return function(*args, **kwargs)
+            with STATE.read(), channel_lock(channel_id).write():
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,241 @@
+'''
+Mail
+
+Outgoing mail is queued in an Outbox and sent in batches from its own
+background thread, so requests return as soon as their mail is queued.
+Mail that fails is retried with a growing delay, and mail queued under a
+key replaces any mail still waiting under the same key, so a user asking
+for several password resets in a row is only sent the latest code.
+
+The transport is chosen with SLACKR_MAIL:
+    smtp://host:port    sends through an smtp server, one connection a batch
+    file:path           appends each mail to a file as a json line
+    (unset)             pipes each mail to mailx
+'''
+import heapq
+import itertools
+import json
+import os
+import smtplib
+import subprocess
+import threading
+import time as t
+import traceback
+from collections import OrderedDict
+from email.message import EmailMessage
+
+# ============================ MAIL ========================================= #
+
+#       This file contains the outbox and the transports sending mail
+
+# =========================================================================== #
+
+BATCH_SIZE = 50
+ATTEMPTS = 5
+RETRY_DELAY = 2
+
+SENDER = os.environ.get('SLACKR_MAIL_FROM', 'slackr@localhost')
+
+
+class MailxTransport:
+    '''
+    Pipes each mail to the mailx command
+    '''
+    def send(self, mails):
+        failed = []
+        for mail in mails:
+            try:
+                result = subprocess.run(['mailx', '-s', mail['subject'], mail['to']],
+                                        input=mail['body'], universal_newlines=True,
+                                        timeout=30)
+                if result.returncode:
+                    failed.append(mail)
+            except (OSError, subprocess.SubprocessError):
+                failed.append(mail)
+        return failed
+
+
+class SmtpTransport:
+    '''
+    Sends each batch over one connection to an smtp server
+    '''
+    def __init__(self, host, port=25, sender=SENDER):
+        self.host = host
+        self.port = port
+        self.sender = sender
+
+    def send(self, mails):
+        failed = []
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            for mail in mails:
+                message = EmailMessage()
+                message['From'] = self.sender
+                message['To'] = mail['to']
+                message['Subject'] = mail['subject']
+                message.set_content(mail['body'])
+                try:
+                    smtp.send_message(message)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
+                    failed.append(mail)
+        return failed
+
+
+class FileTransport:
+    '''
+    Appends each mail to a file as a json line instead of sending it
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, mails):
+        with open(self.path, 'a') as FILE:
+            for mail in mails:
+                FILE.write(json.dumps({'to' : mail['to'], 'subject' : mail['subject'],
+                                       'body' : mail['body']}) + '\n')
+        return []
+
+
+def transport_from_env():
+    '''
+    Returns the transport SLACKR_MAIL names
+    '''
+    setting = os.environ.get('SLACKR_MAIL', '')
+    if setting.startswith('smtp://'):
+        host, _, port = setting[len('smtp://'):].partition(':')
+        return SmtpTransport(host, int(port or 25))
+    if setting.startswith('file:'):
+        return FileTransport(setting[len('file:'):])
+    return MailxTransport()
+
+
+class Outbox:
+    '''
+    Queues mail and sends it in batches through a transport. A transport's
+    send is given a list of mails and returns the ones that failed, raising
+    counts every mail in the batch as failed.
+    '''
+    def __init__(self, transport, batch_size=BATCH_SIZE, attempts=ATTEMPTS,
+                 retry_delay=RETRY_DELAY):
+        self.transport = transport
+        self.batch_size = batch_size
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        # key -> mail waiting to be sent, in the order they were queued
+        self.pending = OrderedDict()
+        # heap of (due, n, mail) of mail waiting to be retried
+        self.retrying = []
+        self.keys = itertools.count()
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.thread = None
+        self.counts = {'queued' : 0, 'replaced' : 0, 'sent' : 0,
+                       'retried' : 0, 'failed' : 0, 'batches' : 0}
+
+    def send(self, to, subject, body, key=None):
+        '''
+        Queues a mail, replacing any mail still waiting under the same key
+        '''
+        with self.cond:
+            if key is None:
+                key = ('mail', next(self.keys))
+            if key in self.pending:
+                self.counts['replaced'] += 1
+            self.pending[key] = {'key' : key, 'to' : to, 'subject' : subject,
+                                 'body' : body, 'attempts' : 0}
+            self.counts['queued'] += 1
+            self.cond.notify()
+
+    def _take(self):
+        # mail due a retry goes back in the queue unless newer mail replaced it
+        now = t.monotonic()
+        while self.retrying and self.retrying[0][0] <= now:
+            mail = heapq.heappop(self.retrying)[2]
+            if mail['key'] not in self.pending:
+                self.pending[mail['key']] = mail
+        batch = []
+        while self.pending and len(batch) < self.batch_size:
+            batch.append(self.pending.popitem(last=False)[1])
+        return batch
+
+    def dispatch(self):
+        '''
+        Sends one batch of the mail that is due, returning how many were in it
+        '''
+        with self.cond:
+            batch = self._take()
+        if not batch:
+            return 0
+
+        try:
+            failed = self.transport.send(batch)
+        except Exception:
+            print('Sending mail failed')
+            traceback.print_exc()
+            failed = batch
+
+        with self.cond:
+            self.counts['batches'] += 1
+            self.counts['sent'] += len(batch) - len(failed)
+            for mail in failed:
+                mail['attempts'] += 1
+                if mail['attempts'] >= self.attempts:
+                    self.counts['failed'] += 1
+                    continue
+                self.counts['retried'] += 1
+                due = t.monotonic() + self.retry_delay * 2 ** (mail['attempts'] - 1)
+                heapq.heappush(self.retrying, (due, next(self.keys), mail))
+        return len(batch)
+
+    def run(self):
+        '''
+        Sends mail as it is queued until the outbox is stopped
+        '''
+        while True:
+            with self.cond:
+                while not self.stopping and not self.pending:
+                    if self.retrying:
+                        wait = self.retrying[0][0] - t.monotonic()
+                        if wait <= 0:
+                            break
+                        self.cond.wait(wait)
+                    else:
+                        self.cond.wait()
+                if self.stopping:
+                    return
+            self.dispatch()
+
+    def start(self):
+        '''
+        Starts the thread sending mail
+        '''
+        if self.thread is not None:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        '''
+        Stops the thread, then sends whatever mail is still queued
+        '''
+        if self.thread is not None:
+            with self.cond:
+                self.stopping = True
+                self.cond.notify()
+            self.thread.join(timeout)
+            self.thread = None
+        while self.dispatch():
+            pass
+
+    def stats(self):
+        '''
+        Returns how much mail has been queued, sent and retried
+        '''
+        with self.cond:
+            stats = dict(self.counts)
+            stats['pending'] = len(self.pending)
+            stats['retrying'] = len(self.retrying)
+            return stats
+
+
+OUTBOX = Outbox(transport_from_env())
@@ -1,4 +1,5 @@
 ''' message funcions'''
+import heapq
 import time as t
 import server_data
 from server.helper import is_valid_message, is_valid_token, token_to_user
@@ -6,7 +7,13 @@ from server.helper import check_valid_user, channel_exists, check_channel_member
 from server.helper import channel_info, AccessError, standup_exists, get_standup
 from server.helper import get_msg_dict, msg_to_channel, is_msg_removed, is_owner
 from server.helper import token_to_firstname, check_valid_channel
-from server.helper import is_slackr_admin, validate_token
+from server.helper import is_slackr_admin, validate_token, add_message, remove_message
+from server.helper import edit_message, pin_message, add_react, remove_react
+from server.helper import react_users, view_message, LaterMessage
+from server.helper import index_standup, new_message_id, channel_arg, message_channel
+from server.persistence import commit, applies, message_store
+from server.locks import reads_channels, reads_channel, writes_channel
+from server import search_index
 
 # ============================ MESSAGE ====================================== #
 
@@ -14,6 +21,7 @@ from server.helper import is_slackr_admin, validate_token
 
 # =========================================================================== #
 
+@reads_channels
 @validate_token
 def search(token, query_str):
     '''
@@ -30,15 +38,78 @@ def search(token, query_str):
 
     # List of channel ids that the user is part of
     list_of_channels = server_data.data['users'][current_user_id]['channels']
+    ranks = {channel_id : rank for rank, channel_id in enumerate(list_of_channels)}
 
-    for channel_id in list_of_channels:
-        for message in server_data.data['channels'][channel_id]['messages']:
-            if query_str in message['message']:
-                matching.append(message)
+    store = message_store()
+    if store is not None:
+        # the storage engine looks the query up in its own index
+        found = [(ranks[channel_id], position, message) for channel_id, position, message
+                 in store.find(current_user_id, [query_str])]
+    else:
+        message_ids = search_index.candidates(query_str)
+        if message_ids is None:
+            # too short to look up, check every message
+            for channel_id in list_of_channels:
+                for message in server_data.data['channels'][channel_id]['messages']:
+                    if query_str in message['message']:
+                        matching.append(view_message(message, current_user_id))
+            return {'messages': matching}
+
+        # verify each candidate
+        found = []
+        for message_id in message_ids:
+            channel, message = server_data.message_index[message_id]
+            if channel['channel_id'] in ranks and query_str in message['message']:
+                found.append((ranks[channel['channel_id']],
+                              server_data.message_seq[message_id], message))
+
+    # order them as a scan of the channels would
+    found.sort(key=lambda match: match[:2])
+    matching = [view_message(message, current_user_id) for _, _, message in found]
 
     return {'messages': matching}
 
 
+@reads_channels
+@validate_token
+def search_terms(token, query_str):
+    '''
+    Searches for the messages containing every term of a query, where a term
+    is a word or a "quoted phrase", oldest first
+    '''
+
+    is_valid_message(query_str)
+    current_user_id = token_to_user(token)
+    query_terms = search_index.terms(query_str)
+    if not query_terms:
+        return {'messages': []}
+
+    list_of_channels = server_data.data['users'][current_user_id]['channels']
+
+    store = message_store()
+    if store is not None:
+        # the storage engine looks the terms up in its own index
+        messages = [message for _, _, message in store.find(current_user_id, query_terms)]
+    else:
+        message_ids = search_index.all_candidates(query_terms)
+        if message_ids is None:
+            # every term is too short to look up, check every message
+            messages = [message for channel_id in list_of_channels
+                        for message in server_data.data['channels'][channel_id]['messages']]
+        else:
+            in_channels = set(list_of_channels)
+            messages = [message for channel, message in
+                        (server_data.message_index[message_id] for message_id in message_ids)
+                        if channel['channel_id'] in in_channels]
+
+    found = [message for message in messages
+             if all(term in message['message'] for term in query_terms)]
+    found.sort(key=lambda message: (message['time_created'], message['message_id']))
+
+    return {'messages': [view_message(message, current_user_id) for message in found]}
+
+
+@writes_channel(channel_arg)
 @validate_token
 def message_send(token, channel_id, message):
     '''
@@ -60,11 +131,7 @@ def message_send(token, channel_id, message):
     if not check_channel_member(curr_user_id, channel_id):
         raise AccessError(f"User is not part of specified channel. Please join the channel.")
 
-    info = channel_info(channel_id)
-
-    messages = info['messages']
-    message_id = server_data.data['n_messages']
-    server_data.data['n_messages'] += 1
+    message_id = new_message_id()
 
     new_message = dict()
     new_message['message_id'] = message_id
@@ -74,12 +141,23 @@ def message_send(token, channel_id, message):
     new_message['reacts'] = []
     new_message['is_pinned'] = False
 
-    server_data.data["channels"][channel_id]["channel_n_messages"] += 1
-    messages.append(dict(new_message))
+    commit('message_send', channel_id=channel_id, message=new_message)
 
     return message_id
 
+@applies('message_send', 'message')
+def _apply_message_send(record):
+    '''
+    Appends a message to a channel, this is also how messages sent later and
+    standup summaries are delivered
+    '''
+    info = channel_info(record['channel_id'])
+    message = dict(record['message'])
+    message['reacts'] = list(message['reacts'])
+    add_message(info, message)
+
 
+@writes_channel(channel_arg)
 @validate_token
 def message_sendlater(token, channel_id, message, time_sent):
     '''
@@ -104,10 +182,7 @@ def message_sendlater(token, channel_id, message, time_sent):
     if not check_channel_member(curr_user_id, channel_id):
         raise AccessError(f"User is not part of specified channel. Please join the channel.")
 
-    message_id = server_data.data['n_messages']
-    server_data.data['n_messages'] += 1
-
-    messages_later = server_data.messages_later
+    message_id = new_message_id()
 
     new_message = dict()
     new_message['message_id'] = message_id
@@ -118,10 +193,19 @@ def message_sendlater(token, channel_id, message, time_sent):
     new_message['reacts'] = []
     new_message['is_pinned'] = False
 
-    messages_later.append(dict(new_message))
+    commit('message_sendlater', message=new_message)
 
     return message_id
 
+@applies('message_sendlater', 'later', 'messages_later')
+def _apply_message_sendlater(record):
+    message = LaterMessage(record['message'])
+    heapq.heappush(server_data.messages_later, message)
+    # reserve the message_id now so no other message can take it
+    server_data.data['n_messages'] = max(server_data.data['n_messages'],
+                                         message['message_id'] + 1)
+
+@writes_channel(channel_arg)
 @validate_token
 def standup_start(token, channel_id, length):
     '''
@@ -139,17 +223,23 @@ def standup_start(token, channel_id, length):
     if not check_channel_member(curr_user_id, int(channel_id)):
         raise AccessError(f"User is not part of specified channel. Please join the channel.")
 
-    standups = server_data.standups
-
     new = dict()
     new['messages'] = []
     new['u_id'] = curr_user_id
     new['channel_id'] = channel_id
     new['time_end'] = int(t.time() + int(length))
 
-    standups.append(new)
+    commit('standup_start', standup=new)
     return new['time_end']
 
+@applies('standup_start', 'standup', 'standups')
+def _apply_standup_start(record):
+    standup = dict(record['standup'])
+    standup['messages'] = list(standup['messages'])
+    server_data.standups.append(standup)
+    index_standup(standup)
+
+@writes_channel(channel_arg)
 @validate_token
 def standup_send(token, channel_id, message):
     '''
@@ -169,16 +259,18 @@ def standup_send(token, channel_id, message):
     if len(message) > 1000:
         raise ValueError(f"Message cannot be over 1000 characters")
 
-    standups = server_data.standups
-    target = get_standup(standups, channel_id)
-    messages = target['messages']
-
     new_message = dict()
     new_message['first_name'] = token_to_firstname(token)
     new_message['message'] = message
 
-    messages.append(dict(new_message))
+    commit('standup_send', channel_id=channel_id, message=new_message)
 
+@applies('standup_send', 'standup', 'standups')
+def _apply_standup_send(record):
+    target = get_standup(record['channel_id'])
+    target['messages'].append(dict(record['message']))
+
+@reads_channel(channel_arg)
 @validate_token
 def standup_active(token, channel_id):
     '''
@@ -188,14 +280,14 @@ def standup_active(token, channel_id):
         raise ValueError(f"channel does not exist")
 
 
-    standups = server_data.standups
-    exists = get_standup(standups, channel_id)
+    exists = get_standup(channel_id)
 
     if exists is None:
         return None # @@@@ NEED TO CHECK IF THIS DOES NOT TRIGGER
 
     return exists['time_end']
 
+@writes_channel(message_channel)
 @validate_token
 def message_remove(token, message_id):
     '''
@@ -224,17 +316,16 @@ def message_remove(token, message_id):
     else:
         raise AccessError('User does not have the right permission')
 
-    # decrease the channel_n_messages and n_messages
-    channel["channel_n_messages"] -= 1
-
-    # deleting message
-    for i in range(len(channel['messages'])):
-        if channel['messages'][i]['message_id'] == int(message_id):
-            del channel['messages'][i]
-            break
+    commit('message_remove', message_id=int(message_id))
 
     return {}
 
+@applies('message_remove', 'message')
+def _apply_message_remove(record):
+    # deleting message, which also decreases the channel_n_messages
+    remove_message(record['message_id'])
+
+@writes_channel(message_channel)
 @validate_token
 def message_edit(token, message_id, message):
     '''
@@ -271,10 +362,15 @@ def message_edit(token, message_id, message):
     if message == "":
         message_remove(token, message_id)
     else:
-        message_dict['message'] = message
+        commit('message_edit', message_id=message_id, message=message)
 
     return {}
 
+@applies('message_edit', 'message')
+def _apply_message_edit(record):
+    edit_message(record['message_id'], record['message'])
+
+@writes_channel(message_channel)
 @validate_token
 def message_pin(token, message_id):
     '''
@@ -312,9 +408,14 @@ def message_pin(token, message_id):
     if message["is_pinned"]:
         raise ValueError("Message is already pinned")
 
-    message["is_pinned"] = True
+    commit('message_pin', message_id=message_id)
     return {}
 
+@applies('message_pin', 'message')
+def _apply_message_pin(record):
+    pin_message(record['message_id'], True)
+
+@writes_channel(message_channel)
 @validate_token
 def message_unpin(token, message_id):
     '''
@@ -351,9 +452,14 @@ def message_unpin(token, message_id):
     if not message["is_pinned"]:
         raise ValueError("Message is not currently pinned")
 
-    message["is_pinned"] = False
+    commit('message_unpin', message_id=message_id)
     return {}
 
+@applies('message_unpin', 'message')
+def _apply_message_unpin(record):
+    pin_message(record['message_id'], False)
+
+@writes_channel(message_channel)
 @validate_token
 def message_react(token, message_id, react_id):
     '''
@@ -385,24 +491,19 @@ def message_react(token, message_id, react_id):
     if react_id not in react_id_list:
         raise ValueError("React ID is not valid")
 
-    # if the message already has the react id
-    for react in message["reacts"]:
-        if react['react_id'] == react_id:
-            # check if the current user has already reacted
-            if curr_user_id in react['u_ids']:
-                raise ValueError("Message already reacted by current user")
-            # react to the message!
-            react['u_ids'].append(curr_user_id)
-            return {}
-
-    # otherwise, the message has not been reacted too
-    message['reacts'].append({
-        'react_id' : react_id,
-        'u_ids' : [curr_user_id]
-    })
+    # check if the current user has already reacted
+    if curr_user_id in react_users(message_id, react_id):
+        raise ValueError("Message already reacted by current user")
+
+    commit('message_react', message_id=message_id, react_id=react_id, u_id=curr_user_id)
 
     return {}
 
+@applies('message_react', 'message')
+def _apply_message_react(record):
+    add_react(record['message_id'], record['react_id'], record['u_id'])
+
+@writes_channel(message_channel)
 @validate_token
 def message_unreact(token, message_id, react_id):
     '''
@@ -442,14 +543,14 @@ def message_unreact(token, message_id, react_id):
     for react_dict in message['reacts']:
         if react_dict['react_id'] == react_id:
             present_flag = 1
-            if curr_user_id in react_dict['u_ids']:
-                # the current user has reacted
-                react_dict['u_ids'].remove(curr_user_id)
-            if len(react_dict['u_ids']) == 0:
-                # remove react entirely if no more members
-                del react_dict
 
     if present_flag == 0:
         raise ValueError("Message does not have that react")
 
+    commit('message_unreact', message_id=message_id, react_id=react_id, u_id=curr_user_id)
+
     return {}
+
+@applies('message_unreact', 'message')
+def _apply_message_unreact(record):
+    remove_react(record['message_id'], record['react_id'], record['u_id'])
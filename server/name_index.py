@@ -0,0 +1,111 @@
+'''
+Name index
+
+Sorted lists of (name, id) over every user's names and handle and every
+public channel's name, lower cased. All the names starting with a prefix
+sit together in one run found by bisection, so a page of typeahead
+results only looks at the entries it returns.
+'''
+import bisect
+import server_data
+from server.paging import page_limit, encode_cursor, decode_cursor
+
+# ============================ NAME INDEX =================================== #
+
+#       This file contains the functions maintaining and paging the index
+
+# =========================================================================== #
+
+def user_names(user):
+    '''
+    Returns the names a user can be found by
+    '''
+    name_first = user['name_first'].lower()
+    name_last = user['name_last'].lower()
+    return {user['handle_str'].lower(), name_first, name_last, name_first + ' ' + name_last}
+
+
+def build():
+    '''
+    Indexes every user and public channel from scratch
+    '''
+    server_data.user_names = sorted((name, user['u_id'])
+                                    for user in server_data.data['users']
+                                    for name in user_names(user))
+    server_data.channel_names = sorted((channel['name'].lower(), channel['channel_id'])
+                                       for channel in server_data.data['channels']
+                                       if channel['is_public'])
+
+
+def _insert(index, entry):
+    bisect.insort(index, entry)
+
+
+def _delete(index, entry):
+    position = bisect.bisect_left(index, entry)
+    if position < len(index) and index[position] == entry:
+        del index[position]
+
+
+def add_user(user):
+    '''
+    Indexes a user, must be called again after their names change
+    '''
+    for name in user_names(user):
+        _insert(server_data.user_names, (name, user['u_id']))
+
+
+def remove_user(user):
+    '''
+    Removes a user from the index, must be called before their names change
+    '''
+    for name in user_names(user):
+        _delete(server_data.user_names, (name, user['u_id']))
+
+
+def add_channel(channel):
+    '''
+    Indexes a channel if it is public
+    '''
+    if channel['is_public']:
+        _insert(server_data.channel_names, (channel['name'].lower(), channel['channel_id']))
+
+
+def cursor(entry):
+    '''
+    Returns an opaque cursor to the results after entry
+    '''
+    return encode_cursor(*entry)
+
+
+def read_cursor(value):
+    '''
+    Returns the entry a cursor continues after
+    '''
+    return tuple(decode_cursor(value, str, int))
+
+
+def page(index, prefix, after=None, limit=None, accept=None):
+    '''
+    Returns up to limit entries of index whose name starts with prefix,
+    continuing after the entry a cursor was read from, and a cursor to the
+    next page or None if this is the last. accept may skip entries.
+    '''
+    limit = page_limit(limit)
+
+    prefix = prefix.lower()
+    if after is None or after[0] < prefix:
+        position = bisect.bisect_left(index, (prefix,))
+    else:
+        position = bisect.bisect_right(index, after)
+
+    entries = []
+    while position < len(index) and index[position][0].startswith(prefix):
+        entry = index[position]
+        position += 1
+        if accept is not None and not accept(entry):
+            continue
+        if len(entries) == limit:
+            return entries, cursor(entries[-1])
+        entries.append(entry)
+    return entries, None
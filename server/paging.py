@@ -0,0 +1,53 @@
+'''
+Paging
+
+The page sizes and cursors shared by every list that is returned a page at
+a time. A cursor is an opaque string holding a few json values that tell
+the next request where to carry on from.
+'''
+import base64
+import json
+
+# ============================ PAGING ======================================= #
+
+#       This file contains the functions checking limits and encoding cursors
+
+# =========================================================================== #
+
+# Results in a page unless a limit is given, and the most a limit may ask for
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def page_limit(limit):
+    '''
+    Returns how many results a page holds, raising ValueError if the limit
+    asked for is out of range
+    '''
+    if limit is None:
+        return PAGE_SIZE
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"Limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+
+def encode_cursor(*values):
+    '''
+    Returns an opaque cursor holding values
+    '''
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+
+def decode_cursor(cursor, *types):
+    '''
+    Returns the values held by a cursor, raising ValueError unless there is
+    one of each of the given types
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError):
+        raise ValueError("Cursor is not valid")
+    if (not isinstance(values, list) or len(values) != len(types) or
+            not all(isinstance(value, kind) for value, kind in zip(values, types))):
+        raise ValueError("Cursor is not valid")
+    return values
@@ -0,0 +1,113 @@
+'''
+Passwords
+
+Passwords are stored as salted PBKDF2 hashes. Deriving one is slow on
+purpose, so it runs on a small pool of threads and never while server_data
+is locked, leaving other requests free to carry on during a burst of logins.
+
+SLACKR_PBKDF2_ITERATIONS sets the cost and SLACKR_HASH_WORKERS the size of
+the pool. Passwords hashed at a different cost, or with the unsalted sha256
+older versions stored, are rehashed the next time their user logs in.
+'''
+import hashlib
+import hmac
+import os
+import threading
+import time as t
+from concurrent.futures import ThreadPoolExecutor
+
+# ============================ PASSWORDS ==================================== #
+
+#       This file contains the functions hashing and checking passwords
+
+# =========================================================================== #
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = int(os.environ.get('SLACKR_PBKDF2_ITERATIONS', 100000))
+WORKERS = int(os.environ.get('SLACKR_HASH_WORKERS', 4))
+SALT_BYTES = 16
+
+_pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='passwords')
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _derive(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+
+
+def _hash(password, iterations):
+    salt = os.urandom(SALT_BYTES)
+    return '$'.join([ALGORITHM, str(iterations), salt.hex(),
+                     _derive(password, salt, iterations).hex()])
+
+
+def _check(password, stored):
+    parts = stored.split('$')
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        # the unsalted sha256 of older versions
+        expected = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(expected, stored)
+    _, iterations, salt, expected = parts
+    derived = _derive(password, bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(derived.hex(), expected)
+
+
+def _record(kind, waited, took):
+    with _stats_lock:
+        stats = _stats.setdefault(kind, {'runs' : 0, 'wait' : 0.0, 'total' : 0.0, 'max' : 0.0})
+        stats['runs'] += 1
+        stats['wait'] += waited
+        stats['total'] += took
+        stats['max'] = max(stats['max'], took)
+
+
+def _run(kind, function, *args):
+    '''
+    Runs function on the pool and waits for its result, timing both how long
+    it queued for and how long it ran
+    '''
+    queued = t.perf_counter()
+
+    def timed():
+        started = t.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            _record(kind, started - queued, t.perf_counter() - started)
+
+    return _pool.submit(timed).result()
+
+
+def hash_password(password):
+    '''
+    Returns a salted hash of password at the current cost
+    '''
+    return _run('hash', _hash, password, ITERATIONS)
+
+
+def check_password(password, stored):
+    '''
+    Returns True if password matches the stored hash
+    '''
+    return _run('check', _check, password, stored)
+
+
+def needs_rehash(stored):
+    '''
+    Returns True if the stored hash was not made at the current cost
+    '''
+    return not stored.startswith(ALGORITHM + '$' + str(ITERATIONS) + '$')
+
+
+def stats():
+    '''
+    Returns how often passwords were hashed and checked, times are in seconds
+    '''
+    with _stats_lock:
+        return {kind : {
+            'runs' : stats['runs'],
+            'mean_wait' : stats['wait'] / stats['runs'],
+            'mean' : stats['total'] / stats['runs'],
+            'max' : stats['max']
+        } for kind, stats in _stats.items()}
@@ -0,0 +1,189 @@
+'''
+Persistence functions
+
+Every mutation of server_data is committed as a small record. The record is
+handed to the storage engine and applied by the function registered for its
+op, so live mutations and records replayed on startup run the same code.
+With the default engine the record is appended to a write-ahead log before it
+is applied, so the JSON stores only need to be rewritten at periodic
+checkpoints.
+'''
+import threading
+import time as t
+import server_data
+from server.storage import JsonStorage
+from server import locks
+from server.locks import reads_channels
+
+# ============================ PERSISTENCE ================================== #
+
+#       This file contains the commit, load and checkpoint functions
+
+# =========================================================================== #
+
+# Checkpoint after this many seconds or records, whichever comes first
+CHECKPOINT_INTERVAL = 60
+CHECKPOINT_RECORDS = 10000
+
+# op -> (store, function applying the record to server_data, rows it touches)
+APPLIERS = {}
+
+# functions run once the stores are loaded, before any record is replayed
+LOAD_HOOKS = []
+
+_lock = threading.RLock()
+_storage = JsonStorage()
+_pending_records = 0
+_last_checkpoint = t.time()
+
+# Generation of each store when it was last written by a checkpoint
+_flushed = dict(server_data.generations)
+
+
+def applies(op, rows, store='data'):
+    '''
+    Decorator registering the function that applies records of type 'op'.
+    Each record only ever changes the one store it is registered against,
+    and 'rows' names the kind of stored rows it changes
+    (user, channel, member, message, later or standup).
+    '''
+    def register(function):
+        APPLIERS[op] = (store, function, rows)
+        return function
+    return register
+
+
+def on_load(function):
+    '''
+    Decorator registering a function to run once the stores have been loaded
+    and before any record is replayed
+    '''
+    LOAD_HOOKS.append(function)
+    return function
+
+
+def use_storage(storage):
+    '''
+    Sets the storage engine, must be called before load()
+    '''
+    global _storage
+    _storage = storage
+    locks.shared = storage if getattr(storage, 'shared', False) else None
+
+
+def message_store():
+    '''
+    Returns the storage engine if it serves messages itself instead of
+    keeping them in server_data, otherwise None
+    '''
+    return _storage if getattr(_storage, 'serving', False) else None
+
+
+def touch(store):
+    '''
+    Marks a store as changed so it is written at the next checkpoint
+    '''
+    server_data.generations[store] += 1
+
+
+def is_dirty(store):
+    '''
+    Returns True if a store has changed since it was last written
+    '''
+    return server_data.generations[store] != _flushed[store]
+
+
+def commit(op, **fields):
+    '''
+    Logs a mutation and then applies it to server_data, the record is taken
+    back out of the log if applying it raises
+    Returns the record
+    '''
+    global _pending_records
+    record = dict(fields)
+    record['op'] = op
+    store, apply, rows = APPLIERS[op]
+    with _lock:
+        _storage.append(record)
+        try:
+            apply(record)
+        except BaseException:
+            # a record that failed to apply would fail again on every replay
+            _storage.discard(record)
+            raise
+        touch(store)
+        _storage.applied(record, store, rows)
+        _pending_records += 1
+    return record
+
+
+def _store_of(op):
+    return APPLIERS[op][0]
+
+
+def _loaded():
+    for function in LOAD_HOOKS:
+        function()
+
+
+def _replay(record):
+    store, apply, _ = APPLIERS[record['op']]
+    apply(record)
+    touch(store)
+
+
+def load():
+    '''
+    Loads the stores from the storage engine
+    Stores changed by replayed records stay dirty until the next checkpoint
+    '''
+    global _pending_records
+    with _lock:
+        _flushed.update(server_data.generations)
+        _pending_records = _storage.load(_store_of, _replay, _loaded)
+
+
+def sync():
+    '''
+    Flushes committed records to disk
+    '''
+    with _lock:
+        _storage.sync()
+
+
+@reads_channels
+def checkpoint():
+    '''
+    Writes every store that has changed since it was last written
+    '''
+    global _pending_records, _last_checkpoint
+    with _lock:
+        dirty = [store for store in server_data.generations if is_dirty(store)]
+        if dirty:
+            print('Checkpoint!', ', '.join(dirty),
+                  t.strftime('%Y-%m-%d %H:%M:%S', t.localtime(int(t.time()))))
+        _storage.write(dirty)
+        for store in dirty:
+            _flushed[store] = server_data.generations[store]
+        _pending_records = 0
+        _last_checkpoint = t.time()
+
+
+def maybe_checkpoint():
+    '''
+    Checkpoints if the log has grown too long or too old
+    '''
+    if not any(is_dirty(store) for store in server_data.generations):
+        return
+    if (_pending_records >= CHECKPOINT_RECORDS or
+            t.time() - _last_checkpoint >= CHECKPOINT_INTERVAL):
+        checkpoint()
+
+
+def close():
+    '''
+    Closes the storage engine, records committed afterwards are only
+    applied in memory
+    '''
+    with _lock:
+        _storage.close()
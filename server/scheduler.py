@@ -0,0 +1,120 @@
+'''
+Scheduler
+
+A single long lived thread running the server's periodic jobs, such as
+sending messages stored for later, finishing standups and flushing
+persistence. Each job has its own interval and keeps timing stats.
+'''
+import heapq
+import threading
+import time as t
+import traceback
+
+# ============================ SCHEDULER ==================================== #
+
+#       This file contains the scheduler running periodic jobs
+
+# =========================================================================== #
+
+
+class Scheduler:
+    '''
+    Runs every added job on its interval from one background thread.
+    Jobs are due at fixed steps from when they were added so they do not
+    drift, and a job that falls behind runs once and then waits a full
+    interval rather than running again to catch up.
+    '''
+    def __init__(self):
+        self.jobs = {}
+        self.queue = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def add(self, name, function, interval):
+        '''
+        Adds a job running function every interval seconds, jobs should be
+        added before the scheduler is started
+        '''
+        with self.lock:
+            self.jobs[name] = {
+                'function' : function,
+                'interval' : interval,
+                'runs' : 0,
+                'errors' : 0,
+                'total' : 0.0,
+                'max' : 0.0,
+                'last' : None
+            }
+            heapq.heappush(self.queue, (t.monotonic() + interval, name))
+
+    def start(self):
+        '''
+        Starts the scheduler thread
+        '''
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        '''
+        Stops the scheduler thread once the job it is running has finished
+        '''
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def run(self):
+        '''
+        Runs jobs as they fall due until the scheduler is stopped
+        '''
+        while not self.stopping.is_set():
+            with self.lock:
+                due, name = self.queue[0] if self.queue else (None, None)
+            if due is None:
+                self.stopping.wait(1)
+                continue
+            if self.stopping.wait(max(due - t.monotonic(), 0)):
+                break
+            with self.lock:
+                heapq.heappop(self.queue)
+                job = self.jobs[name]
+                next_due = due + job['interval']
+                heapq.heappush(self.queue, (max(next_due, t.monotonic()), name))
+            self.run_job(name, job)
+
+    def run_job(self, name, job):
+        '''
+        Runs a job once, recording how long it took
+        An exception is printed and counted but does not stop the scheduler
+        '''
+        start = t.perf_counter()
+        try:
+            job['function']()
+        except Exception:
+            job['errors'] += 1
+            print('Scheduled job', name, 'failed')
+            traceback.print_exc()
+        elapsed = t.perf_counter() - start
+        job['runs'] += 1
+        job['total'] += elapsed
+        job['max'] = max(job['max'], elapsed)
+        job['last'] = elapsed
+
+    def stats(self):
+        '''
+        Returns the timing stats of every job, times are in seconds
+        '''
+        with self.lock:
+            return {name : {
+                'interval' : job['interval'],
+                'runs' : job['runs'],
+                'errors' : job['errors'],
+                'mean' : job['total'] / job['runs'] if job['runs'] else None,
+                'max' : job['max'],
+                'last' : job['last']
+            } for name, job in self.jobs.items()}
@@ -0,0 +1,134 @@
+'''
+Search index
+
+A trigram index from every three character substring to the messages that
+contain it. Any query of three or more characters can only match messages
+holding all of its trigrams, so a search only verifies those candidates
+instead of every message in every channel.
+
+A query may also be split into terms, each a word or a "quoted phrase", that
+a message must all contain. The terms are matched as substrings like a plain
+search, so parts of words match and a phrase matches its words in order.
+'''
+import re
+import server_data
+
+# ============================ SEARCH INDEX ================================= #
+
+#       This file contains the functions maintaining and querying the index
+
+# =========================================================================== #
+
+# Checkpointed alongside the data store when it has changed, so it is not
+# rebuilt on every start
+INDEX_PATH = 'searchIndex.json'
+
+N = 3
+
+# a "quoted phrase" or a single term
+TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def trigrams(text):
+    '''
+    Returns the set of substrings of length N in text
+    '''
+    return {text[i:i + N] for i in range(len(text) - N + 1)}
+
+
+def add(message):
+    '''
+    Indexes every trigram of a message
+    '''
+    index = server_data.search_index
+    server_data.search_index_generation += 1
+    for trigram in trigrams(message['message']):
+        index.setdefault(trigram, set()).add(message['message_id'])
+
+
+def remove(message):
+    '''
+    Removes a message from the index, must be called before its text changes
+    '''
+    index = server_data.search_index
+    server_data.search_index_generation += 1
+    for trigram in trigrams(message['message']):
+        postings = index.get(trigram)
+        if postings is None:
+            continue
+        postings.discard(message['message_id'])
+        if not postings:
+            del index[trigram]
+
+
+def build():
+    '''
+    Indexes every message in every channel from scratch
+    '''
+    server_data.search_index = {}
+    server_data.search_index_generation += 1
+    for channel in server_data.data['channels']:
+        for message in channel['messages']:
+            add(message)
+
+
+def dump():
+    '''
+    Returns the index in a form that can be written as json
+    '''
+    return {trigram : sorted(postings)
+            for trigram, postings in server_data.search_index.items()}
+
+
+def restore(value):
+    '''
+    Returns an index read back from json
+    '''
+    return {trigram : set(postings) for trigram, postings in value.items()}
+
+
+def candidates(query_str):
+    '''
+    Returns the ids of the messages that may contain query_str, or None if
+    the query is too short to narrow down
+    '''
+    query_trigrams = trigrams(query_str)
+    if not query_trigrams:
+        return None
+
+    # intersect starting from the rarest trigram
+    postings = []
+    for trigram in query_trigrams:
+        if trigram not in server_data.search_index:
+            return set()
+        postings.append(server_data.search_index[trigram])
+    postings.sort(key=len)
+    matches = set(postings[0])
+    for trigram_postings in postings[1:]:
+        matches &= trigram_postings
+        if not matches:
+            break
+    return matches
+
+
+def terms(query_str):
+    '''
+    Returns the terms of a query, each a word or the text of a quoted phrase
+    '''
+    return [phrase or term for phrase, term in TERM.findall(query_str) if phrase or term]
+
+
+def all_candidates(query_terms):
+    '''
+    Returns the ids of the messages that may contain every term, or None if
+    none of the terms are long enough to narrow down
+    '''
+    matches = None
+    for term in query_terms:
+        term_matches = candidates(term)
+        if term_matches is None:
+            continue
+        matches = term_matches if matches is None else matches & term_matches
+        if not matches:
+            break
+    return matches
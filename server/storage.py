@@ -0,0 +1,1001 @@
+'''
+Storage engines
+
+An engine is where persistence keeps the stores in server_data between runs.
+It makes the changes durable and loads the stores back on startup.
+
+JsonStorage keeps a write-ahead log next to json checkpoint files and is the
+default, every request is served from the stores in memory. SqliteStorage is
+a durable backend that writes the rows each record changed to indexed sqlite
+tables as it is committed, so nothing is replayed or checkpointed. It reads
+the users and channels back into memory on startup but serves the message
+history, message lookups and searches from its tables. A shared
+SqliteStorage also journals every record so that several server processes
+can serve the same database.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import server_data
+from server import search_index
+
+# ============================ STORAGE ====================================== #
+
+#               This file contains the storage engines
+
+# =========================================================================== #
+
+LOG_PATH = 'dataStore.log'
+
+# Each store in server_data is checkpointed to its own file
+STORE_PATHS = {
+    'data' : 'dataStore.json',
+    'standups' : 'standups.json',
+    'messages_later' : 'messagesLater.json'
+}
+
+
+def _unwrap(store, snapshot):
+    '''
+    Returns (seq, value) for a checkpoint file
+    Files written before the log existed hold the bare store with no seq
+    '''
+    if isinstance(snapshot, dict) and 'seq' in snapshot and store in snapshot:
+        return snapshot['seq'], snapshot[store]
+    return 0, snapshot
+
+
+def _write_atomic(path, value):
+    '''
+    Writes value as json to path without ever leaving a partial file behind
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as FILE:
+        json.dump(value, FILE, separators=(',', ':'))
+        FILE.flush()
+        os.fsync(FILE.fileno())
+    os.replace(tmp_path, path)
+
+
+def _reserve_later_ids():
+    '''
+    Ids reserved by pending messages may be newer than the data checkpoint
+    '''
+    for message in server_data.messages_later:
+        server_data.data['n_messages'] = max(server_data.data['n_messages'],
+                                             message['message_id'] + 1)
+
+
+# ------------------------- JSON STORAGE -------------------------
+
+#       Write-ahead log with periodic json checkpoints
+
+# ----------------------------------------------------------------
+
+class JsonStorage:
+    '''
+    Records are appended to a log before they are applied. Checkpoints
+    rewrite the json file of every changed store and truncate the log.
+    '''
+    def __init__(self, log_path=LOG_PATH, store_paths=None,
+                 index_path=search_index.INDEX_PATH):
+        self.log_path = log_path
+        self.store_paths = dict(store_paths or STORE_PATHS)
+        self.index_path = index_path
+        self.seq = 0
+        self.log = None
+        self.unsynced = False
+        # where the last record appended starts in the log
+        self.last_offset = 0
+        # seq of the search index checkpoint and its generation when written
+        self.index_seq = 0
+        self.index_written = None
+
+    def load(self, store_of, replay, loaded):
+        '''
+        Loads the latest checkpoint, replays the log tail and opens the log
+        for appending
+        Returns the number of records in the log
+        '''
+        store_seqs = {}
+        self.index_seq = 0
+        for store, path in self.store_paths.items():
+            store_seqs[store] = 0
+            if os.path.exists(path):
+                with open(path, 'r') as FILE:
+                    snapshot = json.load(FILE)
+                store_seqs[store], value = _unwrap(store, snapshot)
+                setattr(server_data, store, value)
+                if store == 'data':
+                    # checkpoints written before the index had its own
+                    # generation always rewrote it with the data store
+                    self.index_seq = snapshot.get('index_seq', store_seqs[store])
+        self.seq = max(store_seqs.values())
+        self.read_index(self.index_seq)
+        loaded()
+
+        # Replay only the records the checkpoint of their store is missing
+        n_records = 0
+        end = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as FILE:
+                for line in iter(FILE.readline, ''):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a torn write from a crash, drop it and everything after
+                        break
+                    if record['seq'] > store_seqs[store_of(record['op'])]:
+                        replay(record)
+                    self.seq = max(self.seq, record['seq'])
+                    n_records += 1
+                    end = FILE.tell()
+
+        _reserve_later_ids()
+
+        self.log = open(self.log_path, 'a')
+        self.log.truncate(end)
+        # truncating does not move the position, which discard() relies on
+        self.log.seek(end)
+        return n_records
+
+    def read_index(self, index_seq):
+        '''
+        Reads back the search index if it is the checkpoint the data store
+        was written with, otherwise it is left to be rebuilt from the messages
+        '''
+        server_data.search_index = None
+        self.index_written = None
+        if not (os.path.exists(self.index_path) and
+                os.path.exists(self.store_paths['data'])):
+            return
+        with open(self.index_path, 'r') as FILE:
+            seq, value = _unwrap('search_index', json.load(FILE))
+        if seq == index_seq:
+            server_data.search_index = search_index.restore(value)
+            self.index_written = server_data.search_index_generation
+
+    def append(self, record):
+        '''
+        Writes a record to the log, called before the record is applied
+        '''
+        if self.log is None:
+            return
+        self.seq += 1
+        record['seq'] = self.seq
+        self.last_offset = self.log.tell()
+        self.log.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.log.flush()
+        self.unsynced = True
+
+    def discard(self, record):
+        '''
+        Takes the last record appended back out of the log, called when it
+        could not be applied
+        '''
+        if self.log is None or record.get('seq') != self.seq:
+            return
+        self.log.truncate(self.last_offset)
+        self.log.seek(self.last_offset)
+        self.seq -= 1
+
+    def applied(self, record, store, rows):
+        '''
+        Called once a record has been applied, the log already holds it
+        '''
+
+    def sync(self):
+        '''
+        Flushes the log to disk if anything was appended since the last sync
+        '''
+        if self.log is not None and self.unsynced:
+            os.fsync(self.log.fileno())
+            self.unsynced = False
+
+    def write(self, stores):
+        '''
+        Checkpoints the given stores and truncates the log
+        The search index is only written with the data store when it has
+        changed, and before it so the data store never names an index that
+        was not written
+        '''
+        if ('data' in stores and server_data.search_index is not None and
+                server_data.search_index_generation != self.index_written):
+            _write_atomic(self.index_path,
+                          {'seq' : self.seq, 'search_index' : search_index.dump()})
+            self.index_seq = self.seq
+            self.index_written = server_data.search_index_generation
+        for store in stores:
+            snapshot = {'seq' : self.seq, store : getattr(server_data, store)}
+            if store == 'data':
+                snapshot['index_seq'] = self.index_seq
+            _write_atomic(self.store_paths[store], snapshot)
+        if self.log is not None:
+            self.log.truncate(0)
+            os.fsync(self.log.fileno())
+            self.unsynced = False
+
+    def close(self):
+        '''
+        Closes the log
+        '''
+        if self.log is not None:
+            self.sync()
+            self.log.close()
+            self.log = None
+
+
+# ------------------------- SQLITE STORAGE -------------------------
+
+#       Durable tables updated as each record is committed, the messages
+#       are served from them and everything else is read into memory
+
+# ----------------------------------------------------------------
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+CREATE TABLE IF NOT EXISTS users (
+    u_id INTEGER PRIMARY KEY,
+    token TEXT,
+    email TEXT,
+    password TEXT,
+    name_first TEXT,
+    name_last TEXT,
+    handle_str TEXT,
+    permission INTEGER,
+    reset_token TEXT,
+    profile_img_url TEXT
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_handle ON users (handle_str);
+CREATE INDEX IF NOT EXISTS users_token ON users (token);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    name TEXT,
+    is_public INTEGER
+);
+CREATE TABLE IF NOT EXISTS members (
+    channel_id INTEGER,
+    u_id INTEGER,
+    channel_permission INTEGER,
+    UNIQUE (channel_id, u_id)
+);
+CREATE INDEX IF NOT EXISTS members_user ON members (u_id);
+CREATE TABLE IF NOT EXISTS messages (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id INTEGER UNIQUE,
+    channel_id INTEGER,
+    u_id INTEGER,
+    message TEXT,
+    time_created INTEGER,
+    is_pinned INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, position);
+CREATE TABLE IF NOT EXISTS message_counts (
+    channel_id INTEGER PRIMARY KEY,
+    n INTEGER
+);
+CREATE TABLE IF NOT EXISTS reacts (
+    message_id INTEGER,
+    react_id INTEGER,
+    u_id INTEGER,
+    UNIQUE (message_id, react_id, u_id)
+);
+CREATE TABLE IF NOT EXISTS later (
+    message_id INTEGER PRIMARY KEY,
+    message TEXT
+);
+CREATE TABLE IF NOT EXISTS standups (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER UNIQUE,
+    standup TEXT
+);
+CREATE TABLE IF NOT EXISTS image_jobs (
+    job_id TEXT PRIMARY KEY,
+    u_id INTEGER,
+    status TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS image_jobs_updated ON image_jobs (updated);
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    record TEXT
+);
+'''
+
+# Searched like the trigram index in search_index, left out if this sqlite
+# was built without fts5
+TRIGRAM_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS message_trigrams
+USING fts5 (message, tokenize = "trigram case_sensitive 1");
+'''
+
+# Messages most recently looked up by id, kept to save reading them again
+MESSAGE_CACHE_SIZE = 1000
+
+# Most values bound to one statement by older versions of sqlite
+MAX_VARIABLES = 999
+
+# Journal entries kept for processes that have fallen behind, a process
+# further behind reads every table again
+JOURNAL_KEEP = 10000
+
+# Journalled when whole stores are rewritten without a record
+RELOAD = {'op' : 'reload'}
+
+def _record_message_id(record):
+    '''
+    Records either carry the whole message or just its message_id
+    '''
+    if isinstance(record.get('message'), dict):
+        return record['message']['message_id']
+    return record['message_id']
+
+MESSAGE_SELECT = 'position, message_id, channel_id, u_id, message, time_created, is_pinned'
+
+USER_COLUMNS = ('u_id', 'token', 'email', 'password', 'name_first', 'name_last',
+                'handle_str', 'permission', 'reset_token', 'profile_img_url')
+
+class SqliteStorage:
+    '''
+    Every committed record updates the rows it touched in its own
+    transaction, so there is no log to replay and nothing to checkpoint.
+    Each op names the kind of rows it touches when it is registered.
+    The users, channels, members, later messages and standups are read into
+    server_data on startup and when catching up. Once loaded the engine is
+    serving, and the messages are only held in its tables: the helpers
+    look them up with message(), hand it their changes with changed() and
+    the handlers page and search the history with its queries.
+
+    When shared, every record is also appended to the journal table. A
+    process changing anything first takes the database's write lock with
+    begin() and replays what other processes journalled since it last
+    looked, so its checks and new ids see every process's changes. Readers
+    call refresh() to catch up the same way.
+    '''
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.db = None
+        self.lock = threading.RLock()
+        # generation of each store once its last record was written
+        self.recorded = {}
+        # last journal entry applied to server_data
+        self.journal_seq = 0
+        self.replay = None
+        self.loaded = None
+        # set once the messages are served from the tables
+        self.serving = False
+        # set while applying records already in the tables
+        self.replaying = False
+        self.trigrams = False
+        # message_id -> (channel_id, message) for recently looked up messages
+        self.cache = OrderedDict()
+        # message_id -> (channel_id, message), or None once removed, for
+        # changes applied but not yet written
+        self.unwritten = {}
+
+    def connect(self):
+        '''
+        Opens the database, creating the tables if they do not exist
+        '''
+        self.db = sqlite3.connect(self.path, check_same_thread=False,
+                                  isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(TRIGRAM_SCHEMA)
+            self.trigrams = True
+        except sqlite3.OperationalError:
+            self.trigrams = False
+
+    def is_empty(self):
+        '''
+        Returns True if nothing has been stored yet
+        '''
+        for table in ('users', 'channels', 'later', 'standups'):
+            if self.db.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+                return False
+        return True
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Runs the block in a transaction holding the database's write lock, or
+        in the one already open
+        '''
+        if self.db.in_transaction:
+            yield
+            return
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def load(self, store_of, replay, loaded):
+        '''
+        Builds the stores in server_data from the tables
+        An empty database is filled from the json files if there are any
+        '''
+        with self.lock:
+            self.connect()
+            self.replay = replay
+            self.loaded = loaded
+            # only one process may fill an empty database
+            with self.transaction():
+                if self.is_empty() and any(os.path.exists(path) for path in
+                                           [LOG_PATH] + list(STORE_PATHS.values())):
+                    # the json stores are loaded into memory and written out,
+                    # then read back without their messages
+                    legacy = JsonStorage()
+                    legacy.load(store_of, replay, loaded)
+                    legacy.close()
+                    self.write(server_data.generations)
+                    self.serving = True
+                    self.read()
+                    loaded()
+                elif not self.is_empty():
+                    self.index_messages()
+                    self.serving = True
+                    self.read()
+                    loaded()
+                else:
+                    # a new database, the stores start out empty
+                    self.serving = True
+                    loaded()
+                self.recorded = dict(server_data.generations)
+                self.journal_seq = self.last_journal_seq()
+        return 0
+
+    def index_messages(self):
+        '''
+        Counts and indexes the messages of a database written before the
+        message_counts and message_trigrams tables were
+        '''
+        if not self.db.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+            return
+        if not self.db.execute('SELECT 1 FROM message_counts LIMIT 1').fetchone():
+            self.db.execute('INSERT INTO message_counts SELECT channel_id, COUNT(*) '
+                            'FROM messages GROUP BY channel_id')
+        if (self.trigrams and
+                not self.db.execute('SELECT 1 FROM message_trigrams LIMIT 1').fetchone()):
+            self.db.execute('INSERT INTO message_trigrams (rowid, message) '
+                            'SELECT message_id, message FROM messages')
+
+    def last_journal_seq(self):
+        return self.db.execute('SELECT COALESCE(MAX(seq), 0) FROM journal').fetchone()[0]
+
+    def begin(self):
+        '''
+        Takes the database's write lock until end() and catches up with the
+        journal, called before a change to server_data
+        '''
+        self.lock.acquire()
+        if self.db is None:
+            return
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.catch_up()
+        except BaseException:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            self.lock.release()
+            raise
+
+    def end(self):
+        '''
+        Commits everything since begin(). Records applied in memory are kept
+        even if the change then failed, so they are always committed
+        '''
+        try:
+            if self.db is not None:
+                self.db.execute('COMMIT')
+        finally:
+            self.lock.release()
+
+    def refresh(self):
+        '''
+        Catches up with the journal, called before reading server_data
+        '''
+        with self.lock:
+            if self.db is None:
+                return
+            # read the journal and any tables from a single snapshot
+            self.db.execute('BEGIN')
+            try:
+                self.catch_up()
+            finally:
+                self.db.execute('COMMIT')
+
+    def catch_up(self):
+        '''
+        Applies every record other processes have journalled since the last
+        one this process saw
+        '''
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'journal_pruned'").fetchone()
+        if row is not None and self.journal_seq < row[0]:
+            self.reload()
+            return
+        # stores already written stay written once the records are replayed
+        current = [store for store in server_data.generations
+                   if self.recorded.get(store) == server_data.generations[store]]
+        records = self.db.execute('SELECT seq, record FROM journal WHERE seq > ? '
+                                  'ORDER BY seq', (self.journal_seq,)).fetchall()
+        # the messages are already in the tables, replaying only forgets them
+        self.replaying = True
+        try:
+            for seq, record in records:
+                record = json.loads(record)
+                if record == RELOAD:
+                    self.reload()
+                    return
+                self.replay(record)
+                self.journal_seq = seq
+        finally:
+            self.replaying = False
+        if records:
+            self.read_counts(server_data.data['channels'])
+        for store in current:
+            self.recorded[store] = server_data.generations[store]
+
+    def reload(self):
+        '''
+        Reads every table again
+        '''
+        self.read()
+        self.loaded()
+        self.recorded = dict(server_data.generations)
+        self.journal_seq = self.last_journal_seq()
+
+    def read(self):
+        '''
+        Reads every table but the messages back into the stores in server_data
+        '''
+        db = self.db
+        users = []
+        for row in db.execute('SELECT * FROM users ORDER BY u_id'):
+            user = dict(zip(USER_COLUMNS, row))
+            users.append({
+                'token' : user['token'],
+                'email' : user['email'],
+                'password': user['password'],
+                'name_first' : user['name_first'],
+                'name_last': user['name_last'],
+                'handle_str': user['handle_str'],
+                'u_id' : user['u_id'],
+                'channels' : [],
+                'permission' : user['permission'],
+                'reset_token' : user['reset_token'],
+                'profile_img_url' : user['profile_img_url']
+            })
+
+        channels = []
+        for channel_id, name, is_public in db.execute(
+                'SELECT * FROM channels ORDER BY channel_id'):
+            channels.append({"channel_id": channel_id, "name": name, "members": [],
+                             "messages" : [], "is_public": bool(is_public),
+                             "channel_n_messages": 0})
+        self.read_counts(channels)
+
+        for channel_id, u_id, permission in db.execute(
+                'SELECT * FROM members ORDER BY rowid'):
+            channels[channel_id]['members'].append({'u_id' : u_id,
+                                                    'channel_permission' : permission})
+            users[u_id]['channels'].append(channel_id)
+
+        n_messages = db.execute('SELECT COALESCE(MAX(message_id) + 1, 0) '
+                                'FROM messages').fetchone()[0]
+        row = db.execute("SELECT value FROM meta WHERE key = 'n_messages'").fetchone()
+        if row is not None:
+            n_messages = max(n_messages, row[0])
+
+        server_data.data = {
+            "n_users"       : len(users),
+            "users"         : users,
+            "n_channels"    : len(channels),
+            "channels"      : channels,
+            "n_messages"    : n_messages
+        }
+        server_data.search_index = None
+        server_data.messages_later = [json.loads(message) for (message,) in db.execute(
+            'SELECT message FROM later ORDER BY message_id')]
+        server_data.standups = [json.loads(standup) for (standup,) in db.execute(
+            'SELECT standup FROM standups ORDER BY position')]
+        _reserve_later_ids()
+        self.cache.clear()
+        self.unwritten.clear()
+
+    def read_counts(self, channels):
+        '''
+        Sets how many messages each channel has from the message_counts table
+        '''
+        for channel in channels:
+            channel['channel_n_messages'] = 0
+        for channel_id, n in self.db.execute('SELECT channel_id, n FROM message_counts'):
+            if channel_id < len(channels):
+                channels[channel_id]['channel_n_messages'] = n
+
+    def message(self, message_id):
+        '''
+        Returns (channel_id, message) for a message, or None if there is none
+        '''
+        with self.lock:
+            if message_id in self.unwritten:
+                return self.unwritten[message_id]
+            entry = self.cache.get(message_id)
+            if entry is not None:
+                self.cache.move_to_end(message_id)
+                return entry
+            rows = self.db.execute(f'SELECT {MESSAGE_SELECT} FROM messages '
+                                   'WHERE message_id = ?', (message_id,)).fetchall()
+            if not rows:
+                return None
+            entry = (rows[0][2], self._messages(rows)[0])
+            self.cache[message_id] = entry
+            if len(self.cache) > MESSAGE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+            return entry
+
+    def changed(self, message_id, entry):
+        '''
+        Keeps a message's new (channel_id, message), or None once removed,
+        until the record changing it is written
+        '''
+        with self.lock:
+            self.unwritten[message_id] = entry
+            if entry is None:
+                self.cache.pop(message_id, None)
+            else:
+                self.cache[message_id] = entry
+
+    def forget(self, message_id):
+        '''
+        Drops a message changed by another process so it is read again
+        '''
+        with self.lock:
+            self.cache.pop(message_id, None)
+
+    def position(self, message_id):
+        '''
+        Returns (channel_id, position) for a message, positions increase in
+        the order the messages were sent
+        '''
+        with self.lock:
+            return self.db.execute('SELECT channel_id, position FROM messages '
+                                   'WHERE message_id = ?', (message_id,)).fetchone()
+
+    def count_older(self, channel_id, position):
+        '''
+        Returns how many messages of a channel were sent before position
+        '''
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM messages '
+                                   'WHERE channel_id = ? AND position < ?',
+                                   (channel_id, position)).fetchone()[0]
+
+    def latest(self, channel_id, skip, limit):
+        '''
+        Returns up to limit messages sent before the newest skip messages of
+        a channel, oldest first
+        '''
+        return self._page('WHERE channel_id = ? ORDER BY position DESC LIMIT ? OFFSET ?',
+                          (channel_id, limit, skip))[::-1]
+
+    def older(self, channel_id, position, limit):
+        '''
+        Returns up to limit messages of a channel sent just before position,
+        oldest first
+        '''
+        return self._page('WHERE channel_id = ? AND position < ? '
+                          'ORDER BY position DESC LIMIT ?',
+                          (channel_id, position, limit))[::-1]
+
+    def newer(self, channel_id, position, limit):
+        '''
+        Returns up to limit messages of a channel sent just after position,
+        oldest first
+        '''
+        return self._page('WHERE channel_id = ? AND position > ? '
+                          'ORDER BY position LIMIT ?',
+                          (channel_id, position, limit))
+
+    def find(self, u_id, terms):
+        '''
+        Returns (channel_id, position, message) for every message in u_id's
+        channels containing every term, in the order they were sent
+        Terms of N or more characters are looked up in the trigrams
+        '''
+        query = (f'SELECT {MESSAGE_SELECT} FROM messages WHERE channel_id IN '
+                 '(SELECT channel_id FROM members WHERE u_id = ?)')
+        args = [u_id]
+        indexed = [term for term in terms if len(term) >= search_index.N]
+        if self.trigrams and indexed:
+            query += (' AND message_id IN (SELECT rowid FROM message_trigrams '
+                      'WHERE message_trigrams MATCH ?)')
+            args.append(' AND '.join('"' + term.replace('"', '""') + '"'
+                                     for term in indexed))
+        for term in terms:
+            query += ' AND instr(message, ?) > 0'
+            args.append(term)
+        with self.lock:
+            rows = self.db.execute(query + ' ORDER BY position', args).fetchall()
+            return [(row[2], row[0], message)
+                    for row, message in zip(rows, self._messages(rows))]
+
+    def _page(self, where, args):
+        with self.lock:
+            return self._messages(self.db.execute(
+                f'SELECT {MESSAGE_SELECT} FROM messages ' + where, args).fetchall())
+
+    def _messages(self, rows):
+        '''
+        Builds the messages of rows selected with MESSAGE_SELECT, with their
+        reacts
+        '''
+        reacts = {}
+        message_ids = [row[1] for row in rows]
+        for i in range(0, len(message_ids), MAX_VARIABLES):
+            chunk = message_ids[i:i + MAX_VARIABLES]
+            for message_id, react_id, u_id in self.db.execute(
+                    'SELECT * FROM reacts WHERE message_id IN '
+                    f'({",".join("?" * len(chunk))}) ORDER BY rowid', chunk):
+                message_reacts = reacts.setdefault(message_id, [])
+                for react in message_reacts:
+                    if react['react_id'] == react_id:
+                        react['u_ids'].append(u_id)
+                        break
+                else:
+                    message_reacts.append({'react_id' : react_id, 'u_ids' : [u_id]})
+        return [{
+            'message_id' : message_id,
+            'u_id' : u_id,
+            'message' : message,
+            'time_created' : time_created,
+            'reacts' : reacts.get(message_id, []),
+            'is_pinned' : bool(is_pinned)
+        } for _, message_id, _, u_id, message, time_created, is_pinned in rows]
+
+    def append(self, record):
+        '''
+        Nothing is written ahead, the rows are updated once the record is applied
+        '''
+
+    def discard(self, record):
+        '''
+        Nothing was written for a record that could not be applied, the
+        messages it started changing are read again
+        '''
+        with self.lock:
+            for message_id in self.unwritten:
+                self.cache.pop(message_id, None)
+            self.unwritten.clear()
+
+    def applied(self, record, store, rows):
+        '''
+        Writes the rows a record touched in a single transaction
+        '''
+        if self.db is None:
+            return
+        with self.lock, self.transaction():
+            getattr(self, '_write_' + rows)(record)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('n_messages', ?)",
+                            (server_data.data['n_messages'],))
+            if self.shared:
+                self.journal(record)
+            self.recorded[store] = server_data.generations[store]
+
+    def journal(self, record):
+        self.journal_seq = self.db.execute('INSERT INTO journal (record) VALUES (?)',
+                                           (json.dumps(record),)).lastrowid
+
+    def _write_user(self, record):
+        u_id = record['user']['u_id'] if 'user' in record else record['u_id']
+        user = server_data.data['users'][u_id]
+        self.db.execute(f'INSERT OR REPLACE INTO users VALUES ({",".join("?" * 10)})',
+                        tuple(user[column] for column in USER_COLUMNS))
+
+    def _write_channel(self, record):
+        channel = server_data.data['channels'][record['channel']['channel_id']]
+        self.db.execute('INSERT OR REPLACE INTO channels VALUES (?, ?, ?)',
+                        (channel['channel_id'], channel['name'], channel['is_public']))
+        for member in channel['members']:
+            self._write_member({'channel_id' : channel['channel_id'], 'u_id' : member['u_id']})
+
+    def _write_member(self, record):
+        channel_id = int(record['channel_id'])
+        for member in server_data.data['channels'][channel_id]['members']:
+            if member['u_id'] == record['u_id']:
+                self.db.execute('''INSERT INTO members VALUES (?, ?, ?)
+                                   ON CONFLICT (channel_id, u_id)
+                                   DO UPDATE SET channel_permission = excluded.channel_permission''',
+                                (channel_id, member['u_id'], member['channel_permission']))
+                return
+        self.db.execute('DELETE FROM members WHERE channel_id = ? AND u_id = ?',
+                        (channel_id, record['u_id']))
+
+    def _write_message(self, record):
+        message_id = _record_message_id(record)
+        if message_id in self.unwritten:
+            self._write_entry(message_id, self.unwritten.pop(message_id))
+
+    def _write_entry(self, message_id, entry):
+        '''
+        Writes a message's row, reacts, count and trigrams, or deletes them
+        if entry is None
+        '''
+        row = self.db.execute('SELECT channel_id, message FROM messages WHERE message_id = ?',
+                              (message_id,)).fetchone()
+        self.db.execute('DELETE FROM reacts WHERE message_id = ?', (message_id,))
+        if entry is None:
+            if row is not None:
+                self.db.execute('DELETE FROM messages WHERE message_id = ?', (message_id,))
+                self.db.execute('UPDATE message_counts SET n = n - 1 WHERE channel_id = ?',
+                                (row[0],))
+                if self.trigrams:
+                    self.db.execute('DELETE FROM message_trigrams WHERE rowid = ?',
+                                    (message_id,))
+            return
+        channel_id, message = entry
+        self.db.execute('''INSERT INTO messages
+                           (message_id, channel_id, u_id, message, time_created, is_pinned)
+                           VALUES (?, ?, ?, ?, ?, ?)
+                           ON CONFLICT (message_id) DO UPDATE SET
+                           message = excluded.message, is_pinned = excluded.is_pinned''',
+                        (message_id, channel_id, message['u_id'], message['message'],
+                         message['time_created'], message['is_pinned']))
+        if row is None:
+            self.db.execute('''INSERT INTO message_counts VALUES (?, 1)
+                               ON CONFLICT (channel_id) DO UPDATE SET n = n + 1''',
+                            (channel_id,))
+        # only edits change the text, reacts and pins leave the trigrams alone
+        if self.trigrams and (row is None or row[1] != message['message']):
+            self.db.execute('DELETE FROM message_trigrams WHERE rowid = ?', (message_id,))
+            self.db.execute('INSERT INTO message_trigrams (rowid, message) VALUES (?, ?)',
+                            (message_id, message['message']))
+        for react in message['reacts']:
+            for u_id in react['u_ids']:
+                self.db.execute('INSERT INTO reacts VALUES (?, ?, ?)',
+                                (message_id, react['react_id'], u_id))
+
+    def _write_later(self, record):
+        message_id = _record_message_id(record)
+        for message in server_data.messages_later:
+            if message['message_id'] == message_id:
+                self.db.execute('INSERT OR REPLACE INTO later VALUES (?, ?)',
+                                (message_id, json.dumps(message)))
+                return
+        self.db.execute('DELETE FROM later WHERE message_id = ?', (message_id,))
+
+    def _write_standup(self, record):
+        channel_id = int(record['standup']['channel_id'] if 'standup' in record else
+                         record['channel_id'])
+        for standup in server_data.standups:
+            if int(standup['channel_id']) == channel_id:
+                self.db.execute('''INSERT INTO standups (channel_id, standup) VALUES (?, ?)
+                                   ON CONFLICT (channel_id)
+                                   DO UPDATE SET standup = excluded.standup''',
+                                (channel_id, json.dumps(standup)))
+                return
+        self.db.execute('DELETE FROM standups WHERE channel_id = ?', (channel_id,))
+
+    def save_job(self, job, expired):
+        '''
+        Stores the status of an image job so any process can report it, and
+        drops jobs last changed before expired
+        '''
+        if self.db is None:
+            return
+        with self.lock, self.transaction():
+            self.db.execute('INSERT OR REPLACE INTO image_jobs VALUES (?, ?, ?, ?, ?)',
+                            (job['job_id'], job['u_id'], job['status'], job['error'],
+                             time.time()))
+            self.db.execute("DELETE FROM image_jobs WHERE updated < ? "
+                            "AND status IN ('done', 'failed')", (expired,))
+
+    def load_job(self, job_id):
+        '''
+        Returns the status of an image job stored by any process, or None
+        '''
+        with self.lock:
+            if self.db is None:
+                return None
+            row = self.db.execute('SELECT job_id, u_id, status, error FROM image_jobs '
+                                  'WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('job_id', 'u_id', 'status', 'error'), row))
+
+    def sync(self):
+        '''
+        Every record is committed as it is applied
+        '''
+
+    def write(self, stores):
+        '''
+        Rewrites every table of a store that changed without a record, such as
+        after the data is reset
+        '''
+        with self.lock, self.transaction():
+            if self.shared:
+                self.prune()
+            stale = [store for store in stores
+                     if self.recorded.get(store) != server_data.generations[store]]
+            if not stale:
+                return
+            self._write_stores(stale)
+            if self.shared:
+                # other processes cannot replay this, they read it all again
+                self.journal(RELOAD)
+            for store in stale:
+                self.recorded[store] = server_data.generations[store]
+
+    def prune(self):
+        '''
+        Drops journal entries older than the last JOURNAL_KEEP
+        '''
+        pruned = self.last_journal_seq() - JOURNAL_KEEP
+        if pruned > 0:
+            self.db.execute('DELETE FROM journal WHERE seq <= ?', (pruned,))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('journal_pruned', ?)",
+                            (pruned,))
+
+    def _write_stores(self, stale):
+        if 'data' in stale:
+            for table in ('users', 'channels', 'members'):
+                self.db.execute(f'DELETE FROM {table}')
+            # the messages are only in memory while the json stores are imported
+            if not self.serving:
+                self.clear_messages()
+            for user in server_data.data['users']:
+                self._write_user({'u_id' : user['u_id']})
+            for channel in server_data.data['channels']:
+                self._write_channel({'channel' : channel})
+                if not self.serving:
+                    for message in channel['messages']:
+                        self._write_entry(message['message_id'],
+                                          (channel['channel_id'], message))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('n_messages', ?)",
+                            (server_data.data['n_messages'],))
+        if 'messages_later' in stale:
+            self.db.execute('DELETE FROM later')
+            for message in server_data.messages_later:
+                self._write_later({'message' : message})
+        if 'standups' in stale:
+            self.db.execute('DELETE FROM standups')
+            for standup in server_data.standups:
+                self._write_standup({'standup' : standup})
+
+    def clear_messages(self):
+        '''
+        Deletes every message, called when the data is reset
+        '''
+        with self.lock, self.transaction():
+            for table in ('messages', 'message_counts', 'reacts'):
+                self.db.execute(f'DELETE FROM {table}')
+            if self.trigrams:
+                self.db.execute('DELETE FROM message_trigrams')
+            self.cache.clear()
+            self.unwritten.clear()
+            if self.shared and self.serving:
+                self.journal(RELOAD)
+
+    def close(self):
+        '''
+        Closes the database
+        '''
+        self.serving = False
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -1,8 +1,13 @@
 ''' auth_py pytests '''
+import hashlib
 import pytest
 from server.auth import auth_register, auth_login, auth_logout, auth_passwordreset_request
 from server.auth import auth_passwordreset_reset, admin_userpermission_change, hash_pw
-from server.helper import reset_data, token_to_user, server_data, AccessError
+from server.user_profile import user_profile_sethandle
+from server import passwords
+from server.mail import OUTBOX
+from server.passwords import check_password, needs_rehash
+from server.helper import reset_data, token_to_user, server_data, AccessError, is_valid_token
 
 
 # ======================= TESTS - AUTHORISATION ============================= #
@@ -94,6 +99,43 @@ def test_logout():
     auth_login("b@email.com", "strong_pw")
     assert not auth_logout("wrong_token")['is_success']
 
+@pytest.mark.acc
+def test_sessions():
+    ''' Tests the session registry follows register, login and logout '''
+    reset_data()
+    output = auth_register("s@email.com", "strong_pw", "A", "AA")
+    assert server_data.sessions == {output['token']: output['u_id']}
+    is_valid_token(output['token'])
+
+    # a logged out token is no longer valid
+    auth_logout(output['token'])
+    assert server_data.sessions == {}
+    with pytest.raises(AccessError):
+        is_valid_token(output['token'])
+    assert not auth_logout(output['token'])['is_success']
+
+    # logging back in starts a new session
+    token = auth_login("s@email.com", "strong_pw")['token']
+    is_valid_token(token)
+    assert token_to_user(token) == output['u_id']
+
+@pytest.mark.acc
+def test_handles():
+    ''' Tests new users with the same name are given unique handles '''
+    reset_data()
+    outputs = [auth_register(str(i) + "@email.com", "strong_pw", "John", "Smith")
+               for i in range(4)]
+    u_ids = [output['u_id'] for output in outputs]
+    handles = [server_data.data['users'][u_id]['handle_str'] for u_id in u_ids]
+    assert handles == ['johnsmith', 'johnsmith1', 'johnsmith2', 'johnsmith3']
+    assert server_data.user_handles['johnsmith2'] == {u_ids[2]}
+    assert server_data.user_emails['3@email.com'] == u_ids[3]
+
+    # numbering skips handles other users have taken
+    user_profile_sethandle(outputs[1]['token'], 'johnsmith4')
+    u_id = auth_register("4@email.com", "strong_pw", "John", "Smith")['u_id']
+    assert server_data.data['users'][u_id]['handle_str'] == 'johnsmith5'
+
 # ----------------- Testing auth_passwordreset_request() -------------------- #
 
 @pytest.mark.reset
@@ -123,6 +165,12 @@ def test_reset_req():
 
     assert server_data.data["users"][0]['reset_token'] is not None
 
+    # the code is queued to be mailed, replacing any older code still queued
+    auth_passwordreset_request("xxxleothelionrawrxxx@gmail.com")
+    mail = OUTBOX.pending[('reset', 0)]
+    assert mail['to'] == "xxxleothelionrawrxxx@gmail.com"
+    assert mail['body'].endswith(server_data.data["users"][0]['reset_token'])
+
 # ------------------ Testing auth_passwordreset_reset() --------------------- #
 
 @pytest.mark.reset
@@ -150,7 +198,31 @@ def test_reset_reset():
     print(server_data.data["users"][0]['reset_token'])
     print(reset_code)
     auth_passwordreset_reset(reset_code, "newpassword")
-    assert server_data.data["users"][0]['password'] == hash_pw("newpassword")
+    assert check_password("newpassword", server_data.data["users"][0]['password'])
+    assert not check_password("testpass", server_data.data["users"][0]['password'])
+
+@pytest.mark.reset
+def test_rehash(monkeypatch):
+    ''' Tests passwords are rehashed on login when the cost changes '''
+    reset_data()
+    auth_register("rehash@email.com", "strong_pw", "A", "AA")
+    stored = server_data.data["users"][0]['password']
+    assert stored != hash_pw("strong_pw")
+    assert not needs_rehash(stored)
+
+    # an older version's unsalted hash still logs in and is replaced
+    server_data.data["users"][0]['password'] = hashlib.sha256(b"strong_pw").hexdigest()
+    auth_login("rehash@email.com", "strong_pw")
+    assert server_data.data["users"][0]['password'].startswith('pbkdf2_sha256$')
+
+    # as is a hash made at a different cost
+    monkeypatch.setattr(passwords, 'ITERATIONS', passwords.ITERATIONS + 1)
+    assert needs_rehash(server_data.data["users"][0]['password'])
+    auth_login("rehash@email.com", "strong_pw")
+    assert not needs_rehash(server_data.data["users"][0]['password'])
+    with pytest.raises(ValueError):
+        auth_login("rehash@email.com", "wrong_pw")
+    assert passwords.stats()['check']['runs'] >= 3
 
 @pytest.mark.admin
 def test_admin_change():
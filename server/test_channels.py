@@ -1,13 +1,15 @@
 '''tests'''
 import sys
 import pytest
+import server_data
 from server.channels import channel_join, channel_leave, channel_addowner, channel_removeowner
 from server.channels import channel_invite, channel_messages, channel_details, channels_list
-from server.channels import channels_listall, channel_create
+from server.channels import channels_listall, channel_create, channels_listall_page
 from server.helper import token_to_user, AccessError, reset_data, is_slackr_admin
-from server.helper import  check_channel_member
+from server.helper import  check_channel_member, is_owner, rebuild_indexes
 from server.auth import auth_register
-from server.messages import message_send, message_react
+from server.user_profile import user_profile_setname
+from server.messages import message_send, message_react, message_unreact, message_remove
 sys.path.append("../")
 
 
@@ -202,6 +204,54 @@ def test_channel_invite():
     with pytest.raises(ValueError):
         channel_invite(token, channel_id_private, third_user_id)
 
+def test_membership_indexes():
+    '''
+    Testing that the membership indexes follow every change to a channel
+    '''
+    reset_data()
+    # START SETUP
+    token = auth_register('abcd@email.com', 'pass123', 'john', 'apple')['token']
+    creator_id = token_to_user(token)
+    second_token = auth_register('newUser@email.com', 'pass147', 'vicks', 'uwu')['token']
+    second_user_id = token_to_user(second_token)
+    third_token = auth_register('thirdUser@email.com', 'pass134124', 'lol', 'lmao')['token']
+    third_user_id = token_to_user(third_token)
+    channel_id = channel_create(token, 'newChannel', 'true')
+    # END SETUP
+
+    assert is_owner(creator_id, channel_id)
+    assert not check_channel_member(second_user_id, channel_id)
+
+    channel_join(second_token, channel_id)
+    channel_invite(token, channel_id, third_user_id)
+    channel_addowner(token, channel_id, second_user_id)
+    assert server_data.channel_members[channel_id] == {creator_id, second_user_id, third_user_id}
+    assert server_data.channel_owners[channel_id] == {creator_id, second_user_id}
+    assert server_data.user_channels[third_user_id] == {channel_id}
+
+    channel_removeowner(token, channel_id, second_user_id)
+    channel_leave(third_token, channel_id)
+    assert not is_owner(second_user_id, channel_id)
+    assert not check_channel_member(third_user_id, channel_id)
+    assert third_user_id not in server_data.user_channels
+
+    # joining twice changes nothing, so one leave takes the user out of the channel
+    channel_join(third_token, channel_id)
+    channel_join(third_token, channel_id)
+    assert server_data.data['users'][third_user_id]['channels'].count(channel_id) == 1
+    channel_leave(third_token, channel_id)
+    assert not check_channel_member(third_user_id, channel_id)
+    assert channel_id not in server_data.data['users'][third_user_id]['channels']
+    assert third_user_id not in [member['u_id'] for member in
+                                 server_data.data['channels'][channel_id]['members']]
+
+    # the indexes rebuilt from the stores match the ones kept up to date
+    indexes = (server_data.channel_members, server_data.channel_owners,
+               server_data.user_channels)
+    rebuild_indexes()
+    assert (server_data.channel_members, server_data.channel_owners,
+            server_data.user_channels) == indexes
+
 
 def test_channel_messages():
     '''
@@ -248,6 +298,81 @@ def test_channel_messages():
     channel_messages(token, channel_id_public, 50)
     channel_messages(token, channel_id_public, 100)
 
+def test_channel_messages_reacts():
+    '''
+    Testing each user sees whether they reacted without the stored message changing
+    '''
+    reset_data()
+    # START SETUP
+    token = auth_register('abcd@email.com', 'pass123', 'john', 'apple')['token']
+    second_token = auth_register('newUser@email.com', 'pass147', 'vicks', 'uwu')['token']
+    channel_id = channel_create(token, 'newChannel', 'true')
+    channel_join(second_token, channel_id)
+    message_id = message_send(token, channel_id, 'Hello')
+    message_react(second_token, message_id, 1)
+    # END SETUP
+
+    react = channel_messages(token, channel_id, 0)['messages'][0]['reacts'][0]
+    second_react = channel_messages(second_token, channel_id, 0)['messages'][0]['reacts'][0]
+    assert react['is_this_user_reacted'] is False
+    assert second_react['is_this_user_reacted'] is True
+    assert react['u_ids'] == second_react['u_ids'] == [1]
+
+    stored = server_data.data['channels'][channel_id]['messages'][0]
+    assert stored['reacts'] == [{'react_id' : 1, 'u_ids' : [1]}]
+
+    message_unreact(second_token, message_id, 1)
+    second_react = channel_messages(second_token, channel_id, 0)['messages'][0]['reacts'][0]
+    assert second_react['is_this_user_reacted'] is False
+
+def test_channel_messages_cursor():
+    '''
+    Testing paging through channel_messages with cursors while messages arrive
+    '''
+    reset_data()
+    # START SETUP
+    token = auth_register('abcd@email.com', 'pass123', 'john', 'apple')['token']
+    channel_id = channel_create(token, 'newChannel', 'true')
+    for counter in range(120):
+        message_send(token, channel_id, str(counter))
+    # END SETUP
+
+    def texts(page):
+        return [message['message'] for message in page['messages']]
+
+    first = channel_messages(token, channel_id, 0)
+    assert texts(first) == [str(counter) for counter in range(119, 69, -1)]
+    assert (first['start'], first['end']) == (0, 50)
+    assert first['newer'] is not None
+
+    # new messages do not shift the next page
+    message_send(token, channel_id, 'new')
+    second = channel_messages(token, channel_id, 0, first['older'], 30)
+    assert texts(second) == [str(counter) for counter in range(69, 39, -1)]
+    assert (second['start'], second['end']) == (51, 81)
+
+    last = channel_messages(token, channel_id, 0, second['older'], 100)
+    assert texts(last) == [str(counter) for counter in range(39, -1, -1)]
+    assert last['end'] == -1
+    assert last['older'] is None
+
+    # paging forward picks up what was sent since
+    newer = channel_messages(token, channel_id, 0, first['newer'])
+    assert texts(newer) == ['new']
+    caught_up = channel_messages(token, channel_id, 0, newer['newer'])
+    assert caught_up['messages'] == []
+    assert caught_up['newer'] == newer['newer']
+
+    # a removed message still marks its place
+    message_remove(token, newer['messages'][0]['message_id'])
+    message_send(token, channel_id, 'newest')
+    assert texts(channel_messages(token, channel_id, 0, newer['newer'])) == ['newest']
+
+    with pytest.raises(ValueError):
+        channel_messages(token, channel_id, 0, 'not a cursor')
+    with pytest.raises(ValueError):
+        channel_messages(token, channel_id, 0, None, 500)
+
 def test_channel_details():
     '''
     Testing cases of channel_details
@@ -275,6 +400,46 @@ def test_channel_details():
     channel_details(token, channel_id_public)
     channel_details(second_token, channel_id_public)
 
+def test_channel_details_cache():
+    '''
+    Testing channel_details follows changes to members, owners and profiles
+    '''
+    reset_data()
+    # START SETUP
+    token = auth_register('abcd@email.com', 'pass123', 'john', 'apple')['token']
+    second_token = auth_register('newUser@email.com', 'pass147', 'vicks', 'uwu')['token']
+    second_user_id = token_to_user(second_token)
+    channel_id = channel_create(token, 'newChannel', 'true')
+    # END SETUP
+
+    def members(key):
+        return [member['u_id'] for member in channel_details(token, channel_id)[key]]
+
+    assert members('all_members') == [0]
+    channel_join(second_token, channel_id)
+    assert members('all_members') == [0, second_user_id]
+    channel_addowner(token, channel_id, second_user_id)
+    assert members('owner_members') == [0, second_user_id]
+    channel_removeowner(token, channel_id, second_user_id)
+    assert members('owner_members') == [0]
+
+    user_profile_setname(second_token, 'victoria', 'uwu')
+    names = [member['name_first'] for member in channel_details(token, channel_id)['all_members']]
+    assert names == ['john', 'victoria']
+
+    # paging through the members
+    page = channel_details(token, channel_id, 0, 1)
+    assert [member['u_id'] for member in page['all_members']] == [0]
+    assert (page['start'], page['end']) == (0, 1)
+    page = channel_details(token, channel_id, page['end'], 1)
+    assert [member['u_id'] for member in page['all_members']] == [second_user_id]
+    assert page['end'] == -1
+    with pytest.raises(ValueError):
+        channel_details(token, channel_id, 0, 0)
+
+    channel_leave(second_token, channel_id)
+    assert members('all_members') == [0]
+
 
 def test_channels_list():
     '''
@@ -316,6 +481,27 @@ def test_channels_listall():
     channels_listall(token)
     channels_listall(second_token)
 
+def test_channels_listall_page():
+    '''
+    Testing paging through the public channels matching a prefix
+    '''
+    reset_data()
+    token = auth_register('abcd@email.com', 'pass123', 'john', 'apple')['token']
+    general = channel_create(token, 'General', 'true')
+    games = channel_create(token, 'games', 'true')
+    channel_create(token, 'gossip', 'false')
+    channel_create(token, 'random', 'true')
+
+    output = channels_listall_page(token, 'G', None, 1)
+    assert output['channels'] == [{'channel_id' : games, 'name' : 'games'}]
+    output = channels_listall_page(token, 'G', output['next'], 1)
+    assert output['channels'] == [{'channel_id' : general, 'name' : 'General'}]
+    assert output['next'] is None
+    assert len(channels_listall_page(token)['channels']) == 3
+
+    with pytest.raises(ValueError):
+        channels_listall_page(token, 'g', 'not a cursor')
+
 def test_invalid_channel_create():
     '''
     Testing error cases of channel_create
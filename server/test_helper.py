@@ -107,3 +107,71 @@ def test_is_members():
     # Invalid name_last
     with pytest.raises(ValueError):
         is_members([{"u_id": 1, "name_first": "first1", "name_last": 789}, {"u_id": 2, "name_first": "first2", "name_last": "last2"}])
+
+# Testing the message index
+
+def test_message_index():
+    from server.channels import channel_create
+    from server.messages import message_send, message_remove
+    reset_data()
+    token = auth_register("test@email.com", "validPW", "tom", "cruise")['token']
+    c_id = channel_create(token, "Channel1", 'true')
+    msg1_id = message_send(token, c_id, "Hello world!")
+    msg2_id = message_send(token, c_id, "another message")
+
+    assert get_msg_dict(msg2_id)['message'] == "another message"
+    assert msg_to_channel(msg1_id)['channel_id'] == c_id
+
+    message_remove(token, msg1_id)
+    assert get_msg_dict(msg1_id) is None
+    assert msg_to_channel(msg1_id) is None
+    assert get_msg_dict(msg2_id)['message'] == "another message"
+
+    # rebuilt from the channels on reset
+    reset_data()
+    assert get_msg_dict(msg2_id) is None
+
+# Testing tokens of users who logged out
+
+def test_logged_out_token():
+    from server.auth import auth_logout
+    from server.channels import channel_create, channel_messages
+    reset_data()
+    token = auth_register("test@email.com", "validPW", "tom", "cruise")['token']
+    c_id = channel_create(token, "Channel1", 'true')
+    assert channel_messages(token, c_id, 0)['messages'] == []
+
+    # the token still decodes but no longer belongs to a session
+    auth_logout(token)
+    assert decode_token(token)['u_id'] == 0
+    with pytest.raises(AccessError):
+        token_to_user(token)
+    with pytest.raises(AccessError):
+        channel_messages(token, c_id, 0)
+
+def test_rotate_secret():
+    from server.auth import auth_login
+    from server.channels import channels_list
+    reset_data()
+    token = auth_register("test@email.com", "validPW", "tom", "cruise")['token']
+    token2 = auth_register("test2@email.com", "validPW", "tim", "cruise")['token']
+    assert channels_list(token) == []
+    rotate_secret("anotherSecret")
+    try:
+        # every user is logged out and their tokens no longer work
+        assert server_data.sessions == {}
+        for old_token in (token, token2):
+            with pytest.raises(AccessError):
+                channels_list(old_token)
+            with pytest.raises(AccessError):
+                token_to_user(old_token)
+            with pytest.raises(jwt.InvalidSignatureError):
+                decode_token(old_token)
+
+        # logging in again gives a token signed with the new secret
+        new_token = auth_login("test@email.com", "validPW")['token']
+        assert new_token != token
+        assert channels_list(new_token) == []
+        assert token_to_user(new_token) == 0
+    finally:
+        rotate_secret("tempSecret")
@@ -0,0 +1,162 @@
+''' tests for images'''
+import functools
+import http.server
+import io
+import threading
+import pytest
+from PIL import Image
+from server import images, storage
+
+# ------------------------ Testing cropping images -------------------------- #
+
+def make_image(width, height, fmt='PNG'):
+    '''
+    Returns the bytes of a plain image
+    '''
+    data = io.BytesIO()
+    Image.new('RGBA', (width, height), (255, 0, 0, 255)).save(data, fmt)
+    return data.getvalue()
+
+def test_store(tmp_path, monkeypatch):
+    '''
+    Test a cropped image and its thumbnails are stored under its hash once
+    '''
+    monkeypatch.setattr(images, 'IMAGE_DIR', str(tmp_path))
+    key = images.store(images.process(make_image(200, 100), 10, 20, 110, 70))
+    assert images.is_key(key)
+    with Image.open(str(tmp_path / images.image_name(key))) as img:
+        assert img.format == 'JPEG'
+        assert img.size == (100, 50)
+    for size in images.THUMBNAIL_SIZES:
+        with Image.open(str(tmp_path / images.image_name(key, size))) as img:
+            assert max(img.size) == min(size, 100)
+
+    # uploading the same photo again shares the stored files
+    assert images.store(images.process(make_image(200, 100), 10, 20, 110, 70)) == key
+    other = images.store(images.process(make_image(200, 100), 0, 0, 30, 30))
+    assert other != key
+    names = sorted(path.name for path in tmp_path.iterdir())
+    assert len(names) == 2 * (len(images.THUMBNAIL_SIZES) + 1)
+    assert not [name for name in names if not name.endswith('.jpg')]
+
+    # lists of users show thumbnails of stored photos
+    url = 'http://localhost/' + images.IMAGE_ROUTE + images.image_name(key)
+    assert images.thumbnail_url(url, 64) == url[:-len('.jpg')] + '_64.jpg'
+    assert images.thumbnail_url('') == ''
+    assert images.thumbnail_url('http://elsewhere/photo.jpg') == 'http://elsewhere/photo.jpg'
+
+def test_crop_limits(monkeypatch):
+    '''
+    Test bad bounds, oversized images and data that is not an image
+    '''
+    data = make_image(200, 100)
+    with pytest.raises(ValueError):
+        images.crop(data, 0, 0, 201, 100)
+    with pytest.raises(ValueError):
+        images.crop(data, 100, 0, 50, 100)
+    with pytest.raises(ValueError):
+        images.crop(b'not an image', 0, 0, 1, 1)
+
+    # the size is checked from the header before the image is decoded
+    monkeypatch.setattr(images, 'MAX_PIXELS', 199 * 100)
+    with pytest.raises(ValueError):
+        images.crop(data, 0, 0, 10, 10)
+
+# ------------------------ Testing image jobs -------------------------- #
+
+@pytest.fixture
+def image_server(tmp_path):
+    '''
+    Serves the files in tmp_path over http, returning their base url
+    '''
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(tmp_path))
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:' + str(server.server_address[1]) + '/'
+    server.shutdown()
+
+def test_jobs(tmp_path, image_server, monkeypatch):
+    '''
+    Test uploads run in the background and report how they finished
+    '''
+    monkeypatch.setattr(images, 'IMAGE_DIR', str(tmp_path / 'store'))
+    (tmp_path / 'photo.png').write_bytes(make_image(200, 100))
+    finished = []
+
+    job_id = images.submit(0, image_server + 'photo.png', (0, 0, 50, 50),
+                           on_done=finished.append)
+    job = images.wait(job_id, 10)
+    assert job['status'] == 'done'
+    assert job['error'] is None
+    assert len(finished) == 1
+    with Image.open(str(tmp_path / 'store' / images.image_name(finished[0]))) as img:
+        assert img.size == (50, 50)
+
+    # failures are reported rather than raised, and on_done is not called
+    job_id = images.submit(0, image_server + 'photo.png', (0, 0, 500, 500),
+                           on_done=finished.append)
+    job = images.wait(job_id, 10)
+    assert job['status'] == 'failed'
+    assert 'dimensions' in job['error']
+    job = images.wait(images.submit(0, image_server + 'missing.png', (0, 0, 1, 1)), 10)
+    assert job['error'] == 'Invalid Url'
+    assert len(finished) == 1
+    assert images.job_status('no such job') is None
+
+def test_job_limits(tmp_path, image_server, monkeypatch):
+    '''
+    Test users can only queue a few jobs at once and finished jobs expire
+    '''
+    monkeypatch.setattr(images, 'IMAGE_DIR', str(tmp_path / 'store'))
+    (tmp_path / 'photo.png').write_bytes(make_image(200, 100))
+    url = image_server + 'photo.png'
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocked(key):
+        started.set()
+        release.wait(10)
+
+    # jobs still queued or running count against their user
+    job_ids = [images.submit(1, url, (0, 0, 10, 10), on_done=blocked)
+               for _ in range(images.MAX_QUEUED_PER_USER)]
+    started.wait(10)
+    with pytest.raises(ValueError):
+        images.submit(1, url, (0, 0, 10, 10))
+    other = images.submit(2, url, (0, 0, 10, 10))
+    release.set()
+    for job_id in job_ids + [other]:
+        assert images.wait(job_id, 10)['status'] == 'done'
+    job_ids.append(images.submit(1, url, (0, 0, 10, 10)))
+    assert images.wait(job_ids[-1], 10)['status'] == 'done'
+
+    # finished jobs are forgotten once they expire
+    monkeypatch.setattr(images, 'JOB_TTL', 0)
+    assert images.job_status(other) is None
+    assert not [job_id for job_id in job_ids if images.job_status(job_id) is not None]
+
+def test_shared_jobs(tmp_path, image_server, monkeypatch):
+    '''
+    Test a job can be polled from another process sharing the database
+    '''
+    monkeypatch.setattr(images, 'IMAGE_DIR', str(tmp_path / 'store'))
+    (tmp_path / 'photo.png').write_bytes(make_image(200, 100))
+    path = str(tmp_path / 'slackr.db')
+    here = storage.SqliteStorage(path, shared=True)
+    here.connect()
+    monkeypatch.setattr(images, '_shared', here)
+
+    job_id = images.submit(0, image_server + 'photo.png', (0, 0, 10, 10))
+    assert images.wait(job_id, 10)['status'] == 'done'
+
+    # another process only has the job in the database
+    there = storage.SqliteStorage(path, shared=True)
+    there.connect()
+    monkeypatch.setattr(images, '_shared', there)
+    monkeypatch.setattr(images, '_jobs', {})
+    assert images.job_status(job_id) == {'job_id' : job_id, 'u_id' : 0,
+                                         'status' : 'done', 'error' : None}
+    assert images.job_status('no such job') is None
+    here.close()
+    there.close()
@@ -0,0 +1,118 @@
+''' tests for locks'''
+import threading
+import time as t
+import pytest
+import server_data
+from server import locks
+from server.locks import RWLock
+from server.auth import auth_register
+from server.channels import channel_create, channel_join
+from server.messages import message_send, message_react, message_sendlater, search
+from server.helper import reset_data, check_latermessages, check_standups
+
+# ------------------------ Testing the readers-writer lock -------------------------- #
+
+def test_readers_share():
+    '''
+    Test readers hold the lock together and a writer waits for them
+    '''
+    lock = RWLock()
+    inside = []
+    release = threading.Event()
+
+    def reader():
+        with lock.read():
+            inside.append(1)
+            release.wait(1)
+
+    readers = [threading.Thread(target=reader) for _ in range(3)]
+    for thread in readers:
+        thread.start()
+    t.sleep(0.1)
+    assert len(inside) == 3
+
+    wrote = threading.Event()
+
+    def writer():
+        with lock.write():
+            wrote.set()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    assert not wrote.wait(0.1)
+    release.set()
+    assert wrote.wait(1)
+    for thread in readers:
+        thread.join()
+
+def test_reentrant():
+    '''
+    Test both sides are reentrant and a writer may read, but readers cannot upgrade
+    '''
+    lock = RWLock()
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                pass
+    with lock.read():
+        with lock.read():
+            with pytest.raises(RuntimeError):
+                lock.acquire_write()
+    with lock.write():
+        pass
+
+# ------------------------ Testing concurrent requests -------------------------- #
+
+def test_concurrent_sends(monkeypatch):
+    '''
+    Test messages sent at once in several channels each get their own id
+    '''
+    monkeypatch.setattr(locks, 'PER_CHANNEL', True)
+    reset_data()
+    token = auth_register('test@gmail.com', '123456', 'John', 'Smith')['token']
+    token2 = auth_register('test2@gmail.com', '123456', 'Jane', 'Smith')['token']
+    channels = [channel_create(token, 'Channel' + str(i), 'true') for i in range(4)]
+    for c_id in channels:
+        channel_join(token2, c_id)
+
+    def send(c_id):
+        for i in range(50):
+            message_react(token2, message_send(token, c_id, 'hello ' + str(i)), 1)
+
+    threads = [threading.Thread(target=send, args=(c_id,)) for c_id in channels]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    message_ids = [message['message_id'] for c_id in channels
+                   for message in server_data.data['channels'][c_id]['messages']]
+    assert sorted(message_ids) == list(range(200))
+    assert server_data.data['n_messages'] == 200
+    assert len(search(token, 'hello')['messages']) == 200
+
+def test_idle_checks(monkeypatch):
+    '''
+    Test the scheduled checks only take the write lock when something is due
+    '''
+    reset_data()
+    token = auth_register('test@gmail.com', '123456', 'John', 'Smith')['token']
+    c_id = channel_create(token, 'Channel1', 'true')
+    message_sendlater(token, c_id, 'later', t.time() + 1)
+
+    writes = []
+    write = locks._write
+    def counted_write():
+        writes.append(1)
+        return write()
+    monkeypatch.setattr(locks, '_write', counted_write)
+
+    check_latermessages()
+    check_standups()
+    assert writes == []
+    assert len(server_data.messages_later) == 1
+
+    t.sleep(1.1)
+    check_latermessages()
+    assert len(writes) == 1
+    assert server_data.messages_later == []
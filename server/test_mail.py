@@ -0,0 +1,78 @@
+''' tests for outgoing mail'''
+import json
+import time as t
+from server.mail import Outbox, FileTransport
+
+# ------------------------ Testing the outbox -------------------------- #
+
+class FlakyTransport:
+    '''
+    Fails every mail to a given address until told otherwise
+    '''
+    def __init__(self, failing):
+        self.failing = failing
+        self.batches = []
+
+    def send(self, mails):
+        self.batches.append([mail['to'] for mail in mails])
+        return [mail for mail in mails if mail['to'] == self.failing]
+
+def test_outbox_batches(tmp_path):
+    '''
+    Test mail is sent in batches and newer mail replaces older under a key
+    '''
+    path = tmp_path / 'mail.log'
+    outbox = Outbox(FileTransport(str(path)), batch_size=2)
+    outbox.send('a@email.com', 'Password Reset', 'code 1', key=('reset', 0))
+    outbox.send('b@email.com', 'Hello', 'hi')
+    outbox.send('a@email.com', 'Password Reset', 'code 2', key=('reset', 0))
+    outbox.send('c@email.com', 'Hello', 'hi')
+
+    assert outbox.dispatch() == 2
+    assert outbox.dispatch() == 1
+    assert outbox.dispatch() == 0
+    mails = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(mail['to'], mail['body']) for mail in mails] == [
+        ('a@email.com', 'code 2'), ('b@email.com', 'hi'), ('c@email.com', 'hi')]
+    stats = outbox.stats()
+    assert stats['sent'] == 3
+    assert stats['replaced'] == 1
+    assert stats['batches'] == 2
+
+def test_outbox_retries():
+    '''
+    Test failed mail is retried with a delay and given up on eventually
+    '''
+    transport = FlakyTransport('bad@email.com')
+    outbox = Outbox(transport, attempts=3, retry_delay=0.01)
+    outbox.send('bad@email.com', 'Hello', 'hi')
+    outbox.send('good@email.com', 'Hello', 'hi')
+    outbox.start()
+    t.sleep(0.3)
+    outbox.stop()
+
+    # the first attempt and two retries
+    assert transport.batches == [['bad@email.com', 'good@email.com'],
+                                 ['bad@email.com'], ['bad@email.com']]
+    stats = outbox.stats()
+    assert stats['sent'] == 1
+    assert stats['retried'] == 2
+    assert stats['failed'] == 1
+    assert stats['pending'] == stats['retrying'] == 0
+
+def test_outbox_thread(tmp_path):
+    '''
+    Test the outbox thread sends mail as it is queued and stops cleanly
+    '''
+    path = tmp_path / 'mail.log'
+    outbox = Outbox(FileTransport(str(path)))
+    outbox.start()
+    outbox.send('a@email.com', 'Hello', 'hi')
+    t.sleep(0.1)
+    assert len(path.read_text().splitlines()) == 1
+
+    # mail still queued when stopping is sent on the way out
+    outbox.stop()
+    outbox.send('b@email.com', 'Hello', 'hi')
+    outbox.stop()
+    assert len(path.read_text().splitlines()) == 2
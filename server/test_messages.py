@@ -6,9 +6,9 @@ from server.auth import auth_register, auth_logout, admin_userpermission_change
 from server.channels import channel_create, channel_addowner, channel_join
 from server.messages import message_send, message_sendlater, message_edit
 from server.messages import message_remove, message_react, message_unreact
-from server.messages import message_pin, message_unpin, search
+from server.messages import message_pin, message_unpin, search, search_terms
 from server.helper import get_messages, find_message, reset_data, check_later
-from server.helper import AccessError, get_message_id
+from server.helper import AccessError, get_message_id, check_latermessages
 
 # ------------------------ Testing message_send -------------------------- #
 
@@ -167,6 +167,31 @@ def test_simple_sendlater():
     # Assert message is in channel
     assert check_later(msg_id3) is msg_id3
 
+def test_sendlater_delivery(monkeypatch):
+    '''
+    Test every message that is due is sent once, in order, even after a missed tick
+    '''
+    reset_data()
+
+    # SETUP
+    token = auth_register('test@gmail.com', '123456', 'John', 'Smith')['token']
+    c_id = channel_create(token, 'Channel1', 'true')
+    now = int(t.time())
+    later_id = message_sendlater(token, c_id, 'third', now + 30)
+    second_id = message_sendlater(token, c_id, 'second', now + 3)
+    first_id = message_sendlater(token, c_id, 'first', now + 2)
+    # SETUP END
+
+    # ticks for the due times were missed
+    monkeypatch.setattr(t, 'time', lambda: now + 10)
+    check_latermessages()
+    assert [message['message_id'] for message in get_messages(c_id)] == [first_id, second_id]
+    assert [message['message_id'] for message in server_data.messages_later] == [later_id]
+
+    # nothing is sent twice
+    check_latermessages()
+    assert len(get_messages(c_id)) == 2
+
 def test_sendlater_cap():
     '''
     Test sending a message later at the maximum character limit (1000)
@@ -958,3 +983,92 @@ def test_search_simple():
 
     for message in messages:
         assert "Hello" in message['message']
+
+def test_search_substring():
+    '''
+    Test search matches any part of a message exactly like checking every message
+    '''
+    reset_data()
+
+    # SETUP
+
+    token = auth_register('test@gmail.com', '123456', 'John', 'Smith')['token']
+    token2 = auth_register('test2@gmail.com', '123456', 'Jane', 'Smith')['token']
+
+    c_id = channel_create(token, 'Channel1', 'true')
+    c_id2 = channel_create(token2, 'Channel2', 'true')
+    c_id3 = channel_create(token, 'Channel3', 'true')
+    channel_join(token2, c_id)
+
+    msg1_id = message_send(token, c_id, 'the quick brown fox')
+    msg2_id = message_send(token2, c_id2, 'Brown bears are quick')
+    msg3_id = message_send(token2, c_id, 'quickly now')
+    message_send(token, c_id3, 'quick brown fox in a channel Jane is not in')
+    message_send(token2, c_id2, 'ok')
+
+    # SETUP END
+
+    def scan(query_str):
+        matching = []
+        for channel_id in server_data.data['users'][1]['channels']:
+            for message in server_data.data['channels'][channel_id]['messages']:
+                if query_str in message['message']:
+                    matching.append(message['message_id'])
+        return matching
+
+    def search_ids(token, query_str):
+        return [message['message_id'] for message in search(token, query_str)['messages']]
+
+    for query_str in ['quick', 'uick', 'Brown', 'brown', 'own', 'k', 'ok', 'o',
+                      'quick brown', 'fox in', 'the quick brown fox', 'zebra']:
+        assert search_ids(token2, query_str) == scan(query_str)
+
+    # parts of words match, in the order the channels and messages were listed
+    assert search_ids(token2, 'uick') == [msg2_id, msg1_id, msg3_id]
+
+    message_edit(token, msg1_id, 'the slow brown fox')
+    assert search_ids(token2, 'quick') == scan('quick')
+    assert search_ids(token2, 'slow') == scan('slow')
+
+    message_remove(token2, msg3_id)
+    assert search_ids(token2, 'quick') == scan('quick')
+
+def test_search_terms():
+    '''
+    Test searching for messages holding every term or quoted phrase of a query
+    '''
+    reset_data()
+
+    # SETUP
+
+    token = auth_register('test@gmail.com', '123456', 'John', 'Smith')['token']
+    token2 = auth_register('test2@gmail.com', '123456', 'Jane', 'Smith')['token']
+
+    c_id = channel_create(token, 'Channel1', 'true')
+    c_id2 = channel_create(token2, 'Channel2', 'true')
+    channel_join(token, c_id2)
+
+    msg1_id = message_send(token2, c_id2, 'the quick brown fox')
+    msg2_id = message_send(token, c_id, 'a brown dog is quick')
+    msg3_id = message_send(token, c_id, 'quickly, brown it')
+    message_send(token2, c_id2, 'quick as a fox')
+
+    # SETUP END
+
+    def search_ids(query_str):
+        return [message['message_id'] for message in search_terms(token, query_str)['messages']]
+
+    # every term must match, as part of a word or all of it, oldest first
+    assert search_ids('brown quick') == [msg1_id, msg2_id, msg3_id]
+    assert search_ids('uick own') == [msg1_id, msg2_id, msg3_id]
+    assert search_ids('brown quick dog') == [msg2_id]
+    assert search_ids('brown zebra') == []
+
+    # phrases match their words in order
+    assert search_ids('"quick brown"') == [msg1_id]
+    assert search_ids('"brown quick"') == []
+    assert search_ids('"is quick" brown') == [msg2_id]
+
+    # terms too short to look up are still matched
+    assert search_ids('ck it') == [msg3_id]
+    assert search_ids('""') == []
@@ -0,0 +1,461 @@
+''' tests for persistence'''
+import json
+import multiprocessing
+import time
+import pytest
+import server_data
+from server import persistence, storage, search_index
+from server.auth import auth_register
+from server.channels import channel_create, channel_join, channel_messages
+from server.messages import message_send, message_react, message_remove, message_sendlater
+from server.messages import message_edit, search, search_terms
+from server.helper import reset_data, check_latermessages
+
+# ------------------------ Testing the write-ahead log -------------------------- #
+
+def make_workspace():
+    '''
+    Registers two users with a few messages in a shared channel
+    '''
+    token = auth_register('test@gmail.com', '123456', 'John', 'Smith')['token']
+    token2 = auth_register('test2@gmail.com', '123456', 'Jane', 'Smith')['token']
+    c_id = channel_create(token, 'Channel1', 'true')
+    channel_join(token2, c_id)
+    msg_id = message_send(token, c_id, 'Hello world!')
+    message_send(token2, c_id, 'another message')
+    message_react(token2, msg_id, 1)
+    return token, c_id
+
+def test_replay(tmp_path, monkeypatch):
+    '''
+    Test that replaying the log rebuilds the same state
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.load()
+    make_workspace()
+    expected = json.dumps(server_data.data)
+    persistence.close()
+
+    # one record per mutation
+    with open(storage.LOG_PATH) as FILE:
+        ops = [json.loads(line)['op'] for line in FILE]
+    assert ops == ['auth_register', 'auth_register', 'channel_create', 'channel_join',
+                   'message_send', 'message_send', 'message_react']
+
+    sessions = dict(server_data.sessions)
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert json.dumps(server_data.data) == expected
+    assert server_data.sessions == sessions
+
+def test_checkpoint(tmp_path, monkeypatch):
+    '''
+    Test that a checkpoint truncates the log and replay continues after it
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.load()
+    token, c_id = make_workspace()
+    persistence.checkpoint()
+    assert (tmp_path / storage.LOG_PATH).read_text() == ''
+
+    message_remove(token, message_send(token, c_id, 'third'))
+    expected = json.dumps(server_data.data)
+    persistence.close()
+
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert json.dumps(server_data.data) == expected
+
+def test_torn_write(tmp_path, monkeypatch):
+    '''
+    Test that a partially written record at the end of the log is dropped
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.load()
+    make_workspace()
+    expected = json.dumps(server_data.data)
+    persistence.close()
+
+    with open(storage.LOG_PATH, 'a') as FILE:
+        FILE.write('{"op":"message_send","chan')
+
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert json.dumps(server_data.data) == expected
+    with open(storage.LOG_PATH) as FILE:
+        assert FILE.read().endswith('}\n')
+
+def test_failed_apply(tmp_path, monkeypatch):
+    '''
+    Test that a record whose applier raises is not left in the log
+    '''
+    def fail(record):
+        raise ValueError("Cannot apply")
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(persistence.APPLIERS, 'fail', ('data', fail, 'user'))
+    reset_data()
+    persistence.load()
+    token, c_id = make_workspace()
+    with pytest.raises(ValueError):
+        persistence.commit('fail')
+    message_send(token, c_id, 'sent after the failure')
+    expected = json.dumps(server_data.data)
+    persistence.close()
+
+    with open(storage.LOG_PATH) as FILE:
+        records = [json.loads(line) for line in FILE]
+    assert 'fail' not in [record['op'] for record in records]
+    assert [record['seq'] for record in records] == list(range(1, len(records) + 1))
+
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert json.dumps(server_data.data) == expected
+
+def test_torn_write_failed_apply(tmp_path, monkeypatch):
+    '''
+    Test that a record failing to apply right after a torn write was dropped
+    leaves the records after it intact
+    '''
+    def fail(record):
+        raise ValueError("Cannot apply")
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(persistence.APPLIERS, 'fail', ('data', fail, 'user'))
+    reset_data()
+    persistence.load()
+    token, c_id = make_workspace()
+    persistence.close()
+    with open(storage.LOG_PATH, 'a') as FILE:
+        FILE.write('{"op":"message_send","chan')
+
+    reset_data()
+    persistence.load()
+    with pytest.raises(ValueError):
+        persistence.commit('fail')
+    message_send(token, c_id, 'sent after the failure')
+    expected = json.dumps(server_data.data)
+    persistence.close()
+    with open(storage.LOG_PATH, 'rb') as FILE:
+        assert b'\0' not in FILE.read()
+
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert json.dumps(server_data.data) == expected
+
+def test_legacy_store(tmp_path, monkeypatch):
+    '''
+    Test loading a store written before checkpoints carried a seq
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    make_workspace()
+    with open('dataStore.json', 'w') as FILE:
+        json.dump(server_data.data, FILE, indent=4)
+    expected = json.dumps(server_data.data)
+
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert json.dumps(server_data.data) == expected
+
+def test_dirty_stores(tmp_path, monkeypatch):
+    '''
+    Test that checkpoints only write stores that changed since they were written
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.load()
+    make_workspace()
+    persistence.checkpoint()
+
+    # standups and messages_later were never changed
+    assert (tmp_path / 'dataStore.json').exists()
+    assert not (tmp_path / 'standups.json').exists()
+    assert not (tmp_path / 'messagesLater.json').exists()
+
+    # nothing has changed since so nothing is written
+    (tmp_path / 'dataStore.json').unlink()
+    persistence.checkpoint()
+    persistence.maybe_checkpoint()
+    assert not (tmp_path / 'dataStore.json').exists()
+
+    # only the store that changed is written
+    auth_register('test3@gmail.com', '123456', 'Jim', 'Smith')
+    assert persistence.is_dirty('data')
+    assert not persistence.is_dirty('standups')
+    persistence.checkpoint()
+    persistence.close()
+    assert (tmp_path / 'dataStore.json').exists()
+    assert not (tmp_path / 'standups.json').exists()
+    assert not (tmp_path / 'messagesLater.json').exists()
+
+def test_later_replay(tmp_path, monkeypatch):
+    '''
+    Test that messages sent later are delivered and dequeued the same on replay
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.load()
+    token, c_id = make_workspace()
+    now = int(time.time())
+    message_sendlater(token, c_id, 'first', now + 5)
+    message_sendlater(token, c_id, 'second', now + 60)
+    persistence.checkpoint()
+    monkeypatch.setattr(time, 'time', lambda: now + 10)
+    check_latermessages()
+    expected = json.dumps([server_data.data, server_data.messages_later])
+    persistence.close()
+
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert json.dumps([server_data.data, server_data.messages_later]) == expected
+    assert [x['message'] for x in server_data.messages_later] == ['second']
+
+# ------------------------ Testing the sqlite storage -------------------------- #
+
+def snapshot(token, c_id):
+    '''
+    Returns the stores and the channel's messages as the handlers see them,
+    the sqlite storage does not keep the messages in server_data
+    '''
+    data = json.loads(json.dumps(server_data.data))
+    for channel in data['channels']:
+        channel['messages'] = []
+    return json.dumps([data, channel_messages(token, c_id, 0), search(token, 'e')])
+
+def test_sqlite(tmp_path, monkeypatch):
+    '''
+    Test that the sqlite tables hold the same state as memory
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.use_storage(storage.SqliteStorage('slackr.db'))
+    try:
+        persistence.load()
+        token, c_id = make_workspace()
+        message_remove(token, message_send(token, c_id, 'third'))
+        expected = snapshot(token, c_id)
+        persistence.close()
+
+        reset_data()
+        persistence.load()
+        assert snapshot(token, c_id) == expected
+        persistence.close()
+        assert not (tmp_path / 'dataStore.json').exists()
+    finally:
+        persistence.use_storage(storage.JsonStorage())
+
+def test_sqlite_new(tmp_path, monkeypatch):
+    '''
+    Test that a new database can be used without resetting the data first
+    '''
+    monkeypatch.chdir(tmp_path)
+    # the stores as a new process starts with them
+    server_data.data = {"n_users" : 0, "users" : [], "n_channels" : 0,
+                        "channels" : [], "n_messages" : 0}
+    server_data.messages_later = []
+    server_data.standups = []
+    server_data.search_index = None
+    persistence.use_storage(storage.SqliteStorage('slackr.db'))
+    try:
+        persistence.load()
+        token = auth_register('test@gmail.com', '123456', 'John', 'Smith')['token']
+        c_id = channel_create(token, 'Channel1', 'true')
+        message_send(token, c_id, 'Hello world!')
+        assert len(search(token, 'Hello')['messages']) == 1
+        persistence.close()
+    finally:
+        persistence.use_storage(storage.JsonStorage())
+
+def test_sqlite_import(tmp_path, monkeypatch):
+    '''
+    Test that an empty database is filled from the json stores
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.load()
+    token, c_id = make_workspace()
+    expected = snapshot(token, c_id)
+    persistence.close()
+
+    reset_data()
+    persistence.use_storage(storage.SqliteStorage('slackr.db'))
+    try:
+        persistence.load()
+        assert snapshot(token, c_id) == expected
+        persistence.close()
+        reset_data()
+        persistence.load()
+        assert snapshot(token, c_id) == expected
+        persistence.close()
+    finally:
+        persistence.use_storage(storage.JsonStorage())
+
+def test_search_index(tmp_path, monkeypatch):
+    '''
+    Test that the search index is read back from its checkpoint
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.load()
+    token, c_id = make_workspace()
+    persistence.checkpoint()
+    assert (tmp_path / search_index.INDEX_PATH).exists()
+    message_send(token, c_id, 'sent after the checkpoint')
+    expected = server_data.search_index
+    persistence.close()
+
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert server_data.search_index == expected
+
+    # an index older than the data store is rebuilt
+    persistence.load()
+    message_send(token, c_id, 'one more')
+    persistence.checkpoint()
+    expected = server_data.search_index
+    persistence.close()
+    with open(search_index.INDEX_PATH, 'w') as FILE:
+        json.dump({'seq' : 0, 'search_index' : {}}, FILE)
+    reset_data()
+    persistence.load()
+    persistence.close()
+    assert server_data.search_index == expected
+
+def test_search_index_clean(tmp_path, monkeypatch):
+    '''
+    Test that the search index is only written when messages have changed
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.load()
+    token, c_id = make_workspace()
+    dumps = []
+    dump = search_index.dump
+    monkeypatch.setattr(search_index, 'dump', lambda: dumps.append(1) or dump())
+    persistence.checkpoint()
+    assert len(dumps) == 1
+
+    # changes that leave every message as it was do not rewrite it
+    auth_register('test3@gmail.com', '123456', 'Jim', 'Smith')
+    persistence.checkpoint()
+    assert len(dumps) == 1
+    expected = server_data.search_index
+    persistence.close()
+
+    # and it is still read back rather than rebuilt
+    reset_data()
+    generation = server_data.search_index_generation
+    persistence.load()
+    assert server_data.search_index_generation == generation
+    assert server_data.search_index == expected
+
+    message_send(token, c_id, 'sent after the checkpoint')
+    persistence.checkpoint()
+    assert len(dumps) == 2
+    persistence.close()
+
+def _send_from_worker(path, token, c_id, n_messages):
+    persistence.use_storage(storage.SqliteStorage(path, shared=True))
+    persistence.load()
+    for i in range(n_messages):
+        message_send(token, c_id, 'message ' + str(i))
+    persistence.close()
+
+def test_sqlite_shared(tmp_path, monkeypatch):
+    '''
+    Test that several processes sharing a database keep message ids consistent
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.use_storage(storage.SqliteStorage('slackr.db', shared=True))
+    try:
+        persistence.load()
+        token, c_id = make_workspace()
+
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=_send_from_worker,
+                                   args=('slackr.db', token, c_id, 20)) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+            assert worker.exitcode == 0
+
+        # this process catches up with the others before reading
+        assert len(search(token, 'message ')['messages']) == 60
+        messages = channel_messages(token, c_id, 0, limit=100)['messages']
+        assert sorted(message['message_id'] for message in messages) == list(range(62))
+        expected = snapshot(token, c_id)
+        persistence.close()
+
+        reset_data()
+        persistence.load()
+        assert snapshot(token, c_id) == expected
+        persistence.close()
+    finally:
+        persistence.use_storage(storage.JsonStorage())
+
+def test_sqlite_served(tmp_path, monkeypatch):
+    '''
+    Test that the sqlite storage serves the messages from its tables rather
+    than reading them into memory
+    '''
+    monkeypatch.chdir(tmp_path)
+    reset_data()
+    persistence.use_storage(storage.SqliteStorage('slackr.db'))
+    try:
+        persistence.load()
+        token, c_id = make_workspace()
+        for i in range(10):
+            message_send(token, c_id, 'message ' + str(i))
+        message_edit(token, 2, 'edited message')
+        persistence.close()
+
+        reset_data()
+        persistence.load()
+        assert server_data.data['channels'][c_id]['messages'] == []
+        assert server_data.data['channels'][c_id]['channel_n_messages'] == 12
+
+        # paging back through the history with cursors
+        page = channel_messages(token, c_id, 0, limit=5)
+        assert [message['message_id'] for message in page['messages']] == [11, 10, 9, 8, 7]
+        page = channel_messages(token, c_id, 0, cursor=page['older'], limit=5)
+        assert [message['message_id'] for message in page['messages']] == [6, 5, 4, 3, 2]
+        assert page['start'] == 5
+        newer = page['newer']
+        page = channel_messages(token, c_id, 0, cursor=page['older'], limit=5)
+        assert [message['message_id'] for message in page['messages']] == [1, 0]
+        assert page['end'] == -1
+        assert page['messages'][1]['reacts'][0]['u_ids'] == [1]
+        page = channel_messages(token, c_id, 0, cursor=newer, limit=5)
+        assert [message['message_id'] for message in page['messages']] == [11, 10, 9, 8, 7]
+
+        # searching the tables, with and without the trigrams
+        assert [message['message_id'] for message in search(token, 'message 1')['messages']] \
+            == [3]
+        assert len(search(token, 'e')['messages']) == 12
+        assert [message['message_id'] for message in
+                search_terms(token, 'edited "message"')['messages']] == [2]
+
+        message_remove(token, 5)
+        assert channel_messages(token, c_id, 0)['end'] == -1
+        assert len(channel_messages(token, c_id, 0)['messages']) == 11
+
+        # a reset deletes the messages too
+        reset_data()
+        assert persistence.message_store().message(0) is None
+        persistence.close()
+    finally:
+        persistence.use_storage(storage.JsonStorage())
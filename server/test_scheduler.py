@@ -0,0 +1,41 @@
+''' tests for the scheduler'''
+import time as t
+from server.scheduler import Scheduler
+
+# ------------------------ Testing the scheduler -------------------------- #
+
+def test_scheduler():
+    '''
+    Test jobs run on their own interval from one thread and stop cleanly
+    '''
+    runs = {'fast' : 0, 'slow' : 0}
+
+    def fast():
+        runs['fast'] += 1
+
+    def slow():
+        runs['slow'] += 1
+
+    def broken():
+        raise ValueError('broken job')
+
+    scheduler = Scheduler()
+    scheduler.add('fast', fast, 0.02)
+    scheduler.add('slow', slow, 0.2)
+    scheduler.add('broken', broken, 0.05)
+    scheduler.start()
+    t.sleep(0.5)
+    scheduler.stop()
+    stopped = dict(runs)
+
+    # a failing job does not stop the others
+    assert stopped['fast'] > 2 * stopped['slow'] > 0
+    stats = scheduler.stats()
+    assert stats['fast']['runs'] == stopped['fast']
+    assert stats['broken']['errors'] == stats['broken']['runs'] > 0
+    assert stats['slow']['interval'] == 0.2
+    assert stats['slow']['max'] >= stats['slow']['last'] >= 0
+
+    # nothing runs once stopped
+    t.sleep(0.1)
+    assert runs == stopped
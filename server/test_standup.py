@@ -5,7 +5,7 @@ from server.auth import auth_register
 from server.channels import channel_create
 from server.messages import standup_active, standup_start, standup_send
 from server.helper import reset_data, AccessError, standup_messages
-from server.helper import find_standup_msg
+from server.helper import find_standup_msg, check_standups, get_messages
 # ------------------------ Testing standup_start -------------------------- #
 
 def test_standupstart():
@@ -261,3 +261,41 @@ def test_standup_active_none():
     # SETUP END
 
     assert standup_active(token, c_id) is None
+
+# ------------------------ Testing finishing standups -------------------------- #
+
+def test_standup_finish(monkeypatch):
+    '''
+    Test a standup whose end was missed is still summarised, exactly once
+    '''
+    reset_data()
+
+    # SETUP
+
+    registered_user = auth_register('test@gmail.com', '123456', 'John',
+                                    'Smith')
+    token = registered_user['token']
+
+    c_id = channel_create(token, 'Channel1', 'true')
+
+    # SETUP END
+
+    now = int(t.time())
+    standup_start(token, c_id, 5)
+    standup_send(token, c_id, 'hello world')
+    standup_send(token, c_id, 'another message')
+
+    check_standups()
+    assert standup_active(token, c_id) is not None
+
+    # the tick at the end of the standup was missed
+    monkeypatch.setattr(t, 'time', lambda: now + 8)
+    check_standups()
+    check_standups()
+    assert standup_active(token, c_id) is None
+    assert [message['message'] for message in get_messages(c_id)] == [
+        'John: hello world\nJohn: another message\n']
+
+    # a new standup can start straight away
+    standup_start(token, c_id, 5)
+    assert standup_active(token, c_id) == now + 13
@@ -1,12 +1,15 @@
 '''
     Test user_profile functions
 '''
+import json
 import pytest
 import server_data
 from server.user_profile import user_profile, user_profile_setemail, user_profile_sethandle
 from server.user_profile import user_profile_setname, user_profiles_uploadphoto, users_all
+from server.user_profile import user_profiles_uploadphoto_status, users_all_json, users_all_page
+from server import images
 from server.helper import reset_data, AccessError
-from server.auth import auth_register
+from server.auth import auth_register, auth_login
 
 
 def test_users_all():
@@ -33,6 +36,68 @@ def test_users_all():
     with pytest.raises(AccessError):
         users_all("abcd")
 
+def test_users_all_cache():
+    ''' Tests users_all is only serialised again once a user changes '''
+    reset_data()
+    token = auth_register("test@email.com", "validPW", "tom", "cruise")['token']
+    body, etag = users_all_json(token)
+    assert json.loads(body) == users_all(token)
+    assert users_all_json(token) == (body, etag)
+
+    # logging in changes nothing users_all shows
+    auth_login("test@email.com", "validPW")
+    token = server_data.data['users'][0]['token']
+    assert users_all_json(token)[1] == etag
+
+    user_profile_setname(token, "thomas", "cruise")
+    body, new_etag = users_all_json(token)
+    assert new_etag != etag
+    assert json.loads(body)['users'][0]['name_first'] == 'thomas'
+
+    auth_register("test2@email.com", "validPW", "tom", "hanks")
+    assert users_all_json(token)[1] != new_etag
+
+    # the ETag follows what is shown, not how often it was rebuilt
+    reset_data()
+    token = auth_register("test@email.com", "validPW", "tom", "cruise")['token']
+    assert users_all_json(token)[1] == etag
+
+def test_users_all_page():
+    ''' Tests paging through the users matching a prefix '''
+    reset_data()
+    token = auth_register("a@email.com", "validPW", "tom", "cruise")['token']
+    auth_register("b@email.com", "validPW", "tom", "hanks")
+    auth_register("c@email.com", "validPW", "anne", "tomlinson")
+    auth_register("d@email.com", "validPW", "meg", "ryan")
+
+    # each user is listed once, under the first of their names that matches
+    output = users_all_page(token, 'Tom')
+    assert [user['u_id'] for user in output['users']] == [0, 1, 2]
+    assert output['next'] is None
+
+    pages = []
+    cursor = None
+    while True:
+        output = users_all_page(token, 'tom', cursor, 1)
+        pages.append([user['u_id'] for user in output['users']])
+        cursor = output['next']
+        if cursor is None:
+            break
+    assert pages == [[0], [1], [2]]
+
+    # renamed users are found by their new names only
+    user_profile_setname(token, "thomas", "cruise")
+    assert [user['u_id'] for user in users_all_page(token, 'tom c')['users']] == []
+    assert [user['u_id'] for user in users_all_page(token, 'thomas')['users']] == [0]
+    user_profile_sethandle(token, "maverick")
+    assert [user['u_id'] for user in users_all_page(token, 'mav')['users']] == [0]
+    assert len(users_all_page(token)['users']) == 4
+
+    with pytest.raises(ValueError):
+        users_all_page(token, 'tom', 'not a cursor')
+    with pytest.raises(ValueError):
+        users_all_page(token, 'tom', None, 0)
+
 def test_user_profile():
     ''' Tests user_profile function'''
     reset_data()
@@ -131,12 +196,20 @@ def test_user_profiles_uploadphoto():
     with pytest.raises(AccessError):
         user_profiles_uploadphoto("invalidToken", img, 0, 0, 100, 100)
     # Invalid dimensions too big
-    with pytest.raises(ValueError):
-        user_profiles_uploadphoto(output, img, 0, 0, 9999999, 99999999)
+    job_id = user_profiles_uploadphoto(output, img, 0, 0, 9999999, 99999999)['job_id']
+    assert images.wait(job_id, 30)['status'] == 'failed'
+    assert user_profiles_uploadphoto_status(output, job_id)['status'] == 'failed'
 
     # x_start greater than x_end
+    job_id = user_profiles_uploadphoto(output, img, 100, 0, 50, 100)['job_id']
+    assert images.wait(job_id, 30)['status'] == 'failed'
+
+    # Another user's upload
+    other = auth_register("other@email.com", "validPW", "tom", "hanks")['token']
     with pytest.raises(ValueError):
-        user_profiles_uploadphoto(output, img, 100, 0, 50, 100)
+        user_profiles_uploadphoto_status(other, job_id)
 
-    # Fresh look
-    user_profiles_uploadphoto(output, img, 0, 0, 100, 100)
+    # Fresh look, the profile only changes once the upload is done
+    job_id = user_profiles_uploadphoto(output, img, 0, 0, 100, 100)['job_id']
+    assert images.wait(job_id, 30)['status'] == 'done'
+    assert server_data.data['users'][0]['profile_img_url'].startswith(images.IMAGE_ROUTE)
@@ -1,34 +1,78 @@
 '''
 User Profile Functions
 '''
-import urllib.request
-from PIL import Image
+import hashlib
+import json
 import server_data
 from server.helper import is_valid_name, token_to_user
-from server.helper import is_email, is_valid_url, check_valid_user, validate_token
+from server.helper import is_email, check_valid_user, validate_token
+from server.helper import set_email, set_handle, user_details_changed
+from server.persistence import commit, applies
+from server import images, name_index
+from server.locks import reads, writes
 
+@reads
 @validate_token
 def users_all(token):
     '''
     (GET) Users all function
     Returns a dictionary containing the list of all users in slackr
     '''
+    return {'users': _list_users()}
 
-    user_list = []
+def _list_users():
+    return [_user_entry(user) for user in server_data.data['users']]
+
+def _user_entry(user):
     # The following is the return type
     # Dictionary containing u_id, email, name_first, name_last, handle_str, profile_img_url
+    return {
+        'u_id' : user['u_id'],
+        'email' : user['email'],
+        'name_first' : user['name_first'],
+        'name_last' : user['name_last'],
+        'handle_str' : user['handle_str'],
+        'profile_img_url' : images.thumbnail_url(user['profile_img_url'])
+    }
+
+@reads
+@validate_token
+def users_all_page(token, prefix='', cursor=None, limit=None):
+    '''
+    Returns a page of the users with a name or handle starting with prefix,
+    sorted by that name, with a cursor to the next page
+    '''
+    after = None if cursor is None else name_index.read_cursor(cursor)
+    prefix = prefix.lower()
+
+    # a user matching by several names is only listed under the first
+    def first_match(entry):
+        user = server_data.data['users'][entry[1]]
+        return entry[0] == min(name for name in name_index.user_names(user)
+                               if name.startswith(prefix))
 
-    for user in server_data.data['users']:
-        user_list.append({
-            'u_id' : user['u_id'],
-            'email' : user['email'],
-            'name_first' : user['name_first'],
-            'name_last' : user['name_last'],
-            'handle_str' : user['handle_str'],
-            'profile_img_url' : user['profile_img_url']
-        })
+    entries, next_cursor = name_index.page(server_data.user_names, prefix, after, limit,
+                                           first_match)
+    user_list = [_user_entry(server_data.data['users'][u_id]) for _, u_id in entries]
+    return {'users': user_list, 'next': next_cursor}
 
-    return {'users': user_list}
+# users_all serialised, along with the users_version it was built at and its ETag
+_users_all_cache = (None, None, None)
+
+@reads
+@validate_token
+def users_all_json(token):
+    '''
+    Returns the output of users_all serialised as json along with an ETag
+    for it, both are reused until a user changes
+    '''
+    global _users_all_cache
+    version, body, etag = _users_all_cache
+    if version != server_data.users_version:
+        body = json.dumps({'users': _list_users()})
+        etag = hashlib.sha256(body.encode()).hexdigest()[:32]
+        _users_all_cache = (server_data.users_version, body, etag)
+    return body, etag
 
 
 # ============================= USER PROFILES ========================== #
@@ -38,6 +82,7 @@ def users_all(token):
 # ======================================================================== #
 
 
+@reads
 @validate_token
 def user_profile(token, u_id):
     '''
@@ -55,6 +100,7 @@ def user_profile(token, u_id):
         }
     raise ValueError("Invalid User ID")
 
+@writes
 @validate_token
 def user_profile_setname(token, name_first, name_last):
     '''
@@ -63,10 +109,20 @@ def user_profile_setname(token, name_first, name_last):
     is_valid_name(name_first)
     is_valid_name(name_last)
     current_user_id = (token_to_user(token))
-    server_data.data['users'][current_user_id]['name_first'] = name_first
-    server_data.data['users'][current_user_id]['name_last'] = name_last
+    commit('user_profile_setname', u_id=current_user_id,
+           name_first=name_first, name_last=name_last)
     return {}
 
+@applies('user_profile_setname', 'user')
+def _apply_user_profile_setname(record):
+    name_index.remove_user(server_data.data['users'][record['u_id']])
+    server_data.data['users'][record['u_id']]['name_first'] = record['name_first']
+    server_data.data['users'][record['u_id']]['name_last'] = record['name_last']
+    name_index.add_user(server_data.data['users'][record['u_id']])
+    user_details_changed(record['u_id'])
+    server_data.users_version += 1
+
+@writes
 @validate_token
 def user_profile_setemail(token, email):
     '''
@@ -78,13 +134,18 @@ def user_profile_setemail(token, email):
     is_email(email)
 
     # Check if email is being used by another user
-    for user in server_data.data['users']:
-        if user['email'] == email:
-            raise ValueError("Email address is already being used by another user")
+    if email in server_data.user_emails:
+        raise ValueError("Email address is already being used by another user")
     # Update email
-    server_data.data['users'][current_user_id]['email'] = email
+    commit('user_profile_setemail', u_id=current_user_id, email=email)
     return {}
 
+@applies('user_profile_setemail', 'user')
+def _apply_user_profile_setemail(record):
+    set_email(record['u_id'], record['email'])
+    server_data.users_version += 1
+
+@writes
 @validate_token
 def user_profile_sethandle(token, handle_str):
     '''
@@ -98,44 +159,65 @@ def user_profile_sethandle(token, handle_str):
         raise ValueError("Handle must contain at least 3 characters")
 
     # Update handle
-    server_data.data['users'][current_user_id]['handle_str'] = handle_str
+    commit('user_profile_sethandle', u_id=current_user_id, handle_str=handle_str)
     return {}
 
+@applies('user_profile_sethandle', 'user')
+def _apply_user_profile_sethandle(record):
+    set_handle(record['u_id'], record['handle_str'])
+    server_data.users_version += 1
+
 @validate_token
-def user_profiles_uploadphoto(token, img_url, x_start, y_start, x_end, y_end):
+def user_profiles_uploadphoto(token, img_url, x_start, y_start, x_end, y_end, url_root=''):
     '''
     Given a URL of an image on the internet, crops the image within bounds
     (x_start, y_start) and (x_end, y_end).
     Position (0,0) is the top left.
+
+    The image is fetched and cropped in the background, returns the id of
+    the job doing it. The user's profile_img_url is set once it is done.
     '''
 
     curr_user_id = token_to_user(token)
     check_valid_user(curr_user_id)
 
-    # checks if img_url is valid
-    is_valid_url(img_url)
+    # downloading, cropping and saving the image
+    def on_done(key):
+        profile_img_url = url_root + images.IMAGE_ROUTE + images.image_name(key)
+        user_profile_setphoto(curr_user_id, profile_img_url)
 
-    # retrieving the url
-    filepath = './static/' + token + '.jpg'
-    urllib.request.urlretrieve(img_url, filepath)
+    job_id = images.submit(curr_user_id, img_url, (x_start, y_start, x_end, y_end), on_done)
 
-    # opening the file for cropping
-    Image.open(filepath).convert('RGB').save(filepath)
-    img = Image.open(filepath)
+    return {'job_id' : job_id}
 
-    # crop length must be withing dimensions of the image
-    width, height = img.size
+@validate_token
+def user_profiles_uploadphoto_status(token, job_id):
+    '''
+    Returns the status of an upload, one of queued, running, done or failed
+    along with why it failed
+    '''
+    curr_user_id = token_to_user(token)
+    job = images.job_status(job_id)
 
-    if (x_start < 0 or y_start < 0 or x_end > width or y_end > height):
-        raise ValueError(
-            "x_start, y_start, x_end and y_end must be within the dimensions of the image"
-        )
+    # users can only see their own uploads
+    if job is None or job['u_id'] != curr_user_id:
+        raise ValueError("Upload does not exist")
 
-    if (x_start > x_end or y_start > y_end):
-        raise ValueError("x_start and y_start must be smaller than x_end and y_end respectively")
+    return {
+        'job_id' : job['job_id'],
+        'status' : job['status'],
+        'error' : job['error']
+    }
 
-    # cropping image
-    cropped = img.crop((x_start, y_start, x_end, y_end))
-    cropped.save(filepath)
+@writes
+def user_profile_setphoto(u_id, profile_img_url):
+    '''
+    Points a user's profile at a freshly uploaded photo
+    '''
+    commit('user_profile_setphoto', u_id=u_id, profile_img_url=profile_img_url)
 
-    return {}
+@applies('user_profile_setphoto', 'user')
+def _apply_user_profile_setphoto(record):
+    server_data.data['users'][record['u_id']]['profile_img_url'] = record['profile_img_url']
+    server_data.users_version += 1
+    user_details_changed(record['u_id'])
@@ -98,6 +98,105 @@ messages_later = []
 global standups
 standups = []
 
+# ============================ INDEXES ================================ #
+
+# The following are derived from the stores above. They are rebuilt whenever
+# the stores are loaded or reset and kept up to date by the functions that
+# apply each change. Only the search index is saved, with the data store
+
+# token -> u_id of every logged in user
+global sessions
+sessions = {}
+
+# email -> u_id of every user
+global user_emails
+user_emails = {}
+
+# handle_str -> set of u_ids using it, handles set by users need not be unique
+global user_handles
+user_handles = {}
+
+# sorted (name, u_id) of every user's names and handle, lower cased
+global user_names
+user_names = []
+
+# sorted (name, channel_id) of every public channel, lower cased
+global channel_names
+channel_names = []
+
+# handle a new user's handle was made from -> the last number put after it,
+# so the next user with the same name starts counting from there
+global handle_counts
+handle_counts = {}
+
+# Bumped whenever a user's details shown by users_all change, and whenever
+# the stores are loaded, so responses built from them can be cached
+global users_version
+users_version = 0
+
+# message_id -> (channel, message) of every message that has been sent
+global message_index
+message_index = {}
+
+# message_id -> order messages were appended in, which is also their order
+# within each channel. Removed messages keep their entry so cursors naming
+# them still have a place to resume from
+global message_seq
+message_seq = {}
+
+# channel_id -> message_seq of each message in the channel, in the same order
+# as the channel's messages list
+global channel_seqs
+channel_seqs = {}
+
+# channel_id -> set of u_ids who are members of the channel
+global channel_members
+channel_members = {}
+
+# channel_id -> set of u_ids who own the channel
+global channel_owners
+channel_owners = {}
+
+# u_id -> set of channel_ids the user is a member of
+global user_channels
+user_channels = {}
+
+# channel_id -> the members and owners of the channel as channel_details
+# shows them, dropped whenever any of them change
+global member_details
+member_details = {}
+
+# (message_id, react_id) -> set of u_ids who have reacted
+global react_index
+react_index = {}
+
+# channel_id -> the active standup in that channel
+global standup_index
+standup_index = {}
+
+# heap of (time_end, channel_id) of every active standup, the next to finish first
+global standup_queue
+standup_queue = []
+
+# trigram -> set of message_ids of the messages containing it
+# None until it has been built or read back from its checkpoint
+global search_index
+search_index = None
+
+# Bumped whenever the search index changes, so its checkpoint is only
+# rewritten when it has
+global search_index_generation
+search_index_generation = 0
+
+# Mutation generation of each store above, bumped every time the store changes
+# so that only stores that have changed since their last flush are written
+global generations
+generations = {
+    'data' : 0,
+    'standups' : 0,
+    'messages_later' : 0
+}
+
 '''
 # Users (in 'users' list)
 user = {